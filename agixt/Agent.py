@@ -21,6 +21,8 @@ from DB import (
 )
 from Providers import Providers
 from Extensions import Extensions
+from Caches import TTLCache, invalidation_bus
+from ChainCatalog import invalidate_chains
 from Globals import getenv, get_tokens, DEFAULT_SETTINGS, DEFAULT_USER
 from MagicalAuth import MagicalAuth, get_user_id
 from agixtsdk import AGiXTSDK
@@ -29,6 +31,8 @@ from datetime import datetime, timezone, timedelta
 import logging
 import json
 import numpy as np
+import hashlib
+import copy
 import base64
 import jwt
 import os
@@ -40,6 +44,63 @@ logging.basicConfig(
 )
 
 
+# Ready-built agents per worker, keyed by (user, agent_name)
+agent_cache = TTLCache(
+    max_entries=int(getenv("AGENT_CACHE_SIZE")),
+    ttl=float(getenv("AGENT_CACHE_TTL")),
+)
+
+
+def drop_cached_agents(key: str):
+    user, agent_name = json.loads(key)
+
+    def matches(cached_user, cached_agent_name):
+        return cached_user == user and (
+            agent_name is None or cached_agent_name == agent_name
+        )
+
+    agent_cache.pop_matching(
+        lambda cache_key, agent: matches(*cache_key)
+        or (
+            agent.company_agent is not None
+            and matches(agent.company_agent.user, agent.company_agent.agent_name)
+        )
+    )
+
+
+invalidation_bus.subscribe("agent", drop_cached_agents)
+
+# Rendered command examples and their embeddings, keyed by (agent_id, config version)
+command_prompt_cache = TTLCache(
+    max_entries=int(getenv("COMMAND_PROMPT_CACHE_SIZE")),
+    ttl=float(getenv("COMMAND_PROMPT_CACHE_TTL")),
+)
+
+
+def invalidate_agent(agent_name: str = None, user: str = DEFAULT_USER):
+    """Drop a cached agent, or all of a user's agents when agent_name is None, on every worker"""
+    user = str(user if user is not None else DEFAULT_USER).lower()
+    invalidation_bus.publish("agent", json.dumps([user, agent_name]))
+
+
+def get_agent(agent_name=None, user=DEFAULT_USER, ApiClient: AGiXTSDK = None):
+    """
+    Get a ready-built Agent from the worker's agent cache, building it on a miss.
+
+    Each call gets its own shallow copy bound to `ApiClient`, see Agent.bind_request.
+    Use this where the agent's config is only read, the cache is invalidated when the
+    config changes but not when a caller changes the config it is handed.
+    """
+    agent_name = agent_name if agent_name is not None else "AGiXT"
+    user = str(user if user is not None else DEFAULT_USER).lower()
+    invalidation_bus.poll()
+    agent = agent_cache.get((user, agent_name))
+    if agent is None:
+        agent = Agent(agent_name=agent_name, user=user, ApiClient=ApiClient)
+        agent_cache.set((user, agent_name), agent)
+    return agent.bind_request(ApiClient)
+
+
 def impersonate_user(user_id: str):
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
     # Get users email
@@ -125,6 +186,7 @@ def add_agent(agent_name, provider_settings=None, commands=None, user=DEFAULT_US
                 session.add(agent_command)
     session.commit()
     session.close()
+    invalidate_agent(agent_name=agent_name, user=user)
     return {"message": f"Agent {agent_name} created."}
 
 
@@ -177,6 +239,7 @@ def delete_agent(agent_name, user=DEFAULT_USER):
     session.delete(agent)
     session.commit()
     session.close()
+    invalidate_agent(agent_name=agent_name, user=user)
     return {"message": f"Agent {agent_name} deleted."}, 200
 
 
@@ -195,6 +258,9 @@ def rename_agent(agent_name, new_name, user=DEFAULT_USER):
     agent.name = new_name
     session.commit()
     session.close()
+    invalidate_agent(agent_name=agent_name, user=user)
+    invalidate_agent(agent_name=new_name, user=user)
+    invalidate_chains(user_id=user_id, user=user)
     return {"message": f"Agent {agent_name} renamed to {new_name}."}, 200
 
 
@@ -388,6 +454,40 @@ class Agent:
         if self.company_id and str(self.company_id).lower() != "none":
             self.company_agent = self.get_company_agent()
 
+    def bind_request(self, ApiClient: AGiXTSDK = None):
+        """
+        Shallow copy of a cached agent for one request. Providers and extensions are
+        copied and pointed at the request's ApiClient, so concurrent requests do not
+        share credentials, and provider failure counters start over.
+        """
+        agent = copy.copy(self)
+        for name in [
+            "PROVIDER",
+            "VISION_PROVIDER",
+            "TTS_PROVIDER",
+            "TRANSCRIPTION_PROVIDER",
+            "TRANSLATION_PROVIDER",
+            "IMAGE_PROVIDER",
+        ]:
+            provider = getattr(self, name, None)
+            # Providers forwards unknown attributes to its instance, check its own
+            if provider is None or "instance" not in vars(provider):
+                continue
+            bound = Providers.__new__(Providers)
+            vars(bound).update(vars(provider))
+            bound.instance = copy.copy(provider.instance)
+            failures = getattr(bound.instance, "failures", None)
+            if failures is not None:
+                bound.instance.failures = [] if isinstance(failures, list) else 0
+            if ApiClient is not None and hasattr(bound.instance, "ApiClient"):
+                bound.instance.ApiClient = ApiClient
+            setattr(agent, name, bound)
+        agent.extensions = copy.copy(self.extensions)
+        if ApiClient is not None:
+            agent.extensions.ApiClient = ApiClient
+            agent.extensions.api_key = ApiClient.headers.get("Authorization")
+        return agent
+
     def get_company_agent(self):
         if self.company_id:
             company_agent_session = self.auth.get_company_agent_session(
@@ -831,6 +931,7 @@ class Agent:
         try:
             session.commit()
             logging.info(f"Agent {self.agent_name} configuration updated successfully.")
+            invalidate_agent(agent_name=self.agent_name, user=self.user)
         except Exception as e:
             session.rollback()
             logging.error(f"Error updating agent configuration: {str(e)}")
@@ -1027,7 +1128,118 @@ class Agent:
             logging.error(f"Error getting tasks by agent: {str(e)}")
             return []
 
-    def get_commands_prompt(self, conversation_id):
+    def get_config_version(self) -> str:
+        """Hash of the agent's config and its company agent's config"""
+        config = {"agent": self.AGENT_CONFIG}
+        if self.company_id and self.company_agent:
+            config["company"] = self.company_agent.AGENT_CONFIG
+        return hashlib.sha256(
+            json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def get_command_catalog(self) -> dict:
+        """
+        The enabled commands with their rendered execution examples, cached per agent
+        config version. Description embeddings are added on the first selection.
+        """
+        key = (self.agent_id, self.get_config_version())
+        catalog = command_prompt_cache.get(key)
+        if catalog is not None:
+            return catalog
+        try:
+            agent_extensions = self.get_company_agent_extensions()
+            if agent_extensions == "":
+                agent_extensions = self.get_agent_extensions()
+        except Exception as e:
+            logging.error(f"Error getting agent extensions: {str(e)}")
+            agent_extensions = self.get_agent_extensions()
+        extensions = {}
+        commands = []
+        for extension in agent_extensions:
+            if extension["commands"] == []:
+                continue
+            extension_name = extension["extension_name"]
+            extension_description = extension["description"]
+            enabled_commands = [
+                command
+                for command in extension["commands"]
+                if command["enabled"] == True
+            ]
+            if enabled_commands == []:
+                continue
+            extensions[extension_name] = (
+                f"\n### {extension_name}\nDescription: {extension_description}\n"
+            )
+            for command in enabled_commands:
+                command_friendly_name = command["friendly_name"]
+                command_description = command["description"]
+                example = f"\n#### {command_friendly_name}\nDescription: {command_description}\nCommand execution format:\n"
+                example += f"<execute>\n<name>{command_friendly_name}</name>\n"
+                for arg_name in command["command_args"].keys():
+                    if arg_name != "chain_name":
+                        example += f"<{arg_name}>The assistant will fill in the value based on relevance to the conversation.</{arg_name}>\n"
+                    else:
+                        example += f"<chain_name>{command_friendly_name}</chain_name>\n"
+                example += "</execute>\n"
+                commands.append(
+                    {
+                        "extension_name": extension_name,
+                        "friendly_name": command_friendly_name,
+                        "example": example,
+                        "args": ", ".join(
+                            (
+                                arg_name
+                                if arg_name != "chain_name"
+                                else f"chain_name: {command_friendly_name}"
+                            )
+                            for arg_name in command["command_args"].keys()
+                        ),
+                        "text": f"{extension_name} - {command_friendly_name}: {command_description}",
+                    }
+                )
+        catalog = {"extensions": extensions, "commands": commands, "embeddings": None}
+        command_prompt_cache.set(key, catalog)
+        return catalog
+
+    def select_commands(
+        self, catalog: dict, user_input: str = "", query_embedding=None
+    ) -> set:
+        """
+        Indexes of the COMMANDS_TOP_K commands whose descriptions are closest to the
+        input, or of every command when there are no more than that or no input.
+        """
+        commands = catalog["commands"]
+        top_k = int(getenv("COMMANDS_TOP_K"))
+        if (
+            top_k <= 0
+            or len(commands) <= top_k
+            or (not user_input and query_embedding is None)
+        ):
+            return set(range(len(commands)))
+        try:
+            if catalog["embeddings"] is None:
+                embeddings = np.array(
+                    self.embeddings([command["text"] for command in commands]),
+                    dtype=np.float32,
+                )
+                embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+                catalog["embeddings"] = embeddings
+            if query_embedding is None:
+                query_embedding = self.embeddings([user_input])[0]
+            query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+            scores = catalog["embeddings"] @ (query / (np.linalg.norm(query) + 1e-12))
+        except Exception as e:
+            logging.error(f"Error selecting commands, including all of them: {e}")
+            return set(range(len(commands)))
+        return set(np.argsort(-scores)[:top_k].tolist())
+
+    def get_commands_prompt(
+        self, conversation_id, user_input: str = "", query_embedding=None
+    ):
+        """
+        The command examples for the prompt. With a user input, only the commands most
+        relevant to it get full examples and the rest are listed in a compact index.
+        """
         command_list = [
             available_command["friendly_name"]
             for available_command in self.available_commands
@@ -1050,44 +1262,31 @@ class Agent:
             conversation_outputs = (
                 f"http://localhost:7437/outputs/{self.agent_id}/{conversation_id}/"
             )
-            try:
-                agent_extensions = self.get_company_agent_extensions()
-                if agent_extensions == "":
-                    agent_extensions = self.get_agent_extensions()
-            except Exception as e:
-                logging.error(f"Error getting agent extensions: {str(e)}")
-                agent_extensions = self.get_agent_extensions()
+            catalog = self.get_command_catalog()
+            selected = self.select_commands(
+                catalog, user_input=user_input, query_embedding=query_embedding
+            )
             agent_commands = "## Available Commands\n\n**See command execution examples of commands that the assistant has access to below:**\n"
-            for extension in agent_extensions:
-                if extension["commands"] == []:
-                    continue
-                extension_name = extension["extension_name"]
-                extension_description = extension["description"]
-                enabled_commands = [
-                    command
-                    for command in extension["commands"]
-                    if command["enabled"] == True
-                ]
-                if enabled_commands == []:
+            extension_name = None
+            for index, command in enumerate(catalog["commands"]):
+                if index not in selected:
                     continue
-                agent_commands += (
-                    f"\n### {extension_name}\nDescription: {extension_description}\n"
-                )
-                for command in enabled_commands:
-                    command_friendly_name = command["friendly_name"]
-                    command_description = command["description"]
-                    agent_commands += f"\n#### {command_friendly_name}\nDescription: {command_description}\nCommand execution format:\n"
+                if command["extension_name"] != extension_name:
+                    extension_name = command["extension_name"]
+                    agent_commands += catalog["extensions"][extension_name]
+                agent_commands += command["example"]
+            if len(selected) < len(catalog["commands"]):
+                agent_commands += "\n### Other Available Commands\nThese commands use the same execution format with the listed argument names:\n"
+                extension_name = None
+                for index, command in enumerate(catalog["commands"]):
+                    if index in selected:
+                        continue
+                    if command["extension_name"] != extension_name:
+                        extension_name = command["extension_name"]
+                        agent_commands += f"\n**{extension_name}**\n"
                     agent_commands += (
-                        f"<execute>\n<name>{command_friendly_name}</name>\n"
+                        f"- {command['friendly_name']} ({command['args']})\n"
                     )
-                    for arg_name in command["command_args"].keys():
-                        if arg_name != "chain_name":
-                            agent_commands += f"<{arg_name}>The assistant will fill in the value based on relevance to the conversation.</{arg_name}>\n"
-                        else:
-                            agent_commands += (
-                                f"<chain_name>{command_friendly_name}</chain_name>\n"
-                            )
-                    agent_commands += "</execute>\n"
             agent_commands += f"""## Command Execution Guidelines
 - **The assistant has commands available to use if they would be useful to provide a better user experience.**
 - Reference examples for correct syntax and usage of commands.
@@ -0,0 +1,188 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+from sqlalchemy import func
+from DB import CacheInvalidation, get_session
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def pop_matching(self, predicate: Callable) -> int:
+        """Drop every entry for which predicate(key, value) is true, returns how many were dropped"""
+        with self.lock:
+            keys = [
+                key for key, entry in self.entries.items() if predicate(key, entry[0])
+            ]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class InvalidationBus:
+    """
+    Cross-worker cache invalidation through the cache_invalidation table.
+
+    `publish` runs the local handlers right away and records the key, every other
+    worker picks it up the next time it polls, at most `poll_interval` seconds later.
+    Polling happens lazily from `poll()`, which caches call before each lookup.
+    """
+
+    def __init__(self, poll_interval: float = 1.0, retention_seconds: float = 3600):
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self.handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self.last_id = None
+        self.last_poll = 0.0
+        self.publishes = 0
+        # Ids already handled, including the ones this worker published itself
+        self.seen_ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def subscribe(self, scope: str, handler: Callable[[str], None]):
+        self.handlers.setdefault(scope, []).append(handler)
+
+    def dispatch(self, scope: str, key: str):
+        for handler in self.handlers.get(scope, []):
+            try:
+                handler(key)
+            except Exception as e:
+                logging.error(f"Error invalidating {scope} cache for {key}: {e}")
+
+    def publish(self, scope: str, key: str):
+        self.dispatch(scope, key)
+        session = get_session()
+        try:
+            invalidation = CacheInvalidation(scope=scope, key=key)
+            session.add(invalidation)
+            self.publishes += 1
+            if self.publishes % 100 == 0:
+                # Keep the log short, workers only ever read recent rows
+                session.query(CacheInvalidation).filter(
+                    CacheInvalidation.created_at
+                    < datetime.now() - timedelta(seconds=self.retention_seconds)
+                ).delete(synchronize_session=False)
+            session.commit()
+            self.mark_seen(invalidation.id)
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error publishing {scope} cache invalidation: {e}")
+        finally:
+            session.close()
+
+    def mark_seen(self, id: int):
+        with self.lock:
+            self.seen_ids[id] = True
+            while len(self.seen_ids) > 10000:
+                self.seen_ids.popitem(last=False)
+
+    def poll(self):
+        now = time.monotonic()
+        if now - self.last_poll < self.poll_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.last_poll = now
+            session = get_session()
+            try:
+                if self.last_id is None:
+                    # Start from the end of the log, there is nothing cached yet
+                    self.last_id = (
+                        session.query(func.max(CacheInvalidation.id)).scalar() or 0
+                    )
+                    return
+                # Ids can commit out of order, look back a little for late ones
+                rows = (
+                    session.query(
+                        CacheInvalidation.id,
+                        CacheInvalidation.scope,
+                        CacheInvalidation.key,
+                    )
+                    .filter(CacheInvalidation.id > self.last_id - 100)
+                    .order_by(CacheInvalidation.id)
+                    .all()
+                )
+            finally:
+                session.close()
+            for id, scope, key in rows:
+                self.last_id = max(self.last_id, id)
+                if id in self.seen_ids:
+                    continue
+                self.seen_ids[id] = True
+                self.dispatch(scope, key)
+            while len(self.seen_ids) > 10000:
+                self.seen_ids.popitem(last=False)
+        except Exception as e:
+            logging.error(f"Error polling cache invalidations: {e}")
+        finally:
+            self.lock.release()
+
+
+invalidation_bus = InvalidationBus(
+    poll_interval=float(getenv("CACHE_INVALIDATION_POLL_SECONDS"))
+)
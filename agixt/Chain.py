@@ -17,94 +17,122 @@ from Globals import getenv, DEFAULT_USER
 from Prompts import Prompts
 from Extensions import Extensions
 from MagicalAuth import get_user_id
+from ChainCatalog import get_catalog_chain, invalidate_chains
+import re
 import logging
 import asyncio
+import weakref
+import contextvars
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
     format=getenv("LOG_FORMAT"),
 )
+STEP_REFERENCE = re.compile(r"\{STEP(\d+)\}")
+# Completion events of the steps of chain runs executing in this process
+running_chain_runs = {}
+# Per user step limits, asyncio primitives belong to the loop they run on
+_user_step_limits = weakref.WeakKeyDictionary()
+# The user step limit whose slot the current chain step holds, chains the step runs
+# in this process use that slot instead of waiting for one of their own
+_held_user_slot = contextvars.ContextVar("held_user_slot", default=None)
 
 
-class Chain:
-    def __init__(self, user=DEFAULT_USER):
-        self.user = user
-        self.user_id = get_user_id(self.user)
-
-    def get_chain(self, chain_name):
-        session = get_session()
-        chain_name = chain_name.replace("%20", " ")
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        chain_db = (
-            session.query(ChainDB)
-            .filter(ChainDB.user_id == user_data.id, ChainDB.name == chain_name)
-            .first()
-        )
-        if chain_db is None:
-            chain_db = (
-                session.query(ChainDB)
-                .filter(
-                    ChainDB.name == chain_name,
-                    ChainDB.user_id == self.user_id,
-                )
-                .first()
-            )
-        if chain_db is None:
-            session.close()
-            return []
-        chain_steps = (
-            session.query(ChainStep)
-            .filter(ChainStep.chain_id == chain_db.id)
-            .order_by(ChainStep.step_number)
-            .all()
+def get_user_step_limit(user: str) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    limits = _user_step_limits.get(loop)
+    if limits is None:
+        limits = {}
+        _user_step_limits[loop] = limits
+    user = str(user).lower()
+    if user not in limits:
+        limits[user] = asyncio.Semaphore(
+            max(1, int(getenv("CHAIN_USER_MAX_CONCURRENCY")))
         )
+    return limits[user]
 
-        steps = []
-        for step in chain_steps:
-            agent_name = session.query(Agent).get(step.agent_id).name
-            prompt = {}
-            if step.target_chain_id:
-                prompt["chain_name"] = (
-                    session.query(ChainDB).get(step.target_chain_id).name
-                )
-            elif step.target_command_id:
-                prompt["command_name"] = (
-                    session.query(Command).get(step.target_command_id).name
-                )
-            elif step.target_prompt_id:
-                prompt["prompt_name"] = (
-                    session.query(Prompt).get(step.target_prompt_id).name
-                )
 
-            # Retrieve argument data for the step
-            arguments = (
-                session.query(Argument, ChainStepArgument)
-                .join(ChainStepArgument, ChainStepArgument.argument_id == Argument.id)
-                .filter(ChainStepArgument.chain_step_id == step.id)
-                .all()
+async def run_chain_steps(
+    steps: list,
+    dependencies: dict,
+    run_step,
+    chain_run_id=None,
+    max_concurrency: int = 0,
+    user: str = DEFAULT_USER,
+) -> dict:
+    """
+    Run chain steps as a dependency graph and return their results by step number.
+
+    A step starts once the earlier steps it depends on have finished, at most
+    `max_concurrency` steps of the chain and CHAIN_USER_MAX_CONCURRENCY steps of the
+    user run at once. Dependencies on steps that are not in `steps`, such as the ones
+    before the step a run resumes from, count as met. Steps hold their user slot for
+    all of their work. Steps that run a chain do not take a user slot, the steps of
+    that chain take their own. A chain run from inside a step of the same user, such
+    as a command that runs a chain, runs under that step's slot instead of waiting
+    for slots held by the steps waiting on it.
+    """
+    if max_concurrency <= 0:
+        max_concurrency = int(getenv("CHAIN_MAX_CONCURRENCY"))
+    chain_limit = asyncio.Semaphore(max(1, max_concurrency))
+    user_limit = get_user_step_limit(user)
+    nested = _held_user_slot.get() is user_limit
+    completed = {int(step["step"]): asyncio.Event() for step in steps}
+    results = {}
+    if chain_run_id:
+        running_chain_runs[str(chain_run_id)] = completed
+
+    async def run(step):
+        step_number = int(step["step"])
+        try:
+            for dependency in dependencies.get(str(step_number), []):
+                if dependency in completed and dependency < step_number:
+                    await completed[dependency].wait()
+            if nested or str(step.get("prompt_type", "")).lower() == "chain":
+                async with chain_limit:
+                    results[step_number] = await run_step(step)
+            else:
+                async with chain_limit, user_limit:
+                    held = _held_user_slot.set(user_limit)
+                    try:
+                        results[step_number] = await run_step(step)
+                    finally:
+                        _held_user_slot.reset(held)
+        finally:
+            completed[step_number].set()
+
+    tasks = [asyncio.create_task(run(step)) for step in steps]
+    try:
+        if tasks:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
             )
+            failed = [task for task in done if task.exception() is not None]
+            if failed:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                raise failed[0].exception()
+    finally:
+        # A cancelled run takes its steps down with it
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        if chain_run_id and running_chain_runs.get(str(chain_run_id)) is completed:
+            del running_chain_runs[str(chain_run_id)]
+    return results
 
-            prompt_args = {}
-            for argument, chain_step_argument in arguments:
-                prompt_args[argument.name] = chain_step_argument.value
 
-            prompt.update(prompt_args)
+class Chain:
+    def __init__(self, user=DEFAULT_USER):
+        self.user = user
+        self.user_id = get_user_id(self.user)
 
-            step_data = {
-                "step": step.step_number,
-                "agent_name": agent_name,
-                "prompt_type": step.prompt_type,
-                "prompt": prompt,
-            }
-            steps.append(step_data)
+    def get_chain(self, chain_name):
+        return get_catalog_chain(self.user_id, chain_name)
 
-        chain_data = {
-            "id": chain_db.id,
-            "chain_name": chain_db.name,
-            "steps": steps,
-        }
-        session.close()
-        return chain_data
+    def chains_changed(self):
+        invalidate_chains(user_id=self.user_id, user=self.user)
 
     def get_global_chains(self):
         session = get_session()
@@ -168,6 +196,7 @@ class Chain:
         session.add(chain)
         session.commit()
         session.close()
+        self.chains_changed()
 
     def rename_chain(self, chain_name, new_name):
         session = get_session()
@@ -180,6 +209,7 @@ class Chain:
             chain.name = new_name
             session.commit()
         session.close()
+        self.chains_changed()
 
     def add_chain_step(
         self,
@@ -361,6 +391,7 @@ class Chain:
             session.add(chain_step_argument)
             session.commit()
         session.close()
+        self.chains_changed()
 
     def update_step(self, chain_name, step_number, agent_name, prompt_type, prompt):
         session = get_session()
@@ -457,6 +488,7 @@ class Chain:
                 session.add(chain_step_argument)
                 session.commit()
         session.close()
+        self.chains_changed()
 
     def delete_step(self, chain_name, step_number):
         session = get_session()
@@ -483,6 +515,7 @@ class Chain:
         else:
             logging.info(f"No chain found with name '{chain_name}'")
         session.close()
+        self.chains_changed()
 
     def delete_chain(self, chain_name):
         session = get_session()
@@ -494,6 +527,7 @@ class Chain:
         session.delete(chain)
         session.commit()
         session.close()
+        self.chains_changed()
 
     def get_steps(self, chain_name):
         session = get_session()
@@ -568,6 +602,7 @@ class Chain:
             )
         session.commit()
         session.close()
+        self.chains_changed()
 
     def get_step_response(self, chain_name, chain_run_id=None, step_number="all"):
         if chain_run_id is None:
@@ -762,49 +797,49 @@ class Chain:
                 session.add(chain_step_argument)
                 session.commit()
         session.close()
+        self.chains_changed()
         return f"Imported chain: {chain_name}"
 
-    def get_chain_step_dependencies(self, chain_name):
-        chain_steps = self.get_steps(chain_name=chain_name)
+    def get_chain_step_dependencies(self, chain_name, chain_data=None):
+        """
+        Earlier steps each step needs the output of, by step number.
+
+        A step depends on the steps it references as {STEPn} and, when its prompt uses
+        {context}, on every step before it.
+        """
+        if chain_data is None:
+            chain_data = self.get_chain(chain_name=chain_name)
+        if not chain_data:
+            return {}
         prompts = Prompts(user=self.user)
+        step_numbers = [int(step["step"]) for step in chain_data["steps"]]
         chain_dependencies = {}
-        for step in chain_steps:
-            step_dependencies = []
-            prompt = step.prompt
-            if not isinstance(prompt, dict) and not isinstance(prompt, str):
-                prompt = str(prompt)
-            if isinstance(prompt, dict):
-                for key, value in prompt.items():
-                    if "{STEP" in value:
-                        step_count = value.count("{STEP")
-                        for i in range(step_count):
-                            new_step_number = int(value.split("{STEP")[1].split("}")[0])
-                            step_dependencies.append(new_step_number)
-                if "prompt_name" in prompt:
-                    prompt_text = prompts.get_prompt(
-                        prompt_name=prompt["prompt_name"],
-                        prompt_category=(
-                            prompt["prompt_category"]
-                            if "prompt_category" in prompt
-                            else "Default"
-                        ),
-                    )
-                    # See if "{context}" is in the prompt
-                    if "{context}" in prompt_text:
-                        # Add all prior steps in the chain as deps
-                        for i in range(step.step_number):
-                            step_dependencies.append(i)
-            elif isinstance(prompt, str):
-                if "{STEP" in prompt:
-                    step_count = prompt.count("{STEP")
-                    for i in range(step_count):
-                        new_step_number = int(prompt.split("{STEP")[1].split("}")[0])
-                        step_dependencies.append(new_step_number)
-                    if "{context}" in prompt:
-                        # Add all prior steps in the chain as deps
-                        for i in range(step.step_number):
-                            step_dependencies.append(i)
-            chain_dependencies[str(step.step_number)] = step_dependencies
+        for step in chain_data["steps"]:
+            step_number = int(step["step"])
+            prompt = step["prompt"]
+            values = prompt.values() if isinstance(prompt, dict) else [prompt]
+            text = "\n".join(str(value) for value in values)
+            step_dependencies = {
+                int(reference) for reference in STEP_REFERENCE.findall(text)
+            }
+            uses_context = "{context}" in text
+            if isinstance(prompt, dict) and "prompt_name" in prompt:
+                prompt_text = prompts.get_prompt(
+                    prompt_name=prompt["prompt_name"],
+                    prompt_category=(
+                        prompt["prompt_category"]
+                        if "prompt_category" in prompt
+                        else "Default"
+                    ),
+                )
+                if prompt_text and "{context}" in prompt_text:
+                    uses_context = True
+            if uses_context:
+                # Add all prior steps in the chain as deps
+                step_dependencies.update(
+                    number for number in step_numbers if number < step_number
+                )
+            chain_dependencies[str(step_number)] = sorted(step_dependencies)
         return chain_dependencies
 
     async def check_if_dependencies_met(
@@ -813,6 +848,13 @@ class Chain:
         if dependencies == []:
             chain_dependencies = self.get_chain_step_dependencies(chain_name=chain_name)
             dependencies = chain_dependencies[str(step_number)]
+        completed = running_chain_runs.get(str(chain_run_id))
+        if completed is not None:
+            # The run executes in this process, wait for its steps to signal
+            for dependency in dependencies:
+                if int(dependency) in completed:
+                    await completed[int(dependency)].wait()
+            return True
 
         async def check_dependencies_met(dependencies):
             for dependency in dependencies:
@@ -835,7 +877,13 @@ class Chain:
         return True
 
     def get_step_content(
-        self, chain_run_id, chain_name, prompt_content, user_input, agent_name
+        self,
+        chain_run_id,
+        chain_name,
+        prompt_content,
+        user_input,
+        agent_name,
+        step_responses: dict = None,
     ):
         if isinstance(prompt_content, dict):
             new_prompt_content = {}
@@ -849,11 +897,14 @@ class Chain:
                         step_count = value.count("{STEP")
                         for i in range(step_count):
                             new_step_number = int(value.split("{STEP")[1].split("}")[0])
-                            step_response = self.get_step_response(
-                                chain_run_id=chain_run_id,
-                                chain_name=chain_name,
-                                step_number=new_step_number,
-                            )
+                            if step_responses and new_step_number in step_responses:
+                                step_response = step_responses[new_step_number]
+                            else:
+                                step_response = self.get_step_response(
+                                    chain_run_id=chain_run_id,
+                                    chain_name=chain_name,
+                                    step_number=new_step_number,
+                                )
                             if step_response:
                                 resp = (
                                     step_response[0]
@@ -881,11 +932,14 @@ class Chain:
                     new_step_number = int(
                         prompt_content.split("{STEP")[1].split("}")[0]
                     )
-                    step_response = self.get_step_response(
-                        chain_run_id=chain_run_id,
-                        chain_name=chain_name,
-                        step_number=new_step_number,
-                    )
+                    if step_responses and new_step_number in step_responses:
+                        step_response = step_responses[new_step_number]
+                    else:
+                        step_response = self.get_step_response(
+                            chain_run_id=chain_run_id,
+                            chain_name=chain_name,
+                            step_number=new_step_number,
+                        )
                     if step_response:
                         resp = (
                             step_response[0]
@@ -0,0 +1,182 @@
+import copy
+import logging
+import threading
+from sqlalchemy.orm import aliased
+from DB import (
+    get_session,
+    Chain as ChainDB,
+    ChainStep,
+    Agent,
+    Argument,
+    ChainStepArgument,
+    Prompt,
+    Command,
+    User,
+)
+from Caches import TTLCache, invalidation_bus
+from Globals import getenv, DEFAULT_USER
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Per user catalog of every chain the user can run, with steps, targets and arguments
+catalog_cache = TTLCache(
+    max_entries=int(getenv("CHAIN_CACHE_SIZE")),
+    ttl=float(getenv("CHAIN_CACHE_TTL")),
+)
+# Bumped by every chain change, a catalog built while it moved is not cached
+catalog_version = 0
+catalog_version_lock = threading.Lock()
+
+
+def drop_chain_catalogs(key: str):
+    global catalog_version
+    with catalog_version_lock:
+        catalog_version += 1
+    if key == "*":
+        catalog_cache.clear()
+    else:
+        catalog_cache.pop(key)
+
+
+invalidation_bus.subscribe("chains", drop_chain_catalogs)
+
+
+def invalidate_chains(user_id=None, user: str = ""):
+    """
+    Drop the chain catalog of a user on every worker, or of all users when user_id is
+    None. Changes by the default user reach every catalog, its chains are shared.
+    """
+    if user_id is None or str(user).lower() == DEFAULT_USER.lower():
+        invalidation_bus.publish("chains", "*")
+    else:
+        invalidation_bus.publish("chains", str(user_id))
+
+
+def load_chain_catalog(user_id) -> dict:
+    """
+    Read every chain owned by the user or the default user in four queries.
+
+    Returns the names of the user's own chains and the chain data for every name,
+    in the format Chain.get_chain returns. Names owned by both resolve to the default
+    user's chain, the same as Chain.get_chain.
+    """
+    session = get_session()
+    try:
+        default_user = session.query(User).filter(User.email == DEFAULT_USER).first()
+        owner_ids = [user_id]
+        if default_user is not None:
+            owner_ids.append(default_user.id)
+        chains = (
+            session.query(ChainDB.id, ChainDB.name, ChainDB.user_id)
+            .filter(ChainDB.user_id.in_(owner_ids))
+            .all()
+        )
+        chain_ids = [chain.id for chain in chains]
+        TargetChain = aliased(ChainDB)
+        steps = []
+        arguments = []
+        if chain_ids:
+            steps = (
+                session.query(
+                    ChainStep.id,
+                    ChainStep.chain_id,
+                    ChainStep.step_number,
+                    ChainStep.prompt_type,
+                    ChainStep.target_chain_id,
+                    ChainStep.target_command_id,
+                    ChainStep.target_prompt_id,
+                    Agent.name.label("agent_name"),
+                    TargetChain.name.label("target_chain_name"),
+                    Command.name.label("target_command_name"),
+                    Prompt.name.label("target_prompt_name"),
+                )
+                .outerjoin(Agent, Agent.id == ChainStep.agent_id)
+                .outerjoin(TargetChain, TargetChain.id == ChainStep.target_chain_id)
+                .outerjoin(Command, Command.id == ChainStep.target_command_id)
+                .outerjoin(Prompt, Prompt.id == ChainStep.target_prompt_id)
+                .filter(ChainStep.chain_id.in_(chain_ids))
+                .order_by(ChainStep.step_number)
+                .all()
+            )
+            arguments = (
+                session.query(
+                    ChainStepArgument.chain_step_id,
+                    Argument.name,
+                    ChainStepArgument.value,
+                )
+                .join(Argument, ChainStepArgument.argument_id == Argument.id)
+                .join(ChainStep, ChainStep.id == ChainStepArgument.chain_step_id)
+                .filter(ChainStep.chain_id.in_(chain_ids))
+                .all()
+            )
+    finally:
+        session.close()
+
+    step_arguments = {}
+    for chain_step_id, argument_name, value in arguments:
+        step_arguments.setdefault(str(chain_step_id), {})[argument_name] = value
+    chain_steps = {}
+    for step in steps:
+        prompt = {}
+        if step.target_chain_id:
+            prompt["chain_name"] = step.target_chain_name
+        elif step.target_command_id:
+            prompt["command_name"] = step.target_command_name
+        elif step.target_prompt_id:
+            prompt["prompt_name"] = step.target_prompt_name
+        prompt.update(step_arguments.get(str(step.id), {}))
+        chain_steps.setdefault(str(step.chain_id), []).append(
+            {
+                "step": step.step_number,
+                "agent_name": step.agent_name,
+                "prompt_type": step.prompt_type,
+                "prompt": prompt,
+            }
+        )
+
+    user_chains = []
+    catalog = {}
+    default_user_id = str(default_user.id) if default_user is not None else None
+    for chain in chains:
+        owned_by_default = str(chain.user_id) == default_user_id
+        if str(chain.user_id) == str(user_id):
+            user_chains.append(chain.name)
+        if chain.name in catalog and not owned_by_default:
+            continue
+        catalog[chain.name] = {
+            "id": chain.id,
+            "chain_name": chain.name,
+            "steps": chain_steps.get(str(chain.id), []),
+        }
+    return {"user_chains": user_chains, "chains": catalog}
+
+
+def get_chain_catalog(user_id) -> dict:
+    """The cached chain catalog of a user, loaded on a miss"""
+    key = str(user_id)
+    invalidation_bus.poll()
+    catalog = catalog_cache.get(key)
+    if catalog is None:
+        version = catalog_version
+        catalog = load_chain_catalog(user_id)
+        if version == catalog_version:
+            catalog_cache.set(key, catalog)
+    return catalog
+
+
+def get_user_chain_names(user_id) -> list:
+    """Names of the chains the user owns"""
+    return list(get_chain_catalog(user_id)["user_chains"])
+
+
+def get_catalog_chain(user_id, chain_name: str):
+    """Chain data for a chain the user can run, or [] when there is none"""
+    chain_name = chain_name.replace("%20", " ")
+    chain_data = get_chain_catalog(user_id)["chains"].get(chain_name)
+    if chain_data is None:
+        return []
+    # Callers change the steps they get, keep the cached copy intact
+    return copy.deepcopy(chain_data)
@@ -0,0 +1,78 @@
+import logging
+from Globals import getenv, get_tokens
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class ContextAssembler:
+    """
+    Packs context items into a token budget.
+
+    Required items are always kept. Optional items are packed greedily by relevance
+    per token until the budget is spent, the items that did not fit are recorded in
+    `dropped`. Packed items keep the order they were added in.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = max(0, int(budget))
+        self.items = []
+        self.texts = set()
+        self.dropped = []
+        self.tokens = 0
+
+    def add(self, name: str, text: str, relevance: float = 1.0, required: bool = False):
+        """Add an item, empty items and exact duplicates of earlier items are ignored"""
+        text = str(text) if text is not None else ""
+        if text.strip() == "" or text in self.texts:
+            return
+        self.texts.add(text)
+        self.items.append(
+            {
+                "name": name,
+                "text": text,
+                # Items are joined with newlines
+                "tokens": get_tokens(text) + 1,
+                "relevance": float(relevance),
+                "required": required,
+            }
+        )
+
+    def pack(self) -> list:
+        """The texts of the items that fit the budget, in the order they were added"""
+        used = sum(item["tokens"] for item in self.items if item["required"])
+        optional = sorted(
+            (item for item in self.items if not item["required"]),
+            key=lambda item: item["relevance"] / item["tokens"],
+            reverse=True,
+        )
+        kept = set()
+        self.dropped = []
+        for item in optional:
+            if used + item["tokens"] <= self.budget:
+                used += item["tokens"]
+                kept.add(id(item))
+            else:
+                self.dropped.append(
+                    {
+                        "name": item["name"],
+                        "tokens": item["tokens"],
+                        "relevance": item["relevance"],
+                    }
+                )
+        self.tokens = used
+        if self.dropped:
+            logging.info(
+                f"Context budget of {self.budget} tokens dropped {len(self.dropped)} items "
+                f"({sum(item['tokens'] for item in self.dropped)} tokens): "
+                + ", ".join(item["name"] for item in self.dropped)
+            )
+        if used > self.budget:
+            logging.warning(
+                f"Required context uses {used} tokens, over the budget of {self.budget}"
+            )
+        return [
+            item["text"] for item in self.items if item["required"] or id(item) in kept
+        ]
@@ -1,5 +1,7 @@
 from datetime import datetime
 import logging
+import base64
+import json
 from DB import (
     Conversation,
     Agent,
@@ -9,9 +11,11 @@ from DB import (
     get_session,
 )
 from Globals import getenv, DEFAULT_USER
+from sqlalchemy import and_, or_, exists
 from sqlalchemy.sql import func
 import pytz
-from MagicalAuth import convert_time
+from MagicalAuth import convert_time, convert_times, get_user_timezone
+from EventBus import event_bus
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -19,6 +23,30 @@ logging.basicConfig(
 )
 
 
+def publish_conversation_event(user_id, event_type: str, conversation_id, **fields):
+    """Tell the user's app_state subscribers, on every worker, about a conversation change"""
+    event_bus.publish(
+        f"user:{user_id}",
+        {"type": event_type, "conversation_id": str(conversation_id), **fields},
+    )
+
+
+def encode_conversation_cursor(updated_at: datetime, conversation_id) -> str:
+    """Opaque cursor for the conversation listing, ordered by updated_at then id"""
+    value = json.dumps([updated_at.isoformat(), str(conversation_id)])
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("utf-8")
+
+
+def decode_conversation_cursor(cursor: str):
+    try:
+        updated_at, conversation_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("utf-8"))
+        )
+        return datetime.fromisoformat(updated_at), conversation_id
+    except Exception:
+        raise ValueError(f"Invalid conversation cursor: {cursor}")
+
+
 def get_conversation_id_by_name(conversation_name, user_id):
     user_id = str(user_id)
     session = get_session()
@@ -158,42 +186,90 @@ class Conversations:
         return agent_id
 
     def get_conversations_with_detail(self):
+        return self.get_conversations_page(limit=None)["conversations"]
+
+    def get_conversations_page(
+        self, limit=100, page=1, cursor=None, conversation_id=None
+    ):
+        """
+        Conversations with messages, most recently updated first, read in one query.
+
+        Pass `cursor`, the `next_cursor` of the previous page, to continue after it,
+        otherwise `page` selects the page. A `limit` of None returns every conversation.
+        `total_items` is only counted when there is a limit.
+        """
         session = get_session()
         user_data = session.query(User).filter(User.email == self.user).first()
         user_id = user_data.id
-
-        # Add notification check to the query
-        conversations = (
+        has_messages = exists().where(Message.conversation_id == Conversation.id)
+        has_notifications = exists().where(
+            Message.conversation_id == Conversation.id, Message.notify == True
+        )
+        query = (
             session.query(
-                Conversation,
-                func.count(Message.id)
-                .filter(Message.notify == True)
-                .label("notification_count"),
+                Conversation.id,
+                Conversation.name,
+                Conversation.summary,
+                Conversation.attachment_count,
+                Conversation.created_at,
+                Conversation.updated_at,
+                Agent.id.label("agent_id"),
+                has_notifications.label("has_notifications"),
             )
-            .outerjoin(Message, Message.conversation_id == Conversation.id)
-            .filter(Conversation.user_id == user_id)
-            .filter(Message.id != None)
-            .group_by(Conversation)
-            .order_by(Conversation.updated_at.desc())
-            .all()
+            .outerjoin(Agent, Agent.id == Conversation.last_agent_id)
+            .filter(Conversation.user_id == user_id, has_messages)
         )
-        # If the agent's company_id does not match
-        result = {
-            str(conversation.id): {
-                "name": conversation.name,
-                "agent_id": self.get_agent_id(user_id),
-                "created_at": convert_time(conversation.created_at, user_id=user_id),
-                "updated_at": convert_time(conversation.updated_at, user_id=user_id),
-                "has_notifications": notification_count > 0,
-                "summary": (
-                    conversation.summary if Conversation.summary else "None available"
-                ),
-                "attachment_count": conversation.attachment_count,
+        if conversation_id:
+            query = query.filter(Conversation.id == conversation_id)
+        total_items = None
+        if limit is not None:
+            total_items = (
+                session.query(func.count(Conversation.id))
+                .filter(Conversation.user_id == user_id, has_messages)
+                .scalar()
+            )
+        if cursor:
+            updated_at, after_id = decode_conversation_cursor(cursor)
+            query = query.filter(
+                or_(
+                    Conversation.updated_at < updated_at,
+                    and_(
+                        Conversation.updated_at == updated_at,
+                        Conversation.id < after_id,
+                    ),
+                )
+            )
+        query = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+        if limit is not None:
+            if not cursor:
+                query = query.offset((max(page, 1) - 1) * limit)
+            # One extra row tells whether there is a next page
+            rows = query.limit(limit + 1).all()
+        else:
+            rows = query.all()
+        session.close()
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_conversation_cursor(rows[-1].updated_at, rows[-1].id)
+        timezone = get_user_timezone(user_id)
+        conversations = {
+            str(row.id): {
+                "name": row.name,
+                "agent_id": str(row.agent_id) if row.agent_id else None,
+                "created_at": convert_time(row.created_at, timezone=timezone),
+                "updated_at": convert_time(row.updated_at, timezone=timezone),
+                "has_notifications": bool(row.has_notifications),
+                "summary": row.summary,
+                "attachment_count": row.attachment_count,
             }
-            for conversation, notification_count in conversations
+            for row in rows
+        }
+        return {
+            "conversations": conversations,
+            "total_items": total_items,
+            "next_cursor": next_cursor,
         }
-        session.close()
-        return result
 
     def get_notifications(self):
         session = get_session()
@@ -209,8 +285,11 @@ class Conversations:
             .all()
         )
 
+        timestamps = convert_times(
+            [message.timestamp for message, _ in notifications], user_id=user_id
+        )
         result = []
-        for message, conversation in notifications:
+        for (message, conversation), timestamp in zip(notifications, timestamps):
             result.append(
                 {
                     "conversation_id": str(conversation.id),
@@ -218,7 +297,7 @@ class Conversations:
                     "message_id": str(message.id),
                     "message": message.content,
                     "role": message.role,
-                    "timestamp": convert_time(message.timestamp, user_id=user_id),
+                    "timestamp": timestamp,
                 }
             )
 
@@ -266,14 +345,15 @@ class Conversations:
         if not messages:
             session.close()
             return {"interactions": []}
+        timezone = get_user_timezone(user_id)
         return_messages = []
         for message in messages:
             msg = {
                 "id": message.id,
                 "role": message.role,
                 "message": message.content,
-                "timestamp": convert_time(message.timestamp, user_id=user_id),
-                "updated_at": convert_time(message.updated_at, user_id=user_id),
+                "timestamp": convert_time(message.timestamp, timezone=timezone),
+                "updated_at": convert_time(message.updated_at, timezone=timezone),
                 "updated_by": message.updated_by,
                 "feedback_received": message.feedback_received,
             }
@@ -335,7 +415,26 @@ class Conversations:
         try:
             # Create a new conversation
             new_conversation_name = f"{self.conversation_name}_fork_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            new_conversation = Conversation(name=new_conversation_name, user_id=user_id)
+            last_agent_name = next(
+                (
+                    message.role
+                    for message in reversed(messages)
+                    if message.role not in ("USER", "user")
+                ),
+                None,
+            )
+            last_agent = (
+                session.query(Agent.id)
+                .filter(Agent.name == last_agent_name, Agent.user_id == user_id)
+                .first()
+                if last_agent_name
+                else None
+            )
+            new_conversation = Conversation(
+                name=new_conversation_name,
+                user_id=user_id,
+                last_agent_id=last_agent.id if last_agent else None,
+            )
             session.add(new_conversation)
             session.flush()  # This will assign an id to new_conversation
 
@@ -359,6 +458,13 @@ class Conversations:
 
             session.commit()
             forked_conversation_id = str(new_conversation.id)
+            publish_conversation_event(
+                user_id,
+                "conversation_created",
+                forked_conversation_id,
+                conversation_name=new_conversation_name,
+                updated_at=new_conversation.updated_at,
+            )
 
             logging.info(
                 f"Conversation forked successfully. New conversation ID: {forked_conversation_id}"
@@ -700,6 +806,16 @@ class Conversations:
             conversation.updated_at = func.now()
 
         session.add(new_message)
+        if role != "USER":
+            agent = (
+                session.query(Agent.id)
+                .filter(Agent.name == role, Agent.user_id == user_id)
+                .first()
+            )
+            if agent:
+                session.query(Conversation).filter(
+                    Conversation.id == conversation.id
+                ).update({"last_agent_id": agent.id}, synchronize_session=False)
         session.commit()
 
         if role.lower() == "user":
@@ -712,6 +828,18 @@ class Conversations:
             else:
                 logging.info(f"{role}: {message}")
         message_id = str(new_message.id)
+        publish_conversation_event(
+            user_id,
+            "message_added",
+            new_message.conversation_id,
+            conversation_name=self.conversation_name,
+            message_id=message_id,
+            role=new_message.role,
+            message=new_message.content,
+            timestamp=new_message.timestamp,
+            updated_at=new_message.updated_at,
+            notify=notify,
+        )
         session.close()
         return message_id
 
@@ -734,13 +862,15 @@ class Conversations:
             session.close()
             return
 
+        conversation_id = conversation.id
         session.query(Message).filter(
-            Message.conversation_id == conversation.id
+            Message.conversation_id == conversation_id
         ).delete()
         session.query(Conversation).filter(
-            Conversation.id == conversation.id, Conversation.user_id == user_id
+            Conversation.id == conversation_id, Conversation.user_id == user_id
         ).delete()
         session.commit()
+        publish_conversation_event(user_id, "conversation_deleted", conversation_id)
         session.close()
 
     def delete_message(self, message):
@@ -784,8 +914,12 @@ class Conversations:
             )
             session.close()
             return
+        conversation_id = conversation.id
         session.delete(message)
         session.commit()
+        publish_conversation_event(
+            user_id, "message_deleted", conversation_id, message_id=str(message_id)
+        )
         session.close()
 
     def get_message_by_id(self, message_id):
@@ -889,8 +1023,12 @@ class Conversations:
             )
             session.close()
             return
+        conversation_id = conversation.id
         session.delete(message)
         session.commit()
+        publish_conversation_event(
+            user_id, "message_deleted", conversation_id, message_id=str(message_id)
+        )
         session.close()
 
     def toggle_feedback_received(self, message):
@@ -1016,7 +1154,16 @@ class Conversations:
             session.close()
             return
         message.content = new_message
+        conversation_id = conversation.id
         session.commit()
+        publish_conversation_event(
+            user_id,
+            "message_updated",
+            conversation_id,
+            message_id=str(message_id),
+            conversation_name=self.conversation_name,
+            message=new_message,
+        )
         session.close()
 
     def update_message_by_id(self, message_id, new_message):
@@ -1054,9 +1201,18 @@ class Conversations:
 
         # Update the message content directly
         message.content = str(new_message)  # Ensure the content is a string
+        conversation_id = conversation.id
 
         try:
             session.commit()
+            publish_conversation_event(
+                user_id,
+                "message_updated",
+                conversation_id,
+                message_id=str(message_id),
+                conversation_name=self.conversation_name,
+                message=str(new_message),
+            )
         except Exception as e:
             logging.error(f"Error updating message: {e}")
             session.rollback()
@@ -1104,7 +1260,11 @@ class Conversations:
             session.add(conversation)
             session.commit()
         conversation.name = new_name
+        conversation_id = conversation.id
         session.commit()
+        publish_conversation_event(
+            user_id, "conversation_renamed", conversation_id, conversation_name=new_name
+        )
         session.close()
         return new_name
 
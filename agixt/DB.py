@@ -1,12 +1,19 @@
+import os
+import sys
+import json
 import uuid
+import hashlib
 import time
 import logging
+import threading
+from collections import OrderedDict
 from sqlalchemy import (
     create_engine,
     Column,
     Text,
     String,
     Integer,
+    BigInteger,
     ForeignKey,
     DateTime,
     Boolean,
@@ -14,6 +21,7 @@ from sqlalchemy import (
     or_,
     func,
     text,
+    inspect,
 )
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy.dialects.postgresql import UUID
@@ -63,6 +71,11 @@ def get_new_id():
     return str(uuid.uuid4())
 
 
+def get_new_uuid():
+    """New primary key value matching the id column type of the configured database"""
+    return get_new_id() if DATABASE_TYPE == "sqlite" else uuid.uuid4()
+
+
 class UserRole(Base):
     __tablename__ = "Role"
     id = Column(Integer, primary_key=True)
@@ -178,6 +191,20 @@ class UserPreferences(Base):
     pref_value = Column(String, nullable=True)
 
 
+class TokenUsage(Base):
+    """Running token totals per user, only ever changed with atomic increments"""
+
+    __tablename__ = "token_usage"
+    user_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        ForeignKey("user.id"),
+        primary_key=True,
+    )
+    input_tokens = Column(BigInteger, nullable=False, default=0)
+    output_tokens = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
 class UserOAuth(Base):
     __tablename__ = "user_oauth"
     id = Column(
@@ -394,6 +421,11 @@ class Conversation(Base):
         ForeignKey("user.id"),
         nullable=True,
     )
+    # Agent of the last message not written by the user, kept up to date by log_interaction
+    last_agent_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        nullable=True,
+    )
     user = relationship("User", backref="conversation")
 
 
@@ -696,6 +728,11 @@ class TaskItem(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     completed_at = Column(DateTime, nullable=True)
     priority = Column(Integer)
+    # Task queue lease, the worker named in lease_owner runs the task until it expires
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
     user = relationship("User", backref="task_item")
 
 
@@ -735,6 +772,10 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
+        # For SQLite, store as a compact float32 blob
+        if DATABASE_TYPE == "sqlite":
+            return encode_vector(value)
+
         # Convert to numpy array and ensure 1D
         if isinstance(value, np.ndarray):
             value = value.reshape(-1).tolist()
@@ -742,10 +783,6 @@ class Vector(TypeDecorator):
             # Handle nested lists
             value = np.array(value).reshape(-1).tolist()
 
-        # For SQLite, store as string representation
-        if DATABASE_TYPE == "sqlite":
-            return f'[{",".join(map(str, value))}]'
-
         # For PostgreSQL, return as list
         return value
 
@@ -754,17 +791,74 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
-        # For SQLite, parse string representation
+        # For SQLite, decode the blob or the legacy string representation
         if DATABASE_TYPE == "sqlite":
-            try:
-                value = eval(value)
-            except:
-                return None
+            return decode_vector(value)
 
         # Convert to 1D numpy array
         return np.array(value).reshape(-1)
 
 
+def encode_vector(value) -> bytes:
+    """Encode a vector as little-endian float32 bytes"""
+    return np.asarray(value, dtype="<f4").reshape(-1).tobytes()
+
+
+def decode_vector(value):
+    """Decode a float32 blob without copying, or parse a legacy '[0.1,0.2,...]' string"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype="<f4")
+    try:
+        return np.array(json.loads(value), dtype=np.float32).reshape(-1)
+    except Exception:
+        return None
+
+
+def migrate_memory_embeddings(batch_size: int = 500):
+    """
+    Convert SQLite memory embeddings stored as strings to float32 blobs.
+
+    Rows are converted in batches with a commit after each one, so this can run while
+    the server is up. Reads handle both formats until it has finished.
+    """
+    if DATABASE_TYPE != "sqlite":
+        logging.info("Memory embedding migration is only needed for SQLite.")
+        return 0
+    converted = 0
+    last_id = ""
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    """
+                    SELECT id, embedding FROM memory
+                    WHERE typeof(embedding) = 'text' AND id > :last_id
+                    ORDER BY id
+                    LIMIT :batch_size
+                    """
+                ),
+                {"last_id": last_id, "batch_size": batch_size},
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for id, embedding in rows:
+                vector = decode_vector(embedding)
+                if vector is None:
+                    logging.warning(f"Skipping unreadable embedding for memory {id}")
+                    continue
+                updates.append({"id": id, "embedding": encode_vector(vector)})
+            if updates:
+                connection.execute(
+                    text("UPDATE memory SET embedding = :embedding WHERE id = :id"),
+                    updates,
+                )
+            converted += len(updates)
+        logging.info(f"Converted {converted} memory embeddings to float32 blobs.")
+    return converted
+
+
 # Update the embedding function to ensure consistent output shape
 def process_embedding_for_storage(embedding):
     """Ensure embedding is in the correct format for storage"""
@@ -778,6 +872,16 @@ def process_embedding_for_storage(embedding):
     return None
 
 
+class CacheInvalidation(Base):
+    """Append-only log of cache keys to drop, read by every worker to keep caches coherent"""
+
+    __tablename__ = "cache_invalidation"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    scope = Column(String, nullable=False)
+    key = Column(Text, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+
 class Memory(Base):
     __tablename__ = "memory"
     id = Column(
@@ -801,6 +905,7 @@ class Memory(Base):
     description = Column(Text)
     timestamp = Column(DateTime, server_default=func.now())
     additional_metadata = Column(Text)
+    content_hash = Column(String(64), nullable=True)
 
     # Relationships
     agent = relationship("Agent", backref="memories")
@@ -824,10 +929,203 @@ def setup_vector_column(target, connection, **kw):
                 """
             )
         )
+        connection.execute(
+            text(
+                """
+                CREATE INDEX IF NOT EXISTS memory_content_hash_idx
+                ON memory (agent_id, conversation_id, content_hash);
+                """
+            )
+        )
     except Exception as e:
         logging.error(f"Error setting up memory indices: {e}")
 
 
+def get_content_hash(content: str) -> str:
+    """SHA-256 of a memory chunk, used to skip chunks that are already stored"""
+    return hashlib.sha256(str(content).encode("utf-8")).hexdigest()
+
+
+def setup_memory_content_hash():
+    """
+    Add the content_hash column and its index to a memory table created before it existed.
+
+    Existing rows keep a null hash until `python DB.py migrate-content-hash` fills it in,
+    until then they are not matched when deduplicating.
+    """
+    try:
+        columns = [column["name"] for column in inspect(engine).get_columns("memory")]
+        with engine.begin() as connection:
+            if "content_hash" not in columns:
+                connection.execute(
+                    text("ALTER TABLE memory ADD COLUMN content_hash VARCHAR(64)")
+                )
+            connection.execute(
+                text(
+                    """
+                    CREATE INDEX IF NOT EXISTS memory_content_hash_idx
+                    ON memory (agent_id, conversation_id, content_hash);
+                    """
+                )
+            )
+    except Exception as e:
+        logging.error(f"Error setting up memory content hashes: {e}")
+
+
+def setup_task_queue():
+    """Add the task queue lease columns and index to a task_item table created before them"""
+    try:
+        columns = [
+            column["name"] for column in inspect(engine).get_columns("task_item")
+        ]
+        missing = {
+            "lease_owner": "VARCHAR",
+            "lease_expires_at": "TIMESTAMP",
+            "attempts": "INTEGER DEFAULT 0",
+            "last_error": "TEXT",
+        }
+        with engine.begin() as connection:
+            for name, column_type in missing.items():
+                if name not in columns:
+                    connection.execute(
+                        text(f"ALTER TABLE task_item ADD COLUMN {name} {column_type}")
+                    )
+            connection.execute(
+                text(
+                    """
+                    CREATE INDEX IF NOT EXISTS task_item_due_idx
+                    ON task_item (completed, scheduled, due_date);
+                    """
+                )
+            )
+    except Exception as e:
+        logging.error(f"Error setting up the task queue: {e}")
+
+
+def setup_conversation_listing():
+    """
+    Add last_agent_id to a conversation table created before it existed, filling it
+    in from each conversation's last agent message, and the indexes the listing uses.
+    """
+    try:
+        columns = [
+            column["name"] for column in inspect(engine).get_columns("conversation")
+        ]
+        with engine.begin() as connection:
+            if "last_agent_id" not in columns:
+                column_type = "UUID" if DATABASE_TYPE != "sqlite" else "VARCHAR"
+                connection.execute(
+                    text(
+                        f"ALTER TABLE conversation ADD COLUMN last_agent_id {column_type}"
+                    )
+                )
+                connection.execute(
+                    text(
+                        """
+                        UPDATE conversation SET last_agent_id = (
+                            SELECT agent.id FROM agent
+                            WHERE agent.user_id = conversation.user_id
+                            AND agent.name = (
+                                SELECT message.role FROM message
+                                WHERE message.conversation_id = conversation.id
+                                AND message.role NOT IN ('USER', 'user')
+                                ORDER BY message.timestamp DESC
+                                LIMIT 1
+                            )
+                            LIMIT 1
+                        )
+                        """
+                    )
+                )
+            connection.execute(
+                text(
+                    """
+                    CREATE INDEX IF NOT EXISTS conversation_user_updated_idx
+                    ON conversation (user_id, updated_at);
+                    """
+                )
+            )
+            connection.execute(
+                text(
+                    """
+                    CREATE INDEX IF NOT EXISTS message_conversation_timestamp_idx
+                    ON message (conversation_id, timestamp);
+                    """
+                )
+            )
+    except Exception as e:
+        logging.error(f"Error setting up conversation listing: {e}")
+
+
+def migrate_memory_content_hash(batch_size: int = 500):
+    """Fill in content_hash for memories stored before it existed, committing each batch"""
+    hashed = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, text FROM memory WHERE content_hash IS NULL LIMIT :batch_size"
+                ),
+                {"batch_size": batch_size},
+            ).all()
+            if not rows:
+                break
+            connection.execute(
+                text("UPDATE memory SET content_hash = :content_hash WHERE id = :id"),
+                [
+                    {"id": id, "content_hash": get_content_hash(content)}
+                    for id, content in rows
+                ],
+            )
+            hashed += len(rows)
+        logging.info(f"Hashed {hashed} memories.")
+    return hashed
+
+
+def get_stored_content_sources(
+    session, agent_id, conversation_id, content_hashes, batch_size: int = 500
+) -> dict:
+    """Map the given content hashes already stored for the agent and collection to the sources storing them"""
+    stored = {}
+    content_hashes = list(set(content_hashes))
+    for i in range(0, len(content_hashes), batch_size):
+        rows = (
+            session.query(Memory.content_hash, Memory.external_source)
+            .filter(
+                Memory.agent_id == agent_id,
+                Memory.conversation_id == conversation_id,
+                Memory.content_hash.in_(content_hashes[i : i + batch_size]),
+            )
+            .distinct()
+            .all()
+        )
+        for content_hash, external_source in rows:
+            stored.setdefault(content_hash, set()).add(external_source)
+    return stored
+
+
+def get_stored_embeddings(
+    session, agent_id, conversation_id, content_hashes, batch_size: int = 500
+) -> dict:
+    """Stored embeddings of the given content hashes for the agent and collection, by hash"""
+    embeddings = {}
+    content_hashes = list(set(content_hashes))
+    for i in range(0, len(content_hashes), batch_size):
+        rows = (
+            session.query(Memory.content_hash, Memory.embedding)
+            .filter(
+                Memory.agent_id == agent_id,
+                Memory.conversation_id == conversation_id,
+                Memory.content_hash.in_(content_hashes[i : i + batch_size]),
+                Memory.embedding != None,
+            )
+            .all()
+        )
+        for content_hash, embedding in rows:
+            embeddings.setdefault(content_hash, embedding)
+    return embeddings
+
+
 def calculate_vector_similarity(query_embedding, stored_embedding):
     """Calculate cosine similarity between two vectors"""
     if query_embedding is None or stored_embedding is None:
@@ -866,45 +1164,608 @@ def calculate_vector_similarity(query_embedding, stored_embedding):
         return 0.0
 
 
-# Update the memory search query for both databases:
-def get_similar_memories(
+EMBEDDING_DIMENSION = 384
+
+
+def scan_similar_memories(
     session, query_embedding, agent_id, conversation_id, limit, min_score
 ):
     """Get similar memories using basic SQL and Python-based similarity calculation"""
-    try:
-        # Get all potentially relevant memories
-        memories = (
-            session.query(Memory)
+    # Get all potentially relevant memories
+    memories = (
+        session.query(Memory)
+        .filter(
+            Memory.agent_id == agent_id,
+            or_(
+                Memory.conversation_id == conversation_id,
+                Memory.conversation_id == None,
+            ),
+        )
+        .all()
+    )
+
+    # Calculate similarities
+    memory_scores = [
+        (mem, calculate_vector_similarity(query_embedding, mem.embedding))
+        for mem in memories
+    ]
+
+    # Filter by minimum score and sort by similarity
+    filtered_memories = [
+        (mem, score) for mem, score in memory_scores if score >= min_score
+    ]
+    filtered_memories.sort(key=lambda x: x[1], reverse=True)
+
+    # Return top N results
+    return filtered_memories[:limit]
+
+
+def top_k_scores(ids, scores, limit):
+    """Pick the best `limit` scores with argpartition instead of a full sort"""
+    if len(scores) == 0 or limit <= 0:
+        return []
+    if limit < len(scores):
+        winners = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        winners = np.arange(len(scores))
+    winners = winners[np.argsort(-scores[winners], kind="stable")]
+    return [(ids[i], float(scores[i])) for i in winners]
+
+
+def normalize_embedding_rows(rows):
+    """Stack (id, embedding) rows into an id array and a normalized float32 matrix"""
+    matrix = np.zeros((len(rows), EMBEDDING_DIMENSION), dtype=np.float32)
+    for row, (_, embedding) in enumerate(rows):
+        # Unusable vectors stay as zero rows and score 0.0, like calculate_vector_similarity
+        if embedding is None:
+            continue
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(embedding)
+        if embedding.shape[0] == EMBEDDING_DIMENSION and norm != 0:
+            matrix[row] = embedding / norm
+    return np.array([str(id) for id, _ in rows], dtype=str), matrix
+
+
+def load_scored_memories(session, scored_ids, min_score):
+    """Hydrate only the winning Memory rows, keeping the index's ranking"""
+    scored_ids = [(id, score) for id, score in scored_ids if score >= min_score]
+    if not scored_ids:
+        return []
+    ids = [
+        str(id) if DATABASE_TYPE == "sqlite" else uuid.UUID(str(id))
+        for id, _ in scored_ids
+    ]
+    memories = session.query(Memory).filter(Memory.id.in_(ids)).all()
+    memories_by_id = {str(mem.id): mem for mem in memories}
+    return [
+        (memories_by_id[str(id)], score)
+        for id, score in scored_ids
+        if str(id) in memories_by_id
+    ]
+
+
+class MemoryIndex:
+    """
+    Base class for memory search backends.
+
+    The add and remove hooks are called by Memories after it writes or deletes rows so
+    backends holding embeddings in memory can patch themselves instead of reloading.
+    """
+
+    def search(
+        self, session, query_embedding, agent_id, conversation_id, limit, min_score
+    ):
+        raise NotImplementedError
+
+    def search_many(self, session, query_embedding, scopes, min_score):
+        """
+        Search several (agent_id, conversation_id, limit) scopes with one query vector,
+        returns a result list per scope in the same order.
+        """
+        return [
+            self.search(
+                session, query_embedding, agent_id, conversation_id, limit, min_score
+            )
+            for agent_id, conversation_id, limit in scopes
+        ]
+
+    def add(self, agent_id, conversation_id, ids, embeddings):
+        pass
+
+    def remove(self, agent_id, ids=None, conversation_id=None):
+        pass
+
+
+class ScanMemoryIndex(MemoryIndex):
+    def search(
+        self, session, query_embedding, agent_id, conversation_id, limit, min_score
+    ):
+        return scan_similar_memories(
+            session, query_embedding, agent_id, conversation_id, limit, min_score
+        )
+
+
+class PGVectorMemoryIndex(MemoryIndex):
+    """
+    Server-side nearest neighbour search with pgvector.
+
+    The embedding column stays a float array, the index is built on its cast to vector
+    so existing rows are covered without a migration.
+    """
+
+    def __init__(self, method: str = "hnsw"):
+        self.method = method if method in ["hnsw", "ivfflat"] else "hnsw"
+        self.vector_expression = f"(embedding::vector({EMBEDDING_DIMENSION}))"
+        self.iterative_scan = False
+
+    def setup(self, connection=None):
+        """Create the pgvector extension and ANN index, returns False if unavailable"""
+        close_connection = connection is None
+        if connection is None:
+            connection = engine.connect()
+        try:
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            if self.method == "ivfflat":
+                index_sql = f"""
+                    CREATE INDEX IF NOT EXISTS memory_embedding_ivfflat_idx
+                    ON memory USING ivfflat ({self.vector_expression} vector_cosine_ops)
+                    WITH (lists = {int(getenv("MEMORY_INDEX_IVFFLAT_LISTS"))});
+                    """
+            else:
+                index_sql = f"""
+                    CREATE INDEX IF NOT EXISTS memory_embedding_hnsw_idx
+                    ON memory USING hnsw ({self.vector_expression} vector_cosine_ops);
+                    """
+            connection.execute(text(index_sql))
+            version = connection.execute(
+                text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            ).scalar()
+            major, minor = [int(part) for part in str(version).split(".")[:2]]
+            # Iterative index scans keep filtered HNSW searches from returning < k rows
+            self.iterative_scan = (major, minor) >= (0, 8)
+            connection.commit()
+            return True
+        except Exception as e:
+            connection.rollback()
+            logging.warning(f"pgvector memory index unavailable: {e}")
+            return False
+        finally:
+            if close_connection:
+                connection.close()
+
+    def search(
+        self, session, query_embedding, agent_id, conversation_id, limit, min_score
+    ):
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        if self.method == "hnsw" and self.iterative_scan:
+            session.execute(text("SET LOCAL hnsw.iterative_scan = relaxed_order"))
+        rows = session.execute(
+            text(
+                f"""
+                SELECT id, {self.vector_expression} <=> CAST(:query AS vector) AS distance
+                FROM memory
+                WHERE agent_id = :agent_id
+                AND (conversation_id = :conversation_id OR conversation_id IS NULL)
+                ORDER BY distance
+                LIMIT :limit
+                """
+            ),
+            {
+                "query": f'[{",".join(map(str, query_vector.tolist()))}]',
+                "agent_id": str(agent_id),
+                "conversation_id": (
+                    str(conversation_id) if conversation_id is not None else None
+                ),
+                "limit": int(limit),
+            },
+        ).all()
+        scored_ids = [
+            (id, 1.0 - float(distance)) for id, distance in rows if distance is not None
+        ]
+        scored_ids.sort(key=lambda x: x[1], reverse=True)
+        return load_scored_memories(session, scored_ids, min_score)
+
+    def search_many(self, session, query_embedding, scopes, min_score):
+        """Search every scope in one UNION ALL query and load the winning rows at once"""
+        if not scopes:
+            return []
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        if self.method == "hnsw" and self.iterative_scan:
+            session.execute(text("SET LOCAL hnsw.iterative_scan = relaxed_order"))
+        parameters = {"query": f'[{",".join(map(str, query_vector.tolist()))}]'}
+        selects = []
+        for scope, (agent_id, conversation_id, limit) in enumerate(scopes):
+            selects.append(
+                f"""
+                (SELECT {scope} AS scope, id,
+                {self.vector_expression} <=> CAST(:query AS vector) AS distance
+                FROM memory
+                WHERE agent_id = :agent_id_{scope}
+                AND (conversation_id = :conversation_id_{scope} OR conversation_id IS NULL)
+                ORDER BY distance
+                LIMIT :limit_{scope})
+                """
+            )
+            parameters[f"agent_id_{scope}"] = str(agent_id)
+            parameters[f"conversation_id_{scope}"] = (
+                str(conversation_id) if conversation_id is not None else None
+            )
+            parameters[f"limit_{scope}"] = int(limit)
+        rows = session.execute(text(" UNION ALL ".join(selects)), parameters).all()
+        scored_ids = [[] for _ in scopes]
+        for scope, id, distance in rows:
+            if distance is not None:
+                scored_ids[scope].append((id, 1.0 - float(distance)))
+        memories = load_scored_memories(
+            session,
+            list(
+                {
+                    str(id): (id, score) for ids in scored_ids for id, score in ids
+                }.values()
+            ),
+            min_score,
+        )
+        memories_by_id = {str(memory.id): memory for memory, _ in memories}
+        results = []
+        for ids in scored_ids:
+            ids.sort(key=lambda x: x[1], reverse=True)
+            results.append(
+                [
+                    (memories_by_id[str(id)], score)
+                    for id, score in ids
+                    if score >= min_score and str(id) in memories_by_id
+                ]
+            )
+        return results
+
+
+class FlatFileMemoryIndex(MemoryIndex):
+    """
+    Per-agent flat index of normalized float32 embeddings persisted as one file per agent.
+
+    Each search reconciles the index with the memory ids in the database, so only rows
+    inserted since the last search are parsed and deleted rows are dropped.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.indexes = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get_path(self, agent_id):
+        return os.path.join(self.directory, f"{agent_id}.npz")
+
+    def get_lock(self, agent_id):
+        with self.lock:
+            if agent_id not in self.locks:
+                self.locks[agent_id] = threading.Lock()
+            return self.locks[agent_id]
+
+    def load(self, agent_id):
+        index = self.indexes.get(agent_id)
+        path = self.get_path(agent_id)
+        if not os.path.exists(path):
+            return index
+        mtime = os.path.getmtime(path)
+        if index is not None and index["mtime"] >= mtime:
+            return index
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                index = {
+                    "ids": data["ids"].astype(str),
+                    "conversation_ids": data["conversation_ids"].astype(str),
+                    "matrix": data["matrix"].astype(np.float32),
+                    "mtime": mtime,
+                }
+        except Exception as e:
+            logging.warning(f"Rebuilding unreadable memory index {path}: {e}")
+            return None
+        self.indexes[agent_id] = index
+        return index
+
+    def save(self, agent_id, index):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(agent_id)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(
+            temp_path,
+            ids=index["ids"],
+            conversation_ids=index["conversation_ids"],
+            matrix=index["matrix"],
+        )
+        os.replace(temp_path, path)
+        index["mtime"] = os.path.getmtime(path)
+
+    def sync(self, session, agent_id):
+        index = self.load(agent_id)
+        if index is None:
+            index = {
+                "ids": np.array([], dtype=str),
+                "conversation_ids": np.array([], dtype=str),
+                "matrix": np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32),
+                "mtime": 0,
+            }
+        rows = (
+            session.query(Memory.id, Memory.conversation_id)
+            .filter(Memory.agent_id == agent_id)
+            .all()
+        )
+        current = {str(id): str(conversation_id or "") for id, conversation_id in rows}
+        keep = np.array([id in current for id in index["ids"]], dtype=bool)
+        known = set(index["ids"][keep].tolist())
+        new_ids = [id for id in current if id not in known]
+        if keep.all() and not new_ids:
+            self.indexes[agent_id] = index
+            return index
+        ids = [index["ids"][keep]]
+        conversation_ids = [index["conversation_ids"][keep]]
+        matrices = [index["matrix"][keep]]
+        for i in range(0, len(new_ids), 500):
+            batch = new_ids[i : i + 500]
+            new_rows = (
+                session.query(Memory.id, Memory.embedding)
+                .filter(Memory.id.in_(batch))
+                .all()
+            )
+            batch_ids, matrix = normalize_embedding_rows(new_rows)
+            ids.append(batch_ids)
+            conversation_ids.append(
+                np.array([current[str(id)] for id, _ in new_rows], dtype=str)
+            )
+            matrices.append(matrix)
+        index = {
+            "ids": np.concatenate(ids).astype(str),
+            "conversation_ids": np.concatenate(conversation_ids).astype(str),
+            "matrix": np.ascontiguousarray(np.concatenate(matrices)),
+            "mtime": 0,
+        }
+        try:
+            self.save(agent_id, index)
+        except Exception as e:
+            logging.warning(f"Unable to persist memory index for agent {agent_id}: {e}")
+        self.indexes[agent_id] = index
+        return index
+
+    def search(
+        self, session, query_embedding, agent_id, conversation_id, limit, min_score
+    ):
+        agent_id = str(agent_id)
+        with self.get_lock(agent_id):
+            index = self.sync(session, agent_id)
+        if len(index["ids"]) == 0:
+            return []
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query_norm = np.linalg.norm(query_vector)
+        if query_vector.shape[0] != EMBEDDING_DIMENSION or query_norm == 0:
+            return []
+        mask = index["conversation_ids"] == ""
+        if conversation_id is not None:
+            mask |= index["conversation_ids"] == str(conversation_id)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return []
+        scores = index["matrix"][candidates] @ (query_vector / query_norm)
+        scored_ids = top_k_scores(index["ids"][candidates], scores, limit)
+        return load_scored_memories(session, scored_ids, min_score)
+
+
+class MatrixMemoryIndex(MemoryIndex):
+    """
+    In-memory cache of normalized float32 embedding matrices per (agent_id, conversation_id).
+
+    Used when no ANN extension is available. Core memories (conversation_id None) and
+    each conversation's memories are cached separately and scored together. Entries are
+    evicted least recently used first once MEMORY_MATRIX_CACHE_MB is exceeded, and are
+    reloaded when their row count no longer matches the database or after
+    MEMORY_MATRIX_CACHE_TTL seconds, which covers writes made by other workers.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get_key(self, agent_id, conversation_id):
+        return (str(agent_id), str(conversation_id) if conversation_id else None)
+
+    def count_rows(self, session, agent_id, conversation_id):
+        return (
+            session.query(func.count(Memory.id))
             .filter(
                 Memory.agent_id == agent_id,
-                or_(
-                    Memory.conversation_id == conversation_id,
-                    Memory.conversation_id == None,
-                ),
+                Memory.conversation_id == conversation_id,
+            )
+            .scalar()
+        )
+
+    def store(self, key, entry):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous["matrix"].nbytes
+            self.entries[key] = entry
+            self.size += entry["matrix"].nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted["matrix"].nbytes
+
+    def get_entry(self, session, agent_id, conversation_id):
+        key = self.get_key(agent_id, conversation_id)
+        count = self.count_rows(session, agent_id, conversation_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                entry is not None
+                and len(entry["ids"]) == count
+                and time.time() - entry["loaded_at"] < self.ttl
+            ):
+                self.entries.move_to_end(key)
+                return entry
+        rows = (
+            session.query(Memory.id, Memory.embedding)
+            .filter(
+                Memory.agent_id == agent_id,
+                Memory.conversation_id == conversation_id,
             )
             .all()
         )
+        ids, matrix = normalize_embedding_rows(rows)
+        entry = {"ids": ids, "matrix": matrix, "loaded_at": time.time()}
+        self.store(key, entry)
+        return entry
+
+    def search(
+        self, session, query_embedding, agent_id, conversation_id, limit, min_score
+    ):
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query_norm = np.linalg.norm(query_vector)
+        if query_vector.shape[0] != EMBEDDING_DIMENSION or query_norm == 0:
+            return []
+        query_vector = query_vector / query_norm
+        scopes = [None] if conversation_id is None else [None, conversation_id]
+        ids = []
+        scores = []
+        for scope in scopes:
+            entry = self.get_entry(session, agent_id, scope)
+            ids.append(entry["ids"])
+            scores.append(entry["matrix"] @ query_vector)
+        scored_ids = top_k_scores(np.concatenate(ids), np.concatenate(scores), limit)
+        return load_scored_memories(session, scored_ids, min_score)
+
+    def add(self, agent_id, conversation_id, ids, embeddings):
+        key = self.get_key(agent_id, conversation_id)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or not ids:
+            return
+        new_ids, matrix = normalize_embedding_rows(list(zip(ids, embeddings)))
+        self.store(
+            key,
+            {
+                "ids": np.concatenate([entry["ids"], new_ids]),
+                "matrix": np.ascontiguousarray(
+                    np.concatenate([entry["matrix"], matrix])
+                ),
+                "loaded_at": entry["loaded_at"],
+            },
+        )
 
-        # Calculate similarities
-        memory_scores = [
-            (mem, calculate_vector_similarity(query_embedding, mem.embedding))
-            for mem in memories
-        ]
+    def remove(self, agent_id, ids=None, conversation_id=None):
+        agent_id = str(agent_id)
+        with self.lock:
+            keys = [
+                key
+                for key in self.entries
+                if key[0] == agent_id
+                and (conversation_id is None or key[1] == str(conversation_id))
+            ]
+        for key in keys:
+            if ids is None:
+                with self.lock:
+                    entry = self.entries.pop(key, None)
+                    if entry is not None:
+                        self.size -= entry["matrix"].nbytes
+                continue
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is None:
+                continue
+            keep = ~np.isin(entry["ids"], [str(id) for id in ids])
+            if keep.all():
+                continue
+            self.store(
+                key,
+                {
+                    "ids": entry["ids"][keep],
+                    "matrix": np.ascontiguousarray(entry["matrix"][keep]),
+                    "loaded_at": entry["loaded_at"],
+                },
+            )
 
-        # Filter by minimum score and sort by similarity
-        filtered_memories = [
-            (mem, score) for mem, score in memory_scores if score >= min_score
-        ]
-        filtered_memories.sort(key=lambda x: x[1], reverse=True)
 
-        # Return top N results
-        return filtered_memories[:limit]
+memory_index = None
 
+
+def get_memory_index() -> MemoryIndex:
+    """
+    Select the memory search backend with MEMORY_INDEX (auto, pgvector, flat, matrix or scan).
+    """
+    global memory_index
+    if memory_index is not None:
+        return memory_index
+    backend = str(getenv("MEMORY_INDEX")).lower()
+    if backend == "auto":
+        backend = "flat" if DATABASE_TYPE == "sqlite" else "pgvector"
+    if backend == "pgvector" and DATABASE_TYPE != "sqlite":
+        index = PGVectorMemoryIndex(method=str(getenv("MEMORY_INDEX_METHOD")).lower())
+        if index.setup():
+            memory_index = index
+        else:
+            backend = "matrix"
+    if backend == "flat":
+        memory_index = FlatFileMemoryIndex(
+            directory=os.path.join(os.getcwd(), "memories")
+        )
+    elif backend == "matrix":
+        memory_index = MatrixMemoryIndex(
+            max_bytes=int(getenv("MEMORY_MATRIX_CACHE_MB")) * 1024 * 1024,
+            ttl=float(getenv("MEMORY_MATRIX_CACHE_TTL")),
+        )
+    elif memory_index is None:
+        memory_index = ScanMemoryIndex()
+    return memory_index
+
+
+# Update the memory search query for both databases:
+def get_similar_memories(
+    session, query_embedding, agent_id, conversation_id, limit, min_score
+):
+    """Get similar memories from the configured vector index"""
+    index = get_memory_index()
+    if not isinstance(index, ScanMemoryIndex):
+        try:
+            return index.search(
+                session, query_embedding, agent_id, conversation_id, limit, min_score
+            )
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error in indexed memory search, falling back to scan: {e}")
+    try:
+        return scan_similar_memories(
+            session, query_embedding, agent_id, conversation_id, limit, min_score
+        )
     except Exception as e:
         logging.error(f"Error in memory search: {e}")
         return []
 
 
+def get_similar_memories_many(session, query_embedding, scopes, min_score):
+    """
+    Get similar memories for several (agent_id, conversation_id, limit) scopes with one
+    query vector, one result list per scope
+    """
+    index = get_memory_index()
+    if not isinstance(index, ScanMemoryIndex):
+        try:
+            return index.search_many(session, query_embedding, scopes, min_score)
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error in indexed memory search, falling back to scan: {e}")
+    try:
+        return [
+            scan_similar_memories(
+                session, query_embedding, agent_id, conversation_id, limit, min_score
+            )
+            for agent_id, conversation_id, limit in scopes
+        ]
+    except Exception as e:
+        logging.error(f"Error in memory search: {e}")
+        return [[] for _ in scopes]
+
+
 def setup_default_roles():
     with get_session() as db:
         default_roles = [
@@ -934,7 +1795,19 @@ if __name__ == "__main__":
                 logging.error(f"Error connecting to database: {e}")
                 time.sleep(5)
     Base.metadata.create_all(engine)
+    setup_memory_content_hash()
+    setup_task_queue()
+    setup_conversation_listing()
+    if sys.argv[1:2] == ["migrate-embeddings"]:
+        # python DB.py migrate-embeddings
+        migrate_memory_embeddings()
+        sys.exit(0)
+    if sys.argv[1:2] == ["migrate-content-hash"]:
+        # python DB.py migrate-content-hash
+        migrate_memory_content_hash()
+        sys.exit(0)
     setup_default_roles()
+    get_memory_index()
     seed_data = str(getenv("SEED_DATA")).lower() == "true"
     if seed_data:
         # Import seed data
@@ -0,0 +1,387 @@
+import os
+import time
+import hashlib
+import asyncio
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from typing import List, cast, Union, Sequence
+from onnxruntime import InferenceSession, SessionOptions
+from tokenizers import Tokenizer
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+# Borrowed ONNX MiniLM embedder from ChromaDB <3 https://github.com/chroma-core/chroma
+# The tokenizer and inference session are loaded once per worker and shared by
+# the memory layer and the default provider.
+class EmbeddingEngine:
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(
+        self,
+        model_directory: str = None,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        quantized: bool = False,
+        max_length: int = 256,
+        batch_size: int = 32,
+    ):
+        if not model_directory:
+            model_directory = os.path.join(os.getcwd(), "onnx")
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(
+            os.path.join(model_directory, "tokenizer.json")
+        )
+        self.tokenizer.enable_truncation(max_length=max_length)
+        # Padding is done per batch to the longest sequence in it, see embed()
+        self.tokenizer.no_padding()
+        model_path = os.path.join(model_directory, "model.onnx")
+        if quantized:
+            quantized_path = os.path.join(model_directory, "model_quantized.onnx")
+            if os.path.exists(quantized_path):
+                model_path = quantized_path
+            else:
+                logging.warning(
+                    f"Quantized embedding model not found at {quantized_path}, using {model_path}"
+                )
+        options = SessionOptions()
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+        self.model_path = model_path
+        self.model = InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    @classmethod
+    def get_instance(cls) -> "EmbeddingEngine":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(
+                        model_directory=getenv("EMBEDDING_MODEL_DIRECTORY"),
+                        intra_op_threads=int(getenv("EMBEDDING_INTRA_OP_THREADS")),
+                        inter_op_threads=int(getenv("EMBEDDING_INTER_OP_THREADS")),
+                        quantized=str(getenv("EMBEDDING_QUANTIZED")).lower() == "true",
+                    )
+                    logging.info(
+                        f"Loaded embedding model from {cls._instance.model_path}"
+                    )
+        return cls._instance
+
+    def embed(self, input: List[str]) -> np.ndarray:
+        if not input:
+            return np.zeros((0, 0), dtype=np.float32)
+        encoded = self.tokenizer.encode_batch(input)
+        lengths = np.array([len(e.ids) for e in encoded])
+        # Sort by length so each batch only pads up to similar sized inputs
+        order = np.argsort(lengths, kind="stable")
+        all_embeddings = [None] * len(input)
+        for i in range(0, len(order), self.batch_size):
+            batch = order[i : i + self.batch_size]
+            longest = max(int(lengths[batch].max()), 1)
+            input_ids = np.zeros((len(batch), longest), dtype=np.int64)
+            attention_mask = np.zeros((len(batch), longest), dtype=np.int64)
+            for row, index in enumerate(batch):
+                length = lengths[index]
+                input_ids[row, :length] = encoded[index].ids
+                attention_mask[row, :length] = encoded[index].attention_mask
+            onnx_input = {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            }
+            model_output = self.model.run(None, onnx_input)
+            last_hidden_state = model_output[0]
+            input_mask_expanded = np.broadcast_to(
+                np.expand_dims(attention_mask, -1), last_hidden_state.shape
+            )
+            embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
+                input_mask_expanded.sum(1), a_min=1e-9, a_max=None
+            )
+            norm = np.linalg.norm(embeddings, axis=1)
+            norm[norm == 0] = 1e-12
+            embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
+            for row, index in enumerate(batch):
+                all_embeddings[index] = embeddings[row]
+        return np.stack(all_embeddings)
+
+
+class EmbeddingMetrics:
+    """
+    Throughput counters for the embedding queue, shared by every event loop in the worker.
+    """
+
+    BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.texts = 0
+            self.batches = 0
+            self.batch_size_histogram = {
+                str(bucket): 0 for bucket in self.BATCH_SIZE_BUCKETS
+            }
+            self.batch_size_histogram["+Inf"] = 0
+            self.queue_wait_seconds_total = 0.0
+            self.queue_wait_seconds_max = 0.0
+            self.inference_seconds_total = 0.0
+
+    def record_batch(self, requests: int, texts: int, waits: list, inference: float):
+        with self.lock:
+            self.requests += requests
+            self.texts += texts
+            self.batches += 1
+            bucket = next(
+                (str(b) for b in self.BATCH_SIZE_BUCKETS if texts <= b), "+Inf"
+            )
+            self.batch_size_histogram[bucket] += 1
+            self.queue_wait_seconds_total += sum(waits)
+            self.queue_wait_seconds_max = max([self.queue_wait_seconds_max] + waits)
+            self.inference_seconds_total += inference
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "texts": self.texts,
+                "batches": self.batches,
+                "average_batch_size": (
+                    self.texts / self.batches if self.batches else 0.0
+                ),
+                "batch_size_histogram": dict(self.batch_size_histogram),
+                "average_queue_wait_ms": (
+                    self.queue_wait_seconds_total / self.requests * 1000
+                    if self.requests
+                    else 0.0
+                ),
+                "max_queue_wait_ms": self.queue_wait_seconds_max * 1000,
+                "average_inference_ms": (
+                    self.inference_seconds_total / self.batches * 1000
+                    if self.batches
+                    else 0.0
+                ),
+            }
+
+
+embedding_metrics = EmbeddingMetrics()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of embeddings keyed by the SHA-256 of the text, so identical chunks are
+    only run through the model once per worker.
+    """
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> List[np.ndarray]:
+        with self.lock:
+            embeddings = []
+            for key in keys:
+                embedding = self.entries.get(key)
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                embeddings.append(embedding)
+            return embeddings
+
+    def set_many(self, keys: List[str], embeddings: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                # Copy the row so the cache does not keep the whole batch array alive
+                self.entries[key] = np.array(embedding, dtype=np.float32)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache(max_entries=int(getenv("EMBEDDING_CACHE_SIZE")))
+
+
+def split_cached(input: List[str]):
+    """
+    Look up each text in the embedding cache.
+
+    Returns the cache keys, the embeddings found (None where missing) and the distinct
+    texts that still have to be embedded.
+    """
+    keys = [EmbeddingCache.get_key(text) for text in input]
+    embeddings = embedding_cache.get_many(keys)
+    missing = {}
+    for key, text, embedding in zip(keys, input, embeddings):
+        if embedding is None and key not in missing:
+            missing[key] = text
+    return keys, embeddings, missing
+
+
+def merge_cached(keys, embeddings, missing, new_embeddings) -> np.ndarray:
+    """Fill the cache misses with freshly computed embeddings and cache them"""
+    if missing:
+        embedding_cache.set_many(list(missing.keys()), new_embeddings)
+        computed = dict(zip(missing.keys(), new_embeddings))
+        embeddings = [
+            computed[key] if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
+    return np.stack(embeddings)
+
+
+class EmbeddingQueue:
+    """
+    Coalesces embed requests from concurrent coroutines into a single ONNX batch.
+
+    The first pending request opens a window of `max_wait_ms`, everything queued before
+    the window closes (or until `max_batch_size` texts are pending) is embedded together
+    in the default executor and the results are handed back to each caller.
+    """
+
+    def __init__(self, max_batch_size: int = 64, max_wait_ms: float = 5):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = asyncio.Queue()
+        self.worker = None
+
+    async def embed(self, input: List[str]) -> np.ndarray:
+        if not input:
+            return np.zeros((0, 0), dtype=np.float32)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((list(input), future, time.monotonic()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            count = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.pending.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                count += len(item[0])
+            texts = [text for item in batch for text in item[0]]
+            started = time.monotonic()
+            waits = [started - item[2] for item in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    None, lambda: get_embedding_engine().embed(texts)
+                )
+            except Exception as e:
+                logging.error(f"Error embedding batch of {len(texts)} texts: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            embedding_metrics.record_batch(
+                requests=len(batch),
+                texts=len(texts),
+                waits=waits,
+                inference=time.monotonic() - started,
+            )
+            offset = 0
+            for item_texts, future, _ in batch:
+                if not future.done():
+                    future.set_result(embeddings[offset : offset + len(item_texts)])
+                offset += len(item_texts)
+
+
+# One queue per event loop, asyncio primitives cannot be shared between loops.
+_embedding_queues = weakref.WeakKeyDictionary()
+
+
+def get_embedding_queue() -> EmbeddingQueue:
+    loop = asyncio.get_running_loop()
+    queue = _embedding_queues.get(loop)
+    if queue is None:
+        queue = EmbeddingQueue(
+            max_batch_size=int(getenv("EMBEDDING_MAX_BATCH_SIZE")),
+            max_wait_ms=float(getenv("EMBEDDING_BATCH_WAIT_MS")),
+        )
+        _embedding_queues[loop] = queue
+    return queue
+
+
+def get_embedding_metrics() -> dict:
+    metrics = embedding_metrics.to_dict()
+    metrics["cache"] = embedding_cache.to_dict()
+    return metrics
+
+
+def get_embedding_engine() -> EmbeddingEngine:
+    return EmbeddingEngine.get_instance()
+
+
+def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+    if isinstance(input, str):
+        input = [input]
+    if not input:
+        return []
+    keys, embeddings, missing = split_cached(input)
+    new_embeddings = (
+        get_embedding_engine().embed(list(missing.values())) if missing else None
+    )
+    return cast(
+        List[Union[Sequence[float], Sequence[int]]],
+        merge_cached(keys, embeddings, missing, new_embeddings),
+    ).tolist()
+
+
+async def embed_async(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+    if isinstance(input, str):
+        input = [input]
+    if not input:
+        return []
+    keys, embeddings, missing = split_cached(input)
+    new_embeddings = (
+        await get_embedding_queue().embed(list(missing.values())) if missing else None
+    )
+    return cast(
+        List[Union[Sequence[float], Sequence[int]]],
+        merge_cached(keys, embeddings, missing, new_embeddings),
+    ).tolist()
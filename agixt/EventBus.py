@@ -0,0 +1,273 @@
+import os
+import glob
+import json
+import time
+import atexit
+import select
+import socket
+import asyncio
+import logging
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from sqlalchemy import text
+from DB import engine, DATABASE_TYPE
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class MemoryBackend:
+    """Delivers events to the subscribers in this process only"""
+
+    max_payload = 1024 * 1024
+
+    def start(self, deliver, resync):
+        self.deliver = deliver
+
+    def send(self, payload: str):
+        self.deliver(payload)
+
+
+class SocketBackend:
+    """
+    Fans events out to the workers on this host through Unix datagram sockets.
+
+    Every worker with subscribers binds a socket in `directory`, publishing sends the
+    event to each socket found there. Sockets of workers that exited are removed by
+    the first publisher that fails to reach them.
+    """
+
+    max_payload = 200 * 1024
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = None
+        self.sender = None
+        self.lock = threading.Lock()
+
+    def start(self, deliver, resync):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.path)
+        atexit.register(self.stop)
+
+        def receive():
+            while True:
+                try:
+                    deliver(receiver.recv(self.max_payload).decode("utf-8"))
+                except Exception as e:
+                    logging.error(f"Error receiving event: {e}")
+
+        threading.Thread(target=receive, daemon=True, name="event-bus").start()
+
+    def stop(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def send(self, payload: str):
+        data = payload.encode("utf-8")
+        with self.lock:
+            if self.sender is None:
+                self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            for path in glob.glob(os.path.join(self.directory, "*.sock")):
+                try:
+                    self.sender.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if path != self.path:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                except OSError as e:
+                    logging.error(f"Error sending event to {path}: {e}")
+
+
+class PostgresBackend:
+    """
+    Fans events out to every worker with Postgres LISTEN/NOTIFY.
+
+    A dedicated connection outside the pool listens on `channel` in a background
+    thread. After it reconnects, subscribers are asked to resync since notifications
+    sent in between were missed.
+    """
+
+    # Postgres rejects NOTIFY payloads of 8000 bytes or more
+    max_payload = 7900
+
+    def __init__(self, channel: str = "agixt_events"):
+        self.channel = channel
+
+    def start(self, deliver, resync):
+        def listen():
+            reconnecting = False
+            while True:
+                connection = None
+                try:
+                    connection = engine.raw_connection()
+                    connection.detach()
+                    listener = connection.driver_connection
+                    listener.autocommit = True
+                    listener.cursor().execute(f"LISTEN {self.channel}")
+                    if reconnecting:
+                        resync()
+                    reconnecting = True
+                    while True:
+                        if select.select([listener], [], [], 5) == ([], [], []):
+                            continue
+                        listener.poll()
+                        while listener.notifies:
+                            deliver(listener.notifies.pop(0).payload)
+                except Exception as e:
+                    logging.error(f"Error listening for events: {e}")
+                    time.sleep(5)
+                finally:
+                    if connection is not None:
+                        try:
+                            connection.close()
+                        except Exception:
+                            pass
+
+        threading.Thread(target=listen, daemon=True, name="event-bus").start()
+
+    def send(self, payload: str):
+        with engine.begin() as connection:
+            connection.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": self.channel, "payload": payload},
+            )
+
+
+class EventSubscription:
+    """Events for one subscriber, queued on the event loop it subscribed from"""
+
+    def __init__(self, loop, max_events: int = 1000):
+        self.loop = loop
+        self.queue = asyncio.Queue(max_events)
+        # Set when events were dropped, the subscriber has to reload its state
+        self.overflowed = False
+
+    def put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def put_threadsafe(self, event: dict):
+        try:
+            self.loop.call_soon_threadsafe(self.put, event)
+        except RuntimeError:
+            # The loop is closed
+            pass
+
+    async def get_batch(self, debounce: float = 0) -> list:
+        """
+        Wait for the next event, then collect what else arrives within `debounce`
+        seconds, so bursts are handled at once.
+        """
+        events = [await self.queue.get()]
+        if debounce > 0:
+            await asyncio.sleep(debounce)
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+
+class EventBus:
+    """
+    Publishes small JSON events on topics and delivers them to the subscribers of
+    those topics in every worker, through a pluggable backend.
+    """
+
+    def __init__(self, backend, max_events: int = 1000):
+        self.backend = backend
+        self.max_events = max_events
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.backend.start(self.deliver, self.resync)
+            self.started = True
+
+    def publish(self, topic: str, event: dict):
+        """Publish an event, a "message" field too large for the backend is dropped and flagged as truncated"""
+        payload = json.dumps({"topic": topic, "event": event}, default=str)
+        if len(payload.encode("utf-8")) > self.backend.max_payload:
+            event = {**event, "message": None, "truncated": True}
+            payload = json.dumps({"topic": topic, "event": event}, default=str)
+        try:
+            self.backend.send(payload)
+        except Exception as e:
+            logging.error(f"Error publishing event on {topic}: {e}")
+
+    def deliver(self, payload: str):
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            logging.error(f"Discarding malformed event: {payload[:200]}")
+            return
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(data["topic"], []))
+        for subscription in subscriptions:
+            subscription.put_threadsafe(data["event"])
+
+    def resync(self):
+        with self.lock:
+            subscriptions = [
+                subscription
+                for topic_subscriptions in self.subscriptions.values()
+                for subscription in topic_subscriptions
+            ]
+        for subscription in subscriptions:
+            subscription.put_threadsafe({"type": "resync"})
+
+    @asynccontextmanager
+    async def subscribe(self, topic: str):
+        self.start()
+        subscription = EventSubscription(asyncio.get_running_loop(), self.max_events)
+        with self.lock:
+            self.subscriptions.setdefault(topic, []).append(subscription)
+        try:
+            yield subscription
+        finally:
+            with self.lock:
+                self.subscriptions[topic].remove(subscription)
+                if not self.subscriptions[topic]:
+                    del self.subscriptions[topic]
+
+
+def get_event_backend(name: str):
+    name = name.lower()
+    if name == "auto":
+        if DATABASE_TYPE != "sqlite":
+            name = "postgres"
+        elif hasattr(socket, "AF_UNIX"):
+            name = "socket"
+        else:
+            name = "memory"
+    if name == "postgres":
+        return PostgresBackend()
+    if name == "socket":
+        directory = getenv("EVENT_BUS_SOCKET_DIR") or os.path.join(
+            tempfile.gettempdir(), "agixt-events"
+        )
+        return SocketBackend(directory)
+    return MemoryBackend()
+
+
+event_bus = EventBus(
+    get_event_backend(getenv("EVENT_BUS_BACKEND")),
+    max_events=int(getenv("EVENT_QUEUE_SIZE")),
+)
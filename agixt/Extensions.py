@@ -1,6 +1,8 @@
 import importlib
 import os
 import glob
+import copy
+import threading
 from inspect import signature, Parameter
 import logging
 import inspect
@@ -8,17 +10,7 @@ from Globals import getenv, DEFAULT_USER
 from MagicalAuth import get_user_id, get_sso_credentials
 from agixtsdk import AGiXTSDK
 from Prompts import Prompts
-from DB import (
-    get_session,
-    Chain as ChainDB,
-    ChainStep,
-    Agent,
-    Argument,
-    ChainStepArgument,
-    Prompt,
-    Command,
-    User,
-)
+from ChainCatalog import get_user_chain_names, get_catalog_chain
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -27,6 +19,115 @@ logging.basicConfig(
 DISABLED_EXTENSIONS = getenv("DISABLED_EXTENSIONS").replace(" ", "").split(",")
 
 
+def get_function_params(func):
+    params = {}
+    sig = signature(func)
+    for name, param in sig.parameters.items():
+        if name == "self":
+            continue
+        if param.default == Parameter.empty:
+            params[name] = ""
+        else:
+            params[name] = param.default
+    return params
+
+
+class ExtensionRegistry:
+    """
+    Metadata of every enabled extension, built once per process.
+
+    Each extension module is imported and its class instantiated a single time without
+    settings to read its commands, the same way get_extensions always did. Extensions
+    objects then filter and describe commands from here, only execute_command
+    instantiates an extension again.
+    """
+
+    def __init__(self):
+        extensions = []
+        classes = {}
+        command_args = {}
+        for command_file in sorted(glob.glob("extensions/*.py")):
+            module_name = os.path.splitext(os.path.basename(command_file))[0]
+            if module_name in DISABLED_EXTENSIONS:
+                continue
+            try:
+                extension = self.load_extension(module_name)
+            except Exception as e:
+                logging.error(f"Error loading extension {module_name}: {e}")
+                continue
+            if extension is None:
+                continue
+            classes[module_name] = extension.pop("extension_class")
+            for command in extension["commands"]:
+                command_args.setdefault(
+                    command["friendly_name"], command["command_args"]
+                )
+            extensions.append(extension)
+        self.extensions = tuple(extensions)
+        self.classes = classes
+        self.command_args = command_args
+
+    @staticmethod
+    def load_extension(module_name: str):
+        module = importlib.import_module(f"extensions.{module_name}")
+        extension_class = getattr(module, module_name, None)
+        if not isinstance(extension_class, type) or not issubclass(
+            extension_class, Extensions
+        ):
+            return None
+        command_class = extension_class()
+        extension_name = module_name.replace("_", " ").title()
+        if extension_name == "Agixt Actions":
+            extension_name = "AGiXT Actions"
+        try:
+            extension_description = inspect.getdoc(command_class)
+        except:
+            extension_description = extension_name
+        settings = get_function_params(extension_class.__init__)
+        # Remove kwargs from the settings, self is skipped already
+        settings.pop("kwargs", None)
+        commands = []
+        if hasattr(command_class, "commands"):
+            try:
+                for command_name, command_function in command_class.commands.items():
+                    try:
+                        command_description = inspect.getdoc(command_function)
+                    except:
+                        command_description = command_name
+                    commands.append(
+                        {
+                            "friendly_name": command_name,
+                            "description": command_description,
+                            "command_name": command_function.__name__,
+                            "command_args": get_function_params(command_function),
+                        }
+                    )
+            except Exception as e:
+                logging.error(f"Error getting commands: {e}")
+        return {
+            "module_name": module_name,
+            "extension_class": extension_class,
+            "extension_name": extension_name,
+            "description": extension_description,
+            "settings": settings,
+            "commands": commands,
+        }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_extension_registry() -> ExtensionRegistry:
+    """The process wide extension registry, built on first use or at app startup"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ExtensionRegistry()
+    return _registry
+
+
 class Extensions:
     def __init__(
         self,
@@ -104,96 +205,14 @@ class Extensions:
         return enabled_commands
 
     def get_command_args(self, command_name: str):
-        extensions = self.get_extensions()
-        for extension in extensions:
-            for command in extension["commands"]:
-                if command["friendly_name"] == command_name:
-                    return command["command_args"]
-        return {}
+        command_args = get_extension_registry().command_args.get(command_name)
+        return dict(command_args) if command_args is not None else {}
 
     def get_chains(self):
-        session = get_session()
-        chains = session.query(ChainDB).filter(ChainDB.user_id == self.user_id).all()
-        chain_list = []
-        for chain in chains:
-            chain_list.append(chain.name)
-        session.close()
-        return chain_list
+        return get_user_chain_names(self.user_id)
 
     def get_chain(self, chain_name):
-        session = get_session()
-        chain_name = chain_name.replace("%20", " ")
-        user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
-        chain_db = (
-            session.query(ChainDB)
-            .filter(ChainDB.user_id == user_data.id, ChainDB.name == chain_name)
-            .first()
-        )
-        if chain_db is None:
-            chain_db = (
-                session.query(ChainDB)
-                .filter(
-                    ChainDB.name == chain_name,
-                    ChainDB.user_id == self.user_id,
-                )
-                .first()
-            )
-        if chain_db is None:
-            session.close()
-            return []
-        chain_steps = (
-            session.query(ChainStep)
-            .filter(ChainStep.chain_id == chain_db.id)
-            .order_by(ChainStep.step_number)
-            .all()
-        )
-
-        steps = []
-        for step in chain_steps:
-            agent_name = session.query(Agent).get(step.agent_id).name
-            prompt = {}
-            if step.target_chain_id:
-                prompt["chain_name"] = (
-                    session.query(ChainDB).get(step.target_chain_id).name
-                )
-            elif step.target_command_id:
-                prompt["command_name"] = (
-                    session.query(Command).get(step.target_command_id).name
-                )
-            elif step.target_prompt_id:
-                prompt["prompt_name"] = (
-                    session.query(Prompt).get(step.target_prompt_id).name
-                )
-
-            # Retrieve argument data for the step
-            arguments = (
-                session.query(Argument, ChainStepArgument)
-                .join(ChainStepArgument, ChainStepArgument.argument_id == Argument.id)
-                .filter(ChainStepArgument.chain_step_id == step.id)
-                .all()
-            )
-
-            prompt_args = {}
-            for argument, chain_step_argument in arguments:
-                prompt_args[argument.name] = chain_step_argument.value
-
-            prompt.update(prompt_args)
-
-            step_data = {
-                "step": step.step_number,
-                "agent_name": agent_name,
-                "prompt_type": step.prompt_type,
-                "prompt": prompt,
-            }
-            steps.append(step_data)
-
-        chain_data = {
-            "id": chain_db.id,
-            "chain_name": chain_db.name,
-            "steps": steps,
-        }
-        session.close()
-        return chain_data
+        return get_catalog_chain(self.user_id, chain_name)
 
     def get_chains_with_args(self):
         skip_args = [
@@ -243,33 +262,19 @@ class Extensions:
         return chains
 
     def load_commands(self):
-        try:
-            settings = self.agent_config["settings"]
-        except:
-            settings = {}
         commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)(**settings)
-                if hasattr(command_class, "commands"):
-                    for (
-                        command_name,
-                        command_function,
-                    ) in command_class.commands.items():
-                        params = self.get_command_params(command_function)
-                        commands.append(
-                            (
-                                command_name,
-                                getattr(module, module_name),
-                                command_function.__name__,
-                                params,
-                            )
-                        )
+        registry = get_extension_registry()
+        for extension in registry.extensions:
+            extension_class = registry.classes[extension["module_name"]]
+            for command in extension["commands"]:
+                commands.append(
+                    (
+                        command["friendly_name"],
+                        extension_class,
+                        command["command_name"],
+                        dict(command["command_args"]),
+                    )
+                )
 
         # Add chains as commands
         if hasattr(self, "chains_with_args") and self.chains_with_args:
@@ -303,22 +308,9 @@ class Extensions:
 
     def get_extension_settings(self):
         settings = {}
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            if issubclass(getattr(module, module_name), Extensions):
-                command_class = getattr(module, module_name)()
-                params = self.get_command_params(command_class.__init__)
-                # Remove self and kwargs from params
-                if "self" in params:
-                    del params["self"]
-                if "kwargs" in params:
-                    del params["kwargs"]
-                if params != {}:
-                    settings[module_name] = params
+        for extension in get_extension_registry().extensions:
+            if extension["settings"] != {}:
+                settings[extension["module_name"]] = dict(extension["settings"])
 
         # Use self.chains_with_args instead of iterating over self.chains
         if self.chains_with_args:
@@ -390,67 +382,17 @@ class Extensions:
             )(**args)
 
     def get_command_params(self, func):
-        params = {}
-        sig = signature(func)
-        for name, param in sig.parameters.items():
-            if name == "self":
-                continue
-            if param.default == Parameter.empty:
-                params[name] = ""
-            else:
-                params[name] = param.default
-        return params
+        return get_function_params(func)
 
     def get_extensions(self):
         commands = []
-        command_files = glob.glob("extensions/*.py")
-        for command_file in command_files:
-            module_name = os.path.splitext(os.path.basename(command_file))[0]
-            if module_name in DISABLED_EXTENSIONS:
-                continue
-            module = importlib.import_module(f"extensions.{module_name}")
-            command_class = getattr(module, module_name.lower())()
-            extension_name = command_file.split("/")[-1].split(".")[0]
-            extension_name = extension_name.replace("_", " ").title()
-            try:
-                extension_description = inspect.getdoc(command_class)
-            except:
-                extension_description = extension_name
-            constructor = inspect.signature(command_class.__init__)
-            params = constructor.parameters
-            extension_settings = [
-                name for name in params if name != "self" and name != "kwargs"
-            ]
-            extension_commands = []
-            if hasattr(command_class, "commands"):
-                try:
-                    for (
-                        command_name,
-                        command_function,
-                    ) in command_class.commands.items():
-                        params = self.get_command_params(command_function)
-                        try:
-                            command_description = inspect.getdoc(command_function)
-                        except:
-                            command_description = command_name
-                        extension_commands.append(
-                            {
-                                "friendly_name": command_name,
-                                "description": command_description,
-                                "command_name": command_function.__name__,
-                                "command_args": params,
-                            }
-                        )
-                except Exception as e:
-                    logging.error(f"Error getting commands: {e}")
-            if extension_name == "Agixt Actions":
-                extension_name = "AGiXT Actions"
+        for extension in get_extension_registry().extensions:
             commands.append(
                 {
-                    "extension_name": extension_name,
-                    "description": extension_description,
-                    "settings": extension_settings,
-                    "commands": extension_commands,
+                    "extension_name": extension["extension_name"],
+                    "description": extension["description"],
+                    "settings": list(extension["settings"]),
+                    "commands": copy.deepcopy(extension["commands"]),
                 }
             )
 
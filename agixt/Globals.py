@@ -1,6 +1,9 @@
 import os
 import json
+import hashlib
+import threading
 import tiktoken
+from collections import OrderedDict
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -62,6 +65,61 @@ def getenv(var_name: str, default_value: str = "") -> str:
         "EZLOCALAI_API_KEY": "",
         "DEEPSEEK_API_KEY": "",
         "AZURE_OPENAI_ENDPOINT": "",
+        "EMBEDDING_MODEL_DIRECTORY": "",
+        "EMBEDDING_INTRA_OP_THREADS": "0",
+        "EMBEDDING_INTER_OP_THREADS": "0",
+        "EMBEDDING_QUANTIZED": "false",
+        "EMBEDDING_MAX_BATCH_SIZE": "64",
+        "EMBEDDING_BATCH_WAIT_MS": "5",
+        "EMBEDDING_CACHE_SIZE": "20000",
+        "MEMORY_INDEX": "auto",
+        "MEMORY_INDEX_METHOD": "hnsw",
+        "MEMORY_INDEX_IVFFLAT_LISTS": "100",
+        "MEMORY_MATRIX_CACHE_MB": "512",
+        "MEMORY_MATRIX_CACHE_TTL": "300",
+        "MEMORY_DEDUP": "true",
+        "PROVIDER_REQUEST_TIMEOUT": "300",
+        "PROVIDER_CONNECT_TIMEOUT": "10",
+        "PROVIDER_MAX_CONNECTIONS": "100",
+        "TRANSCRIPTION_MAX_MODELS": "2",
+        "TRANSCRIPTION_IDLE_SECONDS": "900",
+        "TRANSCRIPTION_DEVICE": "cpu",
+        "TRANSCRIPTION_COMPUTE_TYPE": "int8",
+        "TRANSCRIPTION_WORKERS": "2",
+        "TOKEN_CACHE_SIZE": "1024",
+        "TOKEN_CACHE_MIN_LENGTH": "2048",
+        "AGENT_CACHE_SIZE": "128",
+        "AGENT_CACHE_TTL": "300",
+        "COMMAND_PROMPT_CACHE_SIZE": "256",
+        "COMMAND_PROMPT_CACHE_TTL": "300",
+        "COMMANDS_TOP_K": "10",
+        "PROMPT_CACHE_SIZE": "1024",
+        "PROMPT_CACHE_TTL": "300",
+        "CACHE_INVALIDATION_POLL_SECONDS": "1",
+        "CHAIN_CACHE_SIZE": "256",
+        "CHAIN_CACHE_TTL": "300",
+        "TIMEZONE_CACHE_SIZE": "4096",
+        "TIMEZONE_CACHE_TTL": "600",
+        "CHAIN_MAX_CONCURRENCY": "4",
+        "CHAIN_USER_MAX_CONCURRENCY": "8",
+        "TASK_WORKER_CONCURRENCY": "4",
+        "TASK_POLL_SECONDS": "5",
+        "TASK_TIMEOUT_SECONDS": "300",
+        "TASK_LEASE_SECONDS": "600",
+        "TASK_MAX_ATTEMPTS": "5",
+        "TASK_RETRY_SECONDS": "60",
+        "TOKEN_USAGE_FLUSH_SECONDS": "5",
+        "TOKEN_USAGE_FLUSH_CALLS": "100",
+        "EVENT_BUS_BACKEND": "auto",
+        "EVENT_BUS_SOCKET_DIR": "",
+        "EVENT_QUEUE_SIZE": "1000",
+        "EVENT_DEBOUNCE_SECONDS": "0.25",
+        "INGESTION_PARSE_WORKERS": "4",
+        "INGESTION_CHUNK_WORKERS": "1",
+        "INGESTION_QUEUE_SIZE": "32",
+        "INGESTION_EMBED_BATCH_SIZE": "256",
+        "INGESTION_INSERT_BATCH_SIZE": "2000",
+        "INGESTION_PROGRESS_EVERY": "50",
     }
     if default_value != "":
         default_values[var_name] = default_value
@@ -69,9 +127,50 @@ def getenv(var_name: str, default_value: str = "") -> str:
     return os.getenv(var_name, default_value)
 
 
-def get_tokens(text: str) -> int:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(text))
+TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE"))
+TOKEN_CACHE_MIN_LENGTH = int(getenv("TOKEN_CACHE_MIN_LENGTH"))
+_encoding = None
+_token_counts = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+def get_approximate_tokens(text: str) -> int:
+    """
+    Estimate tokens as UTF-8 bytes / 4, without tokenizing.
+
+    For English prose and code this is usually within about 25% of cl100k_base, it
+    undercounts CJK text. Use it for rough thresholds, not for limits that must hold.
+    """
+    return (len(str(text).encode("utf-8", errors="ignore")) + 3) // 4
+
+
+def get_tokens(text: str, approximate: bool = False) -> int:
+    if approximate:
+        return get_approximate_tokens(text)
+    text = str(text)
+    if len(text) < TOKEN_CACHE_MIN_LENGTH:
+        return len(get_encoding().encode(text))
+    # Large strings like conversation context and prompts get counted repeatedly
+    key = hashlib.blake2b(
+        text.encode("utf-8", errors="surrogatepass"), digest_size=16
+    ).digest()
+    with _token_counts_lock:
+        num_tokens = _token_counts.get(key)
+        if num_tokens is not None:
+            _token_counts.move_to_end(key)
+            return num_tokens
+    num_tokens = len(get_encoding().encode(text))
+    with _token_counts_lock:
+        _token_counts[key] = num_tokens
+        while len(_token_counts) > TOKEN_CACHE_SIZE:
+            _token_counts.popitem(last=False)
     return num_tokens
 
 
@@ -0,0 +1,398 @@
+import time
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Tuple
+from sqlalchemy import insert
+from DB import (
+    Memory,
+    get_session,
+    get_new_uuid,
+    get_memory_index,
+    get_content_hash,
+    get_stored_content_sources,
+    get_stored_embeddings,
+)
+from Embeddings import embed_async
+from Memories import Memories, chunk_text
+from Parsers import parse_file
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Marks the end of a stage's input
+DONE = None
+
+
+class IngestionPipeline:
+    """
+    Bulk file ingestion into agent memory.
+
+    Files flow through bounded queues between four stages so each one overlaps with
+    the others: parsing in a process pool, chunking in a thread pool, embedding in
+    large batches and inserting memories with executemany in large transactions.
+    Progress is logged to the conversation as subactivities of one activity.
+    """
+
+    def __init__(
+        self,
+        memories: Memories,
+        user_input: str = "",
+        conversation=None,
+        agent_name: str = "",
+        on_document: Callable[[dict], None] = None,
+    ):
+        self.memories = memories
+        self.user_input = user_input
+        self.conversation = conversation
+        self.agent_name = agent_name
+        self.on_document = on_document
+        self.conversation_id = (
+            None if memories.collection_number == "0" else memories.collection_number
+        )
+        self.parse_workers = int(getenv("INGESTION_PARSE_WORKERS"))
+        # spaCy pipelines are not guaranteed to be thread safe, keep this at 1 unless tested
+        self.chunk_workers = int(getenv("INGESTION_CHUNK_WORKERS"))
+        self.queue_size = int(getenv("INGESTION_QUEUE_SIZE"))
+        self.embed_batch_size = int(getenv("INGESTION_EMBED_BATCH_SIZE"))
+        self.insert_batch_size = int(getenv("INGESTION_INSERT_BATCH_SIZE"))
+        self.progress_every = int(getenv("INGESTION_PROGRESS_EVERY"))
+        self.dedup = str(getenv("MEMORY_DEDUP")).lower() == "true"
+        self.activity_id = None
+        self.total_files = 0
+        self.parsed_files = 0
+        self.stored_files = 0
+        self.stored_chunks = 0
+        self.logged_files = 0
+        self.duplicate_chunks = 0
+        self.failed_files = []
+
+    def log(self, message: str):
+        if not self.conversation:
+            return
+        if self.activity_id:
+            message = f"[SUBACTIVITY][{self.activity_id}] {message}"
+        else:
+            message = f"[ACTIVITY] {message}"
+        try:
+            self.conversation.log_interaction(role=self.agent_name, message=message)
+        except Exception as e:
+            logging.warning(f"Unable to log ingestion progress: {e}")
+
+    def log_progress(self, force: bool = False):
+        if not force and self.stored_files < self.logged_files + self.progress_every:
+            return
+        self.logged_files = self.stored_files
+        self.log(
+            f"Read {self.stored_files}/{self.total_files} files into memory ({self.stored_chunks} chunks)."
+        )
+
+    async def run(self, files: List[Tuple[str, str]]) -> dict:
+        """
+        Ingest (file_path, file_name) pairs, returns counts and the files that failed.
+        """
+        self.total_files = len(files)
+        started = time.time()
+        if not self.memories.agent_id or not files:
+            return self.get_stats(started)
+        if self.conversation:
+            self.activity_id = self.conversation.log_interaction(
+                role=self.agent_name,
+                message=f"[ACTIVITY] Reading {self.total_files} files into memory.",
+            )
+        parsed_queue = asyncio.Queue(maxsize=self.queue_size)
+        chunked_queue = asyncio.Queue(maxsize=self.queue_size)
+        embedded_queue = asyncio.Queue(maxsize=self.queue_size)
+        file_queue = asyncio.Queue()
+        for file in files:
+            file_queue.put_nowait(file)
+        process_pool = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        thread_pool = ThreadPoolExecutor(max_workers=self.chunk_workers)
+        stages = []
+        try:
+            parsers = [
+                asyncio.create_task(
+                    self.parse_stage(file_queue, parsed_queue, process_pool)
+                )
+                for _ in range(self.parse_workers)
+            ]
+            chunkers = [
+                asyncio.create_task(
+                    self.chunk_stage(parsed_queue, chunked_queue, thread_pool)
+                )
+                for _ in range(self.chunk_workers)
+            ]
+            embedder = asyncio.create_task(
+                self.embed_stage(chunked_queue, embedded_queue)
+            )
+            inserter = asyncio.create_task(self.insert_stage(embedded_queue))
+            stages = parsers + chunkers + [embedder, inserter]
+            await asyncio.gather(*parsers)
+            for _ in chunkers:
+                await parsed_queue.put(DONE)
+            await asyncio.gather(*chunkers)
+            await chunked_queue.put(DONE)
+            await asyncio.gather(embedder, inserter)
+        finally:
+            # On cancellation or a failed stage, the others would wait on their queues forever
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            process_pool.shutdown(wait=False, cancel_futures=True)
+            thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self.failed_files:
+            self.log(
+                f"[ERROR] Unable to read {len(self.failed_files)} files: {', '.join(self.failed_files[:20])}"
+            )
+        self.log_progress(force=True)
+        return self.get_stats(started)
+
+    def get_stats(self, started: float) -> dict:
+        return {
+            "files": self.total_files,
+            "stored_files": self.stored_files,
+            "stored_chunks": self.stored_chunks,
+            "duplicate_chunks": self.duplicate_chunks,
+            "failed_files": self.failed_files,
+            "seconds": time.time() - started,
+        }
+
+    async def parse_stage(self, file_queue, parsed_queue, process_pool):
+        loop = asyncio.get_running_loop()
+        while not file_queue.empty():
+            file_path, file_name = file_queue.get_nowait()
+            try:
+                document = await loop.run_in_executor(
+                    process_pool, parse_file, file_path, file_name
+                )
+            except Exception as e:
+                logging.error(f"Error parsing {file_path}: {e}")
+                self.failed_files.append(file_name)
+                continue
+            self.parsed_files += 1
+            if self.on_document:
+                self.on_document(document)
+            # Only the memory text moves on, the raw content is not needed to chunk
+            await parsed_queue.put(
+                {
+                    "file_path": document["file_path"],
+                    "file_name": document["file_name"],
+                    "text": document["text"],
+                }
+            )
+
+    async def chunk_stage(self, parsed_queue, chunked_queue, thread_pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            document = await parsed_queue.get()
+            if document is DONE:
+                return
+            try:
+                chunks = await loop.run_in_executor(
+                    thread_pool, chunk_text, document["text"], self.memories.chunk_size
+                )
+            except Exception as e:
+                logging.error(f"Error chunking {document['file_path']}: {e}")
+                self.failed_files.append(document["file_name"])
+                continue
+            await chunked_queue.put(
+                {
+                    "file_name": document["file_name"],
+                    "external_source": f"file {document['file_path']}",
+                    "chunks": chunks,
+                }
+            )
+
+    async def embed_stage(self, chunked_queue, embedded_queue):
+        done = False
+        while not done:
+            batch = []
+            chunk_count = 0
+            # Wait for one document, then take whatever else is ready up to the batch size
+            document = await chunked_queue.get()
+            while document is not DONE:
+                batch.append(document)
+                chunk_count += len(document["chunks"])
+                if chunk_count >= self.embed_batch_size or chunked_queue.empty():
+                    break
+                document = await chunked_queue.get()
+            done = document is DONE
+            if batch:
+                stored_embeddings = {}
+                if self.dedup:
+                    try:
+                        stored_embeddings = await self.skip_stored_chunks(batch)
+                    except Exception as e:
+                        logging.warning(f"Unable to check for stored chunks: {e}")
+                texts = [chunk for document in batch for chunk in document["chunks"]]
+                try:
+                    embeddings = await self.embed_chunks(texts, stored_embeddings)
+                except Exception as e:
+                    logging.error(f"Error embedding {len(texts)} chunks: {e}")
+                    self.failed_files.extend(
+                        [document["file_name"] for document in batch]
+                    )
+                    continue
+                offset = 0
+                for document in batch:
+                    count = len(document["chunks"])
+                    document["embeddings"] = embeddings[offset : offset + count]
+                    offset += count
+                    await embedded_queue.put(document)
+        await embedded_queue.put(DONE)
+
+    async def skip_stored_chunks(self, batch: List[dict]) -> dict:
+        """
+        Drop chunks the document's source already stored, before they are embedded.
+        Returns the stored embeddings of chunks that other sources stored, those get
+        their own row since replacing or deleting the other source removes its rows.
+        """
+        document_hashes = [
+            [get_content_hash(chunk) for chunk in document["chunks"]]
+            for document in batch
+        ]
+        stored_sources = await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.get_stored_sources,
+            [content_hash for hashes in document_hashes for content_hash in hashes],
+        )
+        # Hashes stored before this batch, their embeddings can be reused
+        reusable_hashes = set(stored_sources.keys())
+        reused_hashes = set()
+        for document, hashes in zip(batch, document_hashes):
+            chunks = []
+            for chunk, content_hash in zip(document["chunks"], hashes):
+                sources = stored_sources.setdefault(content_hash, set())
+                if document["external_source"] not in sources:
+                    sources.add(document["external_source"])
+                    chunks.append(chunk)
+                    if content_hash in reusable_hashes:
+                        reused_hashes.add(content_hash)
+            self.duplicate_chunks += len(document["chunks"]) - len(chunks)
+            document["chunks"] = chunks
+            # Rows for these hashes are kept when the source is replaced
+            document["all_hashes"] = hashes
+        if not reused_hashes:
+            return {}
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.get_embeddings, list(reused_hashes)
+        )
+
+    def get_stored_sources(self, hashes: List[str]) -> dict:
+        session = get_session()
+        try:
+            return get_stored_content_sources(
+                session, self.memories.agent_id, self.conversation_id, hashes
+            )
+        finally:
+            session.close()
+
+    def get_embeddings(self, hashes: List[str]) -> dict:
+        session = get_session()
+        try:
+            return get_stored_embeddings(
+                session, self.memories.agent_id, self.conversation_id, hashes
+            )
+        finally:
+            session.close()
+
+    async def embed_chunks(self, texts: List[str], stored_embeddings: dict) -> list:
+        """Embed the chunks, reusing the stored embeddings by content hash"""
+        if not stored_embeddings:
+            return await embed_async(texts) if texts else []
+        hashes = [get_content_hash(text) for text in texts]
+        missing = [
+            text
+            for text, content_hash in zip(texts, hashes)
+            if content_hash not in stored_embeddings
+        ]
+        computed = iter(await embed_async(missing) if missing else [])
+        return [
+            (
+                stored_embeddings[content_hash]
+                if content_hash in stored_embeddings
+                else next(computed)
+            )
+            for content_hash in hashes
+        ]
+
+    async def insert_stage(self, embedded_queue):
+        loop = asyncio.get_running_loop()
+        batch = []
+        row_count = 0
+        while True:
+            document = await embedded_queue.get()
+            if document is not DONE:
+                batch.append(document)
+                row_count += len(document["chunks"])
+            if batch and (document is DONE or row_count >= self.insert_batch_size):
+                try:
+                    await loop.run_in_executor(None, self.insert_documents, batch)
+                    self.stored_files += len(batch)
+                    self.stored_chunks += row_count
+                    self.log_progress()
+                except Exception as e:
+                    logging.error(f"Error inserting {row_count} memories: {e}")
+                    self.failed_files.extend(
+                        [document["file_name"] for document in batch]
+                    )
+                batch = []
+                row_count = 0
+            if document is DONE:
+                return
+
+    def insert_documents(self, documents: List[dict]):
+        """Replace the memories for each document's source and insert the new chunks in one transaction"""
+        session = get_session()
+        try:
+            rows = []
+            for document in documents:
+                old_memories = session.query(Memory.id, Memory.content_hash).filter_by(
+                    agent_id=self.memories.agent_id,
+                    conversation_id=self.conversation_id,
+                    external_source=document["external_source"],
+                )
+                # Deduplicated chunks that are still in the file keep their rows
+                keep_hashes = set(document.get("all_hashes", []))
+                removed_ids = [
+                    id
+                    for id, content_hash in old_memories
+                    if content_hash not in keep_hashes
+                ]
+                for i in range(0, len(removed_ids), 500):
+                    session.query(Memory).filter(
+                        Memory.id.in_(removed_ids[i : i + 500])
+                    ).delete(synchronize_session=False)
+                for chunk, embedding in zip(document["chunks"], document["embeddings"]):
+                    rows.append(
+                        {
+                            "id": get_new_uuid(),
+                            "agent_id": self.memories.agent_id,
+                            "conversation_id": self.conversation_id,
+                            "embedding": embedding,
+                            "text": chunk,
+                            "external_source": document["external_source"],
+                            "description": self.user_input,
+                            "additional_metadata": chunk,
+                            "content_hash": get_content_hash(chunk),
+                        }
+                    )
+            if rows:
+                session.execute(insert(Memory), rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        # Replaced sources may have removed rows from the index, let it reload this scope
+        get_memory_index().remove(
+            self.memories.agent_id, conversation_id=self.conversation_id
+        )
@@ -12,8 +12,12 @@ from Memories import Memories
 from Websearch import Websearch
 from Extensions import Extensions
 from Memories import extract_keywords
+from Embeddings import embed_async
+from ContextAssembler import ContextAssembler
+from PromptTemplates import CompiledPrompt
 from ApiClient import (
     Agent,
+    get_agent,
     Prompts,
     Chain,
     Conversations,
@@ -42,7 +46,7 @@ class Interactions:
         self.uri = getenv("AGIXT_URI")
         if agent_name != "":
             self.agent_name = agent_name
-            self.agent = Agent(self.agent_name, user=user, ApiClient=self.ApiClient)
+            self.agent = get_agent(self.agent_name, user=user, ApiClient=self.ApiClient)
             self.websearch = Websearch(
                 collection_number=collection_id,
                 agent=self.agent,
@@ -68,22 +72,141 @@ class Interactions:
         self.chain = Chain(user=user)
         self.cp = Prompts(user=user)
         self._processed_commands = set()
+        # Query embedding tasks of the current format_prompt call, by text
+        self.query_embeddings = {}
+        # Context items the last format_prompt call left out to fit the token budget
+        self.context_dropped = []
 
     def custom_format(self, string, **kwargs):
         if isinstance(string, list):
             string = "".join(str(x) for x in string)
+        return CompiledPrompt(string).render(**kwargs)
 
-        def replace(match):
-            key = match.group(1)
-            value = kwargs.get(key, match.group(0))
-            if isinstance(value, list):
-                return "".join(str(x) for x in value)
-            else:
-                return str(value)
+    async def gather_context(self, sources: dict) -> dict:
+        """
+        Run context sources concurrently and return their results by name. A source is
+        a coroutine, or a sync callable that runs in a thread. Each source's time is
+        recorded in self.context_timings.
+        """
+        self.context_timings = {}
+
+        async def run(name, source):
+            started = time.perf_counter()
+            try:
+                if asyncio.iscoroutine(source):
+                    return await source
+                return await asyncio.to_thread(source)
+            finally:
+                self.context_timings[name] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(run(name, source) for name, source in sources.items())
+        )
+        self.context_timings["total"] = time.perf_counter() - started
+        logging.debug(
+            "Context gathered in "
+            + ", ".join(
+                f"{name}: {seconds * 1000:.0f}ms"
+                for name, seconds in self.context_timings.items()
+            )
+        )
+        return dict(zip(sources.keys(), results))
+
+    async def get_query_embedding(self, text: str):
+        """Embed a query once per format_prompt call, concurrent callers share the result"""
+        task = self.query_embeddings.get(text)
+        if task is None:
+            task = asyncio.ensure_future(embed_async([text]))
+            self.query_embeddings[text] = task
+        return (await task)[0]
+
+    async def get_context_memories(
+        self, user_input, top_results, min_relevance_score, collection_id=None
+    ) -> list:
+        """
+        Agent, injected collection and conversation memories for the input as
+        (memory, similarity) pairs, searched in one pass with a single query embedding.
+        Conversation memories are widened to twice and then four times top_results
+        while they stay under 4000 tokens.
+        """
+        top_results = int(top_results)
+        scopes = [("0", top_results)]
+        if collection_id is not None:
+            scopes.append((collection_id, top_results))
+        scopes.append((self.websearch.agent_memory.collection_number, top_results * 4))
+        results = await self.agent_memory.search_collections(
+            scopes=scopes,
+            min_relevance_score=min_relevance_score,
+            query_embedding=await self.get_query_embedding(user_input),
+            with_scores=True,
+        )
+        memories = results.pop()
+        conversation_context = memories[:top_results]
+        if len(conversation_context) == top_results:
+            for limit in (top_results * 2, top_results * 4):
+                if (
+                    get_tokens(
+                        " ".join(memory for memory, _ in conversation_context),
+                        approximate=True,
+                    )
+                    >= 4000
+                ):
+                    break
+                conversation_context = memories[:limit]
+        context = []
+        for collection_memories in results:
+            context += collection_memories
+        return context + conversation_context
 
-        pattern = r"(?<!{){([^{}\n]+)}(?!})"
-        result = re.sub(pattern, replace, string)
-        return result
+    async def get_commands_context(self, conversation_id, user_input) -> str:
+        """The command examples, selected by relevance to the input with the shared query embedding"""
+        query_embedding = None
+        if user_input:
+            try:
+                query_embedding = await self.get_query_embedding(user_input)
+            except Exception as e:
+                logging.error(f"Error embedding input for command selection: {e}")
+        return await asyncio.to_thread(
+            self.agent.get_commands_prompt,
+            conversation_id=conversation_id,
+            user_input=user_input,
+            query_embedding=query_embedding,
+        )
+
+    def get_company_context(self, company_id, user_input) -> tuple:
+        """The company's training data and the company agent's memories for the input"""
+        try:
+            company_training = self.auth.get_training_data(company_id=company_id)
+        except Exception as e:
+            return None, []
+        try:
+            cs = self.auth.get_company_agent_session(company_id=company_id)
+            company_memories = cs.get_agent_memories(
+                agent_name="AGiXT", user_input=user_input
+            )
+        except Exception as e:
+            return company_training, []
+        memories = []
+        for result in company_memories or []:
+            metadata = (
+                result["additional_metadata"] if "additional_metadata" in result else ""
+            )
+            external_source = (
+                result["external_source_name"]
+                if "external_source_name" in result
+                else None
+            )
+            timestamp = (
+                result["timestamp"]
+                if "timestamp" in result
+                else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            )
+            if external_source:
+                metadata = f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
+            if metadata != "":
+                memories.append(metadata)
+        return company_training, memories
 
     async def format_prompt(
         self,
@@ -96,21 +219,23 @@ class Interactions:
     ):
         if "user_input" in kwargs and user_input == "":
             user_input = kwargs["user_input"]
+        self.query_embeddings = {}
         prompt_name = prompt if prompt != "" else "Custom Input"
         prompt_category = (
             "Default" if "prompt_category" not in kwargs else kwargs["prompt_category"]
         )
         try:
-            prompt = self.cp.get_prompt(
+            template = self.cp.get_compiled_prompt(
                 prompt_name=prompt_name, prompt_category=prompt_category
             )
-            prompt_args = self.cp.get_prompt_args(prompt_text=prompt)
+            prompt = template.content
         except Exception as e:
             logging.error(
                 f"Error: {self.agent_name} failed to get prompt {prompt_name} from prompt category {prompt_category}. {e}"
             )
+            template = CompiledPrompt(prompt_name)
             prompt = prompt_name
-            prompt_args = []
+        prompt_args = template.args
         if "conversation_name" in kwargs:
             conversation_name = kwargs["conversation_name"]
         if conversation_name == "":
@@ -120,91 +245,50 @@ class Interactions:
         conversation_outputs = (
             f"http://localhost:7437/outputs/{self.agent.agent_id}/{conversation_id}/"
         )
-        context = []
-        if int(top_results) > 0:
-            if user_input:
-                min_relevance_score = 0.2
-                if "min_relevance_score" in kwargs:
-                    try:
-                        min_relevance_score = float(kwargs["min_relevance_score"])
-                    except:
-                        min_relevance_score = 0.2
-                context += await self.agent_memory.get_memories(
-                    user_input=user_input,
-                    limit=top_results,
-                    min_relevance_score=min_relevance_score,
-                )
-                if "inject_memories_from_collection_number" in kwargs:
-                    collection_id = kwargs["inject_memories_from_collection_number"]
-                    try:
-                        context += await Memories(
-                            agent_name=self.agent_name,
-                            agent_config=self.agent.AGENT_CONFIG,
-                            collection_number=collection_id,
-                            ApiClient=self.ApiClient,
-                            user=self.user,
-                        ).get_memories(
-                            user_input=user_input,
-                            limit=top_results,
-                            min_relevance_score=min_relevance_score,
-                        )
-                    except Exception as e:
-                        logging.error(
-                            f"Error: {self.agent_name} failed to get memories from collection {collection_id}. {e}"
-                        )
-                conversation_context = await self.websearch.agent_memory.get_memories(
-                    user_input=user_input,
-                    limit=top_results,
-                    min_relevance_score=min_relevance_score,
-                )
-                if len(conversation_context) == int(top_results):
-                    conversational_context_tokens = get_tokens(
-                        " ".join(conversation_context)
-                    )
-                    if int(conversational_context_tokens) < 4000:
-                        conversational_results = top_results * 2
-                        conversation_context = (
-                            await self.websearch.agent_memory.get_memories(
-                                user_input=user_input,
-                                limit=conversational_results,
-                                min_relevance_score=min_relevance_score,
-                            )
-                        )
-                        conversational_context_tokens = get_tokens(
-                            " ".join(conversation_context)
-                        )
-                        if int(conversational_context_tokens) < 4000:
-                            conversational_results = conversational_results * 2
-                            conversation_context = (
-                                await self.websearch.agent_memory.get_memories(
-                                    user_input=user_input,
-                                    limit=conversational_results,
-                                    min_relevance_score=min_relevance_score,
-                                )
-                            )
-                context += conversation_context
-        if "context" in kwargs:
-            context.append(kwargs["context"])
-        include_sources = (
-            str(kwargs["include_sources"]).lower() == "true"
-            if "include_sources" in kwargs
-            else False
+        company_id = self.auth.company_id
+        if "company_id" in kwargs:
+            company_id = kwargs["company_id"]
+        # Every context source is independent, fetch them all at once
+        sources = {}
+        if int(top_results) > 0 and user_input:
+            min_relevance_score = 0.2
+            if "min_relevance_score" in kwargs:
+                try:
+                    min_relevance_score = float(kwargs["min_relevance_score"])
+                except:
+                    min_relevance_score = 0.2
+            sources["memories"] = self.get_context_memories(
+                user_input=user_input,
+                top_results=top_results,
+                min_relevance_score=min_relevance_score,
+                collection_id=kwargs.get("inject_memories_from_collection_number"),
+            )
+        sources["tasks"] = lambda: self.agent.get_conversation_tasks(
+            conversation_id=conversation_id
         )
-        if include_sources:
-            sources = []
-            for line in context:
-                if "Content from" in line:
-                    source = line.split("Content from ")[1].split("\n")[0]
-                    if f"Content from {source}" not in sources:
-                        sources.append(f"Content from {source}")
-            if sources != []:
-                joined_sources = "\n".join(sources)
-                thinking_id = c.get_thinking_id(agent_name=self.agent_name)
-                source_count = len(sources)
-                c.log_interaction(
-                    role=self.agent_name,
-                    message=f"[SUBACTIVITY][{thinking_id}] Referencing {source_count} sources from content.\n{joined_sources}.",
-                )
+        sources["conversation"] = c.get_conversation
+        sources["activities"] = c.get_activities_with_subactivities
+        if company_id:
+            sources["company"] = lambda: self.get_company_context(
+                company_id=company_id, user_input=user_input
+            )
+        if "disable_commands" not in kwargs:
+            sources["commands"] = self.get_commands_context(
+                conversation_id=conversation_id, user_input=user_input
+            )
+        results = await self.gather_context(sources)
+        # Context gets what is left of the agent's input budget after the prompt,
+        # the input and the commands, memories are packed by relevance per token
+        reserved_tokens = get_tokens(prompt) + get_tokens(user_input)
+        if "COMMANDS" in prompt_args or "command_list" in prompt_args:
+            reserved_tokens += get_tokens(results.get("commands", ""))
+        assembler = ContextAssembler(
+            budget=self.agent.max_input_tokens - reserved_tokens
+        )
+        for memory, relevance in results.get("memories", []):
+            assembler.add("memory", memory, relevance=relevance)
+        if "context" in kwargs:
+            assembler.add("context", kwargs["context"], required=True)
         working_directory = f"{self.agent.working_directory}/{conversation_id}"
         helper_agent_name = self.agent_name
         if "helper_agent_name" not in kwargs:
@@ -222,11 +306,11 @@ class Interactions:
                 conversation_results = int(top_results) if top_results > 0 else 5
             except:
                 conversation_results = 5
-        agent_tasks = self.agent.get_conversation_tasks(conversation_id=conversation_id)
+        agent_tasks = results["tasks"]
         if agent_tasks != "":
-            context.append(agent_tasks)
+            assembler.add("tasks", agent_tasks)
         conversation_history = ""
-        conversation = c.get_conversation()
+        conversation = results["conversation"]
         if "interactions" in conversation:
             if conversation["interactions"] != []:
                 activity_history = [
@@ -262,69 +346,71 @@ class Interactions:
                     interactions = interactions[-conversation_results:]
                     conversation_history = "\n".join(interactions)
                 conversation_history += "\n## The assistant's recent activities:\n"
-                conversation_history += c.get_activities_with_subactivities()
+                conversation_history += results["activities"]
         if conversation_history != "":
-            context.append(
-                f"### Recent Activities and Conversation History\n{conversation_history}\n"
+            assembler.add(
+                "conversation_history",
+                f"### Recent Activities and Conversation History\n{conversation_history}\n",
+                required=True,
             )
         persona = ""
         if "PERSONA" in self.agent.AGENT_CONFIG["settings"]:
             persona = self.agent.AGENT_CONFIG["settings"]["PERSONA"]
         if "persona" in self.agent.AGENT_CONFIG["settings"]:
             persona = self.agent.AGENT_CONFIG["settings"]["persona"]
-        try:
-            company_id = self.auth.company_id
-            if "company_id" in kwargs:
-                company_id = kwargs["company_id"]
-            if company_id:
-                company_training = self.auth.get_training_data(company_id=company_id)
-                persona += f"\n\n**Guidelines as they pertain to the company:**\n{company_training}"
-                cs = self.auth.get_company_agent_session(company_id=company_id)
-                company_memories = cs.get_agent_memories(
-                    agent_name="AGiXT", user_input=user_input
-                )
-                if company_memories:
-                    for result in company_memories:
-                        metadata = (
-                            result["additional_metadata"]
-                            if "additional_metadata" in result
-                            else ""
-                        )
-                        external_source = (
-                            result["external_source_name"]
-                            if "external_source_name" in result
-                            else None
-                        )
-                        timestamp = (
-                            result["timestamp"]
-                            if "timestamp" in result
-                            else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                        if external_source:
-                            metadata = f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
-                        if metadata not in context and metadata != "":
-                            context.append(metadata)
-        except Exception as e:
-            pass
+        company_training, company_memories = results.get("company", (None, []))
+        if company_training is not None:
+            persona += f"\n\n**Guidelines as they pertain to the company:**\n{company_training}"
+        for metadata in company_memories:
+            assembler.add("company_memory", metadata)
         if persona != "":
-            context.append(
-                f"## Persona\n**The assistant follows a persona and uses the following guidelines and information to remain in character.**\n{persona}\n"
+            assembler.add(
+                "persona",
+                f"## Persona\n**The assistant follows a persona and uses the following guidelines and information to remain in character.**\n{persona}\n",
+                required=True,
             )
         if "uploaded_file_data" in kwargs:
-            context.append(
-                f"The user uploaded these files for the assistant to analyze:\n{kwargs['uploaded_file_data']}\n"
+            assembler.add(
+                "uploaded_file_data",
+                f"The user uploaded these files for the assistant to analyze:\n{kwargs['uploaded_file_data']}\n",
+                required=True,
             )
         if vision_response != "":
-            context.append(
-                f"The assistant's visual description from viewing uploaded images by user in this interaction:\n{vision_response}\n"
+            assembler.add(
+                "vision_response",
+                f"The assistant's visual description from viewing uploaded images by user in this interaction:\n{vision_response}\n",
+                required=True,
             )
         if "data_analysis" in kwargs:
-            context.append(
-                f"The assistant's data analysis from the user's input and file uploads:\n{kwargs['data_analysis']}\n"
+            assembler.add(
+                "data_analysis",
+                f"The assistant's data analysis from the user's input and file uploads:\n{kwargs['data_analysis']}\n",
+                required=True,
             )
-        if context != [] and context != "":
-            if isinstance(context, list):
-                context = "\n".join(context)
+        context = assembler.pack()
+        self.context_dropped = assembler.dropped
+        include_sources = (
+            str(kwargs["include_sources"]).lower() == "true"
+            if "include_sources" in kwargs
+            else False
+        )
+        if include_sources:
+            sources = []
+            for line in context:
+                if "Content from" in line:
+                    source = line.split("Content from ")[1].split("\n")[0]
+                    if f"Content from {source}" not in sources:
+                        sources.append(f"Content from {source}")
+            if sources != []:
+                joined_sources = "\n".join(sources)
+                thinking_id = c.get_thinking_id(agent_name=self.agent_name)
+                source_count = len(sources)
+                c.log_interaction(
+                    role=self.agent_name,
+                    message=f"[SUBACTIVITY][{thinking_id}] Referencing {source_count} sources from content.\n{joined_sources}.",
+                )
+        if context != []:
+            context = "\n".join(context)
             context = f"The user's input causes the assistant to recall these memories from activities:\n{context}\n\n**If referencing a file or image from context to the user, link to it with a url at `{conversation_outputs}the_file_name` - The URL is accessible to the user. If the file has not been referenced in context or from activities, do not attempt to link to it as it may not exist. Use exact file names and links from context only.** .\n"
         else:
             context = ""
@@ -390,6 +476,9 @@ class Interactions:
                     user_input=f"{user_input} {file_list}",
                     min_relevance_score=0.3,
                     limit=top_results if top_results > 0 else 5,
+                    query_embedding=await self.get_query_embedding(
+                        f"{user_input} {file_list}"
+                    ),
                 )
                 if fragmented_content != "":
                     file_contents = f"Here is some potentially relevant information from {the_files}\n{fragmented_content}\n\n"
@@ -411,13 +500,8 @@ class Interactions:
         for arg in kwargs:
             if arg in skip_args:
                 del args[arg]
-        agent_commands = ""
-        if "disable_commands" not in kwargs:
-            agent_commands = self.agent.get_commands_prompt(
-                conversation_id=conversation_id
-            )
-        formatted_prompt = self.custom_format(
-            string=prompt,
+        agent_commands = results.get("commands", "")
+        formatted_prompt = template.render(
             user_input=user_input,
             agent_name=self.agent_name,
             COMMANDS=agent_commands,
@@ -25,6 +25,8 @@ from Models import (
 from typing import List, Optional
 from fastapi import Header, HTTPException
 from Globals import getenv, get_default_agent
+from Caches import TTLCache, invalidation_bus
+from TokenCounter import get_token_usage, record_token_usage
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 from agixtsdk import AGiXTSDK
@@ -843,6 +845,8 @@ class MagicalAuth:
                     user_preference.pref_value = str(value)
         session.commit()
         session.close()
+        if "timezone" in kwargs:
+            invalidate_user_timezone(self.user_id)
         return "User updated successfully."
 
     def delete_company(self, company_id):
@@ -995,10 +999,7 @@ class MagicalAuth:
         user_requirements = self.registration_requirements()
         if not user_preferences:
             user_preferences = {}
-        if "input_tokens" not in user_preferences:
-            user_preferences["input_tokens"] = 0
-        if "output_tokens" not in user_preferences:
-            user_preferences["output_tokens"] = 0
+        user_preferences.update(get_token_usage(self.user_id))
         if user.email != getenv("DEFAULT_USER"):
             api_key = getenv("STRIPE_API_KEY")
             if api_key != "" and api_key is not None and str(api_key).lower() != "none":
@@ -1517,96 +1518,14 @@ class MagicalAuth:
         return decrypted_preferences
 
     def get_token_counts(self):
-        session = get_session()
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
-        )
-        input_tokens = 0
-        output_tokens = 0
-        found_input_tokens = False
-        found_output_tokens = False
-        for preference in user_preferences:
-            if preference.pref_key == "input_tokens":
-                input_tokens = int(preference.pref_value)
-                found_input_tokens = True
-            if preference.pref_key == "output_tokens":
-                output_tokens = int(preference.pref_value)
-                found_output_tokens = True
-        if not found_input_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(input_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
-        if not found_output_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(output_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
-        session.close()
-        return {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        return get_token_usage(self.user_id)
 
     def increase_token_counts(self, input_tokens: int = 0, output_tokens: int = 0):
+        """Add to the user's token totals, written to the database in batches"""
         self.validate_user()
-        session = get_session()
-        counts = self.get_token_counts()
-        current_input_tokens = int(counts["input_tokens"])
-        current_output_tokens = int(counts["output_tokens"])
-        updated_input_tokens = current_input_tokens + input_tokens
-        updated_output_tokens = current_output_tokens + output_tokens
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
+        record_token_usage(
+            self.user_id, input_tokens=input_tokens, output_tokens=output_tokens
         )
-        if not user_preferences:
-            user_input_tokens = None
-            user_output_tokens = None
-        else:
-            user_input_tokens = next(
-                (x for x in user_preferences if x.pref_key == "input_tokens"),
-                None,
-            )
-            user_output_tokens = next(
-                (x for x in user_preferences if x.pref_key == "output_tokens"),
-                None,
-            )
-        # Update input tokens
-        if user_input_tokens is None:
-            user_input_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(updated_input_tokens),
-            )
-            session.add(user_input_tokens)
-            session.commit()
-        else:
-            user_input_tokens.pref_value = str(updated_input_tokens)
-            session.commit()
-        # Update output tokens
-        if user_output_tokens is None:
-            user_output_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(updated_output_tokens),
-            )
-            session.add(user_output_tokens)
-            session.commit()
-        else:
-            user_output_tokens.pref_value = str(updated_output_tokens)
-            session.commit()
-        session.close()
-        return {
-            "input_tokens": updated_input_tokens,
-            "output_tokens": updated_output_tokens,
-        }
 
     def get_user_companies(self) -> List[str]:
         """Get list of company IDs that the user has access to"""
@@ -2689,7 +2608,24 @@ class MagicalAuth:
             )
 
 
+# Timezone names of users, read on every timestamp conversion
+timezone_cache = TTLCache(
+    max_entries=int(getenv("TIMEZONE_CACHE_SIZE")),
+    ttl=float(getenv("TIMEZONE_CACHE_TTL")),
+)
+invalidation_bus.subscribe("timezone", timezone_cache.pop)
+
+
+def invalidate_user_timezone(user_id):
+    """Drop the cached timezone of a user on every worker, call after changing it"""
+    invalidation_bus.publish("timezone", str(user_id))
+
+
 def get_user_timezone(user_id):
+    invalidation_bus.poll()
+    timezone = timezone_cache.get(str(user_id))
+    if timezone is not None:
+        return timezone
     session = get_session()
     user_preferences = (
         session.query(UserPreferences)
@@ -2707,10 +2643,24 @@ def get_user_timezone(user_id):
         session.commit()
     timezone = user_preferences.pref_value
     session.close()
+    timezone_cache.set(str(user_id), timezone)
     return timezone
 
 
-def convert_time(utc_time, user_id):
-    gmt = pytz.timezone("GMT")
-    local_tz = pytz.timezone(get_user_timezone(user_id))
-    return gmt.localize(utc_time).astimezone(local_tz)
+def convert_time(utc_time, user_id=None, timezone=None):
+    """
+    Convert a naive UTC datetime to the user's timezone. Pass `timezone`, from
+    get_user_timezone, to convert many timestamps with a single lookup.
+    """
+    if timezone is None:
+        timezone = get_user_timezone(user_id)
+    return pytz.utc.localize(utc_time).astimezone(pytz.timezone(timezone))
+
+
+def convert_times(utc_times, user_id) -> list:
+    """Convert a list of naive UTC datetimes to the user's timezone, None stays None"""
+    timezone = get_user_timezone(user_id)
+    return [
+        None if utc_time is None else convert_time(utc_time, timezone=timezone)
+        for utc_time in utc_times
+    ]
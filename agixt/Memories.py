@@ -2,25 +2,29 @@ import logging
 import os
 import asyncio
 import sys
+import threading
 from DB import (
     Memory,
     Agent,
     User,
     get_session,
     get_similar_memories,
+    get_similar_memories_many,
+    get_memory_index,
+    get_new_uuid,
+    get_content_hash,
+    get_stored_content_sources,
+    get_stored_embeddings,
     process_embedding_for_storage,
 )
 import spacy
 from numpy import array, linalg, ndarray
 from collections import Counter
-from typing import List
+from typing import List, Tuple
 from Globals import getenv, DEFAULT_USER
 from textacy.extract.keyterms import textrank  # type: ignore
 from youtube_transcript_api import YouTubeTranscriptApi
-from onnxruntime import InferenceSession
-from tokenizers import Tokenizer
-from typing import List, cast, Union, Sequence
-from numpy import array, linalg, ndarray
+from Embeddings import embed, embed_async
 import numpy as np
 from datetime import datetime
 from uuid import UUID
@@ -33,50 +37,104 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 
+NLP_SEGMENT_LENGTH = 100000
+_nlp_pipeline = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """
+    Load the spaCy pipeline once per process with only what chunking and keyword
+    extraction need: the sentence recognizer instead of the parser, and POS tags and
+    lemmas for textrank. NER and the parser are excluded.
+    """
+    global _nlp_pipeline
+    if _nlp_pipeline is None:
+        with _nlp_lock:
+            if _nlp_pipeline is None:
+                try:
+                    sp = spacy.load("en_core_web_sm", exclude=["ner", "parser"])
+                except:
+                    spacy.cli.download("en_core_web_sm")
+                    sp = spacy.load("en_core_web_sm", exclude=["ner", "parser"])
+                if "senter" in sp.disabled:
+                    sp.enable_pipe("senter")
+                elif "senter" not in sp.pipe_names:
+                    sp.add_pipe("sentencizer")
+                sp.max_length = NLP_SEGMENT_LENGTH * 2
+                _nlp_pipeline = sp
+    return _nlp_pipeline
+
+
 def nlp(text):
-    try:
-        sp = spacy.load("en_core_web_sm")
-    except:
-        spacy.cli.download("en_core_web_sm")
-        sp = spacy.load("en_core_web_sm")
-    sp.max_length = 99999999999999999999999
+    sp = get_nlp()
+    if len(text) > sp.max_length:
+        sp.max_length = len(text) + 1
     return sp(text)
 
 
-def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
-    tokenizer = Tokenizer.from_file(os.path.join(os.getcwd(), "onnx", "tokenizer.json"))
-    tokenizer.enable_truncation(max_length=256)
-    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=256)
-    model = InferenceSession(os.path.join(os.getcwd(), "onnx", "model.onnx"))
-    all_embeddings = []
-    for i in range(0, len(input), 32):
-        batch = input[i : i + 32]
-        encoded = [tokenizer.encode(d) for d in batch]
-        input_ids = np.array([e.ids for e in encoded])
-        attention_mask = np.array([e.attention_mask for e in encoded])
-        onnx_input = {
-            "input_ids": np.array(input_ids, dtype=np.int64),
-            "attention_mask": np.array(attention_mask, dtype=np.int64),
-            "token_type_ids": np.array(
-                [np.zeros(len(e), dtype=np.int64) for e in input_ids],
-                dtype=np.int64,
-            ),
-        }
-        model_output = model.run(None, onnx_input)
-        last_hidden_state = model_output[0]
-        input_mask_expanded = np.broadcast_to(
-            np.expand_dims(attention_mask, -1), last_hidden_state.shape
-        )
-        embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
-            input_mask_expanded.sum(1), a_min=1e-9, a_max=None
-        )
-        norm = np.linalg.norm(embeddings, axis=1)
-        norm[norm == 0] = 1e-12
-        embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
-        all_embeddings.append(embeddings)
-    return cast(
-        List[Union[Sequence[float], Sequence[int]]], np.concatenate(all_embeddings)
-    ).tolist()
+def split_text_segments(text: str, segment_length: int = NLP_SEGMENT_LENGTH):
+    """Yield pieces of text of at most segment_length, split on paragraph or word boundaries"""
+    start = 0
+    while start < len(text):
+        end = start + segment_length
+        if end >= len(text):
+            yield text[start:]
+            return
+        split_at = text.rfind("\n\n", start, end)
+        if split_at <= start:
+            split_at = text.rfind(" ", start, end)
+        if split_at <= start:
+            split_at = end
+        yield text[start:split_at]
+        start = split_at
+
+
+def nlp_pipe(text: str):
+    """Stream Docs for large text so only one segment is parsed and held at a time"""
+    return get_nlp().pipe(split_text_segments(text), batch_size=1)
+
+
+def score_chunk(chunk: str, keywords: set) -> int:
+    """Score a chunk based on the number of query keywords it contains."""
+    chunk_counter = Counter(chunk.split())
+    score = sum(chunk_counter[keyword] for keyword in keywords)
+    return score
+
+
+def chunk_text(text: str, chunk_size: int) -> List[str]:
+    """
+    Split text into chunks of about chunk_size tokens on sentence boundaries, ordered by
+    how many of the document's keywords each chunk contains.
+    """
+    chunk_texts = []
+    chunk = []
+    chunk_len = 0
+    keyword_scores = Counter()
+    # Large documents are parsed one segment at a time, only words are kept
+    for doc in nlp_pipe(text):
+        for keyword, score in textrank(doc, topn=10):
+            keyword_scores[keyword] += score
+        for sentence in doc.sents:
+            sentence_tokens = len(sentence)
+            if chunk_len + sentence_tokens > chunk_size and chunk:
+                chunk_texts.append(" ".join(chunk))
+                chunk = []
+                chunk_len = 0
+
+            chunk.extend(token.text for token in sentence)
+            chunk_len += sentence_tokens
+
+    if chunk:
+        chunk_texts.append(" ".join(chunk))
+
+    keywords = set(keyword for keyword, _ in keyword_scores.most_common(10))
+    content_chunks = [
+        (score_chunk(content, keywords), content) for content in chunk_texts
+    ]
+    # Sort the chunks by their score in descending order before returning them
+    content_chunks.sort(key=lambda x: x[0], reverse=True)
+    return [content for score, content in content_chunks]
 
 
 def extract_keywords(doc=None, text="", limit=10):
@@ -378,6 +436,7 @@ class SQLCollection:
                 synchronize_session="fetch"
             )
             self.session.commit()
+            get_memory_index().remove(self.memories.agent_id, ids=ids)
             return True
         except Exception as e:
             self.session.rollback()
@@ -386,8 +445,10 @@ class SQLCollection:
 
     def add(self, ids, metadatas, documents):
         try:
-            for id, metadata, document in zip(ids, metadatas, documents):
-                embedding = embed([document])
+            embeddings = embed(list(documents))
+            for id, metadata, document, embedding in zip(
+                ids, metadatas, documents, embeddings
+            ):
                 memory = Memory(
                     id=id,
                     agent_id=self.memories.agent_id,
@@ -398,12 +459,23 @@ class SQLCollection:
                     ),
                     embedding=embedding,
                     text=document,
+                    content_hash=get_content_hash(document),
                     external_source=metadata.get("external_source_name", "user input"),
                     description=metadata.get("description", ""),
                     additional_metadata=metadata.get("additional_metadata", ""),
                 )
                 self.session.add(memory)
             self.session.commit()
+            get_memory_index().add(
+                self.memories.agent_id,
+                (
+                    None
+                    if self.memories.collection_number == "0"
+                    else self.memories.collection_number
+                ),
+                ids,
+                embeddings,
+            )
             return True
         except Exception as e:
             self.session.rollback()
@@ -431,6 +503,31 @@ def format_timestamp(timestamp):
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def format_scored_memory_results(memory_results) -> List[Tuple[str, float]]:
+    """Format (memory, similarity) results as deduplicated (metadata, similarity) pairs"""
+    response = []
+    seen = set()
+    for memory, similarity in memory_results:
+        metadata = memory.additional_metadata if memory.additional_metadata else ""
+        external_source = memory.external_source if memory.external_source else None
+        timestamp = format_timestamp(memory.timestamp)
+
+        if external_source:
+            metadata = (
+                f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
+            )
+
+        if metadata not in seen and metadata != "":
+            seen.add(metadata)
+            response.append((metadata, float(similarity)))
+    return response
+
+
+def format_memory_results(memory_results) -> List[str]:
+    """Format (memory, similarity) results as the deduplicated metadata strings used for context"""
+    return [metadata for metadata, _ in format_scored_memory_results(memory_results)]
+
+
 class Memories:
     def __init__(
         self,
@@ -485,6 +582,7 @@ class Memories:
                 query = query.filter_by(conversation_id=conversation_id)
             query.delete()
             session.commit()
+            get_memory_index().remove(self.agent_id, conversation_id=conversation_id)
             return True
         except Exception as e:
             session.rollback()
@@ -663,29 +761,92 @@ class Memories:
                 None if self.collection_number == "0" else self.collection_number
             )
 
+            content_hashes = [get_content_hash(chunk) for chunk in chunks]
+            dedup = str(getenv("MEMORY_DEDUP")).lower() == "true"
+
             # If replacing external source content, delete old entries
-            if external_source.startswith(("file", "http://", "https://")):
-                session.query(Memory).filter_by(
+            replaced_source = external_source.startswith(
+                ("file", "http://", "https://")
+            )
+            removed_ids = []
+            if replaced_source:
+                old_memories = session.query(Memory.id, Memory.content_hash).filter_by(
                     agent_id=self.agent_id,
                     conversation_id=conversation_id,
                     external_source=external_source,
-                ).delete()
+                )
+                # When deduplicating, chunks that did not change are kept as they are
+                keep_hashes = set(content_hashes) if dedup else set()
+                removed_ids = [
+                    id
+                    for id, content_hash in old_memories
+                    if content_hash not in keep_hashes
+                ]
+                for i in range(0, len(removed_ids), 500):
+                    session.query(Memory).filter(
+                        Memory.id.in_(removed_ids[i : i + 500])
+                    ).delete(synchronize_session=False)
+
+            duplicate_chunks = 0
+            stored_embeddings = {}
+            if dedup:
+                # Skip chunks this source already stored. Other sources' rows are not
+                # reused, replacing or deleting those sources would remove them.
+                stored_sources = get_stored_content_sources(
+                    session, self.agent_id, conversation_id, content_hashes
+                )
+                new_chunks = []
+                new_hashes = []
+                for chunk, content_hash in zip(chunks, content_hashes):
+                    sources = stored_sources.setdefault(content_hash, set())
+                    if external_source not in sources:
+                        sources.add(external_source)
+                        new_chunks.append(chunk)
+                        new_hashes.append(content_hash)
+                duplicate_chunks = len(chunks) - len(new_chunks)
+                if duplicate_chunks:
+                    logging.info(
+                        f"Skipping {duplicate_chunks} chunks already in memory"
+                    )
+                chunks, content_hashes = new_chunks, new_hashes
+                # Chunks stored by other sources get their own row with the stored embedding
+                stored_embeddings = get_stored_embeddings(
+                    session, self.agent_id, conversation_id, content_hashes
+                )
 
-            # Process all chunks first to ensure they're valid
+            # Embed the remaining chunks in one batch, then process them to ensure they're valid
+            missing_chunks = [
+                chunk
+                for chunk, content_hash in zip(chunks, content_hashes)
+                if content_hash not in stored_embeddings
+            ]
+            missing_embeddings = iter(
+                await embed_async(missing_chunks) if missing_chunks else []
+            )
+            chunk_embeddings = [
+                (
+                    stored_embeddings[content_hash]
+                    if content_hash in stored_embeddings
+                    else next(missing_embeddings)
+                )
+                for content_hash in content_hashes
+            ]
             memories_to_add = []
-            for chunk in chunks:
-                # Get embedding and ensure proper shape
+            for chunk, content_hash, chunk_embedding in zip(
+                chunks, content_hashes, chunk_embeddings
+            ):
+                # Ensure proper shape
                 try:
-                    chunk_embedding = embed([chunk])
-                    if not chunk_embedding or len(chunk_embedding) == 0:
+                    if chunk_embedding is None or len(chunk_embedding) == 0:
                         logging.warning(
                             f"Failed to generate embedding for chunk: {chunk[:100]}..."
                         )
                         continue
 
-                    embedding = process_embedding_for_storage(chunk_embedding[0])
+                    embedding = process_embedding_for_storage(chunk_embedding)
 
                     memory = Memory(
+                        id=get_new_uuid(),
                         agent_id=self.agent_id,  # Explicitly set agent_id
                         conversation_id=conversation_id,
                         embedding=embedding,
@@ -693,6 +854,7 @@ class Memories:
                         external_source=external_source,
                         description=user_input,
                         additional_metadata=chunk,
+                        content_hash=content_hash,
                     )
                     # Validate memory object
                     if not memory.agent_id:
@@ -707,9 +869,22 @@ class Memories:
             # Add all valid memories
             if memories_to_add:
                 session.bulk_save_objects(memories_to_add)
-                session.commit()
+            session.commit()
+            memory_index = get_memory_index()
+            if removed_ids:
+                memory_index.remove(self.agent_id, ids=removed_ids)
+            if memories_to_add:
+                memory_index.add(
+                    self.agent_id,
+                    conversation_id,
+                    [memory.id for memory in memories_to_add],
+                    [memory.embedding for memory in memories_to_add],
+                )
                 logging.info(f"Successfully added {len(memories_to_add)} memories")
                 return True
+            elif duplicate_chunks and not chunks:
+                # Everything was already stored
+                return True
             else:
                 logging.warning("No valid memories to add")
                 return False
@@ -733,7 +908,7 @@ class Memories:
 
         session = get_session()
         try:
-            query_embedding = embed([user_input])[0]
+            query_embedding = (await embed_async([user_input]))[0]
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
@@ -780,10 +955,12 @@ class Memories:
         user_input: str,
         limit: int,
         min_relevance_score: float = 0.0,
+        query_embedding=None,
     ) -> List[str]:
         session = get_session()
         try:
-            query_embedding = embed([user_input])[0]
+            if query_embedding is None:
+                query_embedding = (await embed_async([user_input]))[0]
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
@@ -797,26 +974,46 @@ class Memories:
                 limit,
                 min_relevance_score,
             )
+            return format_memory_results(memory_results)
 
-            # Format results
-            response = []
-            for memory, similarity in memory_results:
-                metadata = (
-                    memory.additional_metadata if memory.additional_metadata else ""
-                )
-                external_source = (
-                    memory.external_source if memory.external_source else None
-                )
-                timestamp = format_timestamp(memory.timestamp)
-
-                if external_source:
-                    metadata = f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
-
-                if metadata not in response and metadata != "":
-                    response.append(metadata)
-
-            return response
+        finally:
+            session.close()
 
+    async def search_collections(
+        self,
+        scopes: List[Tuple[str, int]],
+        min_relevance_score: float = 0.0,
+        user_input: str = "",
+        query_embedding=None,
+        with_scores: bool = False,
+    ) -> List[List[str]]:
+        """
+        Search several of this agent's collections in one pass with a single query vector.
+
+        `scopes` holds (collection_number, limit) pairs. `user_input` is only embedded
+        when no `query_embedding` is given. Returns a list of memories per scope,
+        formatted like get_memories, or (memory, similarity) pairs with `with_scores`.
+        """
+        if query_embedding is None:
+            query_embedding = (await embed_async([user_input]))[0]
+        search_scopes = []
+        for collection_number, limit in scopes:
+            try:
+                conversation_id = str(UUID(str(collection_number)))
+            except:
+                conversation_id = None
+            search_scopes.append((self.agent_id, conversation_id, limit))
+        session = get_session()
+        try:
+            results = get_similar_memories_many(
+                session, query_embedding, search_scopes, min_relevance_score
+            )
+            if with_scores:
+                return [
+                    format_scored_memory_results(memory_results)
+                    for memory_results in results
+                ]
+            return [format_memory_results(memory_results) for memory_results in results]
         finally:
             session.close()
 
@@ -853,6 +1050,7 @@ class Memories:
             )
 
             session.commit()
+            get_memory_index().remove(self.agent_id)
             return bool(result)
         except Exception as e:
             session.rollback()
@@ -863,37 +1061,10 @@ class Memories:
 
     def score_chunk(self, chunk: str, keywords: set) -> int:
         """Score a chunk based on the number of query keywords it contains."""
-        chunk_counter = Counter(chunk.split())
-        score = sum(chunk_counter[keyword] for keyword in keywords)
-        return score
+        return score_chunk(chunk=chunk, keywords=keywords)
 
     async def chunk_content(self, text: str, chunk_size: int) -> List[str]:
-        doc = nlp(text)
-        sentences = list(doc.sents)
-        content_chunks = []
-        chunk = []
-        chunk_len = 0
-        keywords = set(extract_keywords(doc=doc, limit=10))
-        for sentence in sentences:
-            sentence_tokens = len(sentence)
-            if chunk_len + sentence_tokens > chunk_size and chunk:
-                chunk_text = " ".join(token.text for token in chunk)
-                content_chunks.append(
-                    (self.score_chunk(chunk_text, keywords), chunk_text)
-                )
-                chunk = []
-                chunk_len = 0
-
-            chunk.extend(sentence)
-            chunk_len += sentence_tokens
-
-        if chunk:
-            chunk_text = " ".join(token.text for token in chunk)
-            content_chunks.append((self.score_chunk(chunk_text, keywords), chunk_text))
-
-        # Sort the chunks by their score in descending order before returning them
-        content_chunks.sort(key=lambda x: x[0], reverse=True)
-        return [chunk_text for score, chunk_text in content_chunks]
+        return chunk_text(text=text, chunk_size=chunk_size)
 
     async def get_transcription(self, video_id: str = None):
         if "?v=" in video_id:
@@ -0,0 +1,88 @@
+import os
+import base64
+from datetime import datetime
+
+# File parsers used by the ingestion pipeline's process pool.
+# Keep this module free of database and model imports, worker processes import it.
+
+PARSEABLE_FILE_TYPES = ["pdf", "doc", "docx", "csv"]
+UNPARSEABLE_FILE_TYPES = [
+    "exe",
+    "bin",
+    "rar",
+    "zip",
+    "ppt",
+    "pptx",
+    "xls",
+    "xlsx",
+    "wav",
+    "mp3",
+    "ogg",
+    "m4a",
+    "flac",
+    "wma",
+    "aac",
+    "jpg",
+    "jpeg",
+    "png",
+    "gif",
+    "webp",
+    "tiff",
+    "bmp",
+    "svg",
+]
+
+
+def can_parse_file(file_name: str) -> bool:
+    """Files that can be read without an agent, conversion or transcription"""
+    file_type = str(file_name).split(".")[-1].lower()
+    return file_type not in UNPARSEABLE_FILE_TYPES
+
+
+def parse_file(file_path: str, file_name: str = "") -> dict:
+    """
+    Read a file into text for memory.
+
+    Returns a dict with the text to store (`text`) and the raw extracted content
+    (`content`), matching what AGiXT.learn_from_file stores for the same file type.
+    """
+    if not file_name:
+        file_name = os.path.basename(file_path)
+    file_type = file_name.split(".")[-1].lower()
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if file_type == "pdf":
+        import pdfplumber
+
+        with pdfplumber.open(file_path) as pdf:
+            content = "\n".join([page.extract_text() or "" for page in pdf.pages])
+        text = (
+            f"Content from PDF uploaded at {timestamp} named `{file_name}`:\n{content}"
+        )
+    elif file_type in ["doc", "docx"]:
+        import docx2txt
+
+        content = docx2txt.process(file_path)
+        text = f"Content from the document uploaded named `{file_name}`:\n{content}"
+    elif file_type == "csv":
+        import pandas as pd
+
+        csv = pd.read_csv(file_path).to_csv(index=False)
+        content = f"Content from file uploaded named `{file_name}`:\n```csv\n{csv}```\n"
+        text = content
+    else:
+        try:
+            with open(file_path, "r") as f:
+                content = f.read()
+        except:
+            with open(file_path, "rb") as f:
+                content = f.read()
+            content = base64.b64encode(content).decode("utf-8")
+        text = (
+            f"Content from file uploaded named `{file_name}` at {timestamp}:\n{content}"
+        )
+    return {
+        "file_path": file_path,
+        "file_name": file_name,
+        "text": text,
+        "content": content,
+    }
@@ -0,0 +1,110 @@
+import re
+import logging
+import threading
+from Caches import TTLCache, invalidation_bus
+from Globals import getenv, DEFAULT_USER
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+def get_template_args(prompt_text: str) -> list:
+    """Names of every {placeholder} in a prompt, in order"""
+    prompt_args = []
+    start_index = prompt_text.find("{")
+    while start_index != -1:
+        end_index = prompt_text.find("}", start_index)
+        if end_index != -1:
+            prompt_args.append(prompt_text[start_index + 1 : end_index])
+            start_index = prompt_text.find("{", end_index)
+        else:
+            break
+    return prompt_args
+
+
+class CompiledPrompt:
+    """
+    A prompt template split once into literal text and placeholder slots, so rendering
+    is a single join. Placeholders are matched the same way as custom_format, doubled
+    braces are left alone and placeholders without a value keep their braces.
+    """
+
+    pattern = re.compile(r"(?<!{){([^{}\n]+)}(?!})")
+
+    def __init__(self, content: str):
+        self.content = content
+        # Literal text at even indexes, placeholder names at odd indexes
+        self.segments = []
+        position = 0
+        for match in self.pattern.finditer(content):
+            self.segments.append(content[position : match.start()])
+            self.segments.append(match.group(1))
+            position = match.end()
+        self.segments.append(content[position:])
+        self.args = get_template_args(content)
+
+    def render(self, **kwargs) -> str:
+        parts = list(self.segments)
+        for index in range(1, len(parts), 2):
+            name = parts[index]
+            if name not in kwargs:
+                parts[index] = f"{{{name}}}"
+                continue
+            value = kwargs[name]
+            if isinstance(value, list):
+                parts[index] = "".join(str(x) for x in value)
+            else:
+                parts[index] = str(value)
+        return "".join(parts)
+
+
+# Compiled prompts per user, keyed by (user_id, prompt_name, prompt_category)
+prompt_cache = TTLCache(
+    max_entries=int(getenv("PROMPT_CACHE_SIZE")),
+    ttl=float(getenv("PROMPT_CACHE_TTL")),
+)
+# Bumped by every prompt change, a prompt loaded while it moved is not cached
+prompt_version = 0
+prompt_version_lock = threading.Lock()
+
+
+def drop_cached_prompts(key: str):
+    global prompt_version
+    with prompt_version_lock:
+        prompt_version += 1
+    if key == "*":
+        prompt_cache.clear()
+    else:
+        prompt_cache.pop_matching(lambda cache_key, prompt: cache_key[0] == key)
+
+
+invalidation_bus.subscribe("prompts", drop_cached_prompts)
+
+
+def invalidate_prompts(user_id=None, user: str = ""):
+    """
+    Drop the cached prompts of a user on every worker, or of all users when user_id is
+    None. Changes by the default user reach every user, its prompts are shared.
+    """
+    if user_id is None or str(user).lower() == DEFAULT_USER.lower():
+        invalidation_bus.publish("prompts", "*")
+    else:
+        invalidation_bus.publish("prompts", str(user_id))
+
+
+def get_cached_prompt(user_id, prompt_name: str, prompt_category: str, load):
+    """The cached compiled prompt, calling load() for its content on a miss"""
+    key = (str(user_id), prompt_name, prompt_category)
+    invalidation_bus.poll()
+    prompt = prompt_cache.get(key)
+    if prompt is None:
+        version = prompt_version
+        content = load()
+        if content is None:
+            return None
+        prompt = CompiledPrompt(content)
+        if version == prompt_version:
+            prompt_cache.set(key, prompt)
+    return prompt
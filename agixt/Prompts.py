@@ -1,6 +1,8 @@
 from DB import Prompt, PromptCategory, Argument, User, get_session
 from Globals import DEFAULT_USER
 from MagicalAuth import get_user_id
+from ChainCatalog import invalidate_chains
+from PromptTemplates import get_cached_prompt, get_template_args, invalidate_prompts
 import os
 
 
@@ -49,8 +51,26 @@ class Prompts:
             session.add(argument)
         session.commit()
         session.close()
+        invalidate_prompts(user_id=self.user_id, user=self.user)
+
+    def get_compiled_prompt(self, prompt_name: str, prompt_category: str = "Default"):
+        """The prompt as a CompiledPrompt from the per user prompt cache, None when it does not exist"""
+        return get_cached_prompt(
+            self.user_id,
+            prompt_name,
+            prompt_category,
+            lambda: self.load_prompt(
+                prompt_name=prompt_name, prompt_category=prompt_category
+            ),
+        )
 
     def get_prompt(self, prompt_name: str, prompt_category: str = "Default"):
+        prompt = self.get_compiled_prompt(
+            prompt_name=prompt_name, prompt_category=prompt_category
+        )
+        return prompt.content if prompt is not None else None
+
+    def load_prompt(self, prompt_name: str, prompt_category: str = "Default"):
         session = get_session()
         user_data = session.query(User).filter(User.email == DEFAULT_USER).first()
         prompt = (
@@ -226,16 +246,7 @@ class Prompts:
         return prompts
 
     def get_prompt_args(self, prompt_text):
-        prompt_args = []
-        start_index = prompt_text.find("{")
-        while start_index != -1:
-            end_index = prompt_text.find("}", start_index)
-            if end_index != -1:
-                prompt_args.append(prompt_text[start_index + 1 : end_index])
-                start_index = prompt_text.find("{", end_index)
-            else:
-                break
-        return prompt_args
+        return get_template_args(prompt_text)
 
     def delete_prompt(self, prompt_name, prompt_category="Default"):
         if not prompt_category:
@@ -253,6 +264,8 @@ class Prompts:
         if prompt:
             session.delete(prompt)
             session.commit()
+            invalidate_chains(user_id=self.user_id, user=self.user)
+            invalidate_prompts(user_id=self.user_id, user=self.user)
         session.close()
 
     def update_prompt(self, prompt_name, prompt, prompt_category="Default"):
@@ -308,6 +321,7 @@ class Prompts:
                     )
                     session.add(argument)
             session.commit()
+            invalidate_prompts(user_id=self.user_id, user=self.user)
         session.close()
 
     def rename_prompt(self, prompt_name, new_prompt_name, prompt_category="Default"):
@@ -330,6 +344,8 @@ class Prompts:
         if prompt:
             prompt.name = new_prompt_name
             session.commit()
+            invalidate_chains(user_id=self.user_id, user=self.user)
+            invalidate_prompts(user_id=self.user_id, user=self.user)
         session.close()
 
     def get_prompt_categories(self):
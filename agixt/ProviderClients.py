@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import weakref
+import httpx
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Shared HTTP clients for providers, one connection pool per base URL.
+# httpx.AsyncClient is bound to the event loop it first ran on, so the pools are kept
+# per event loop, the same way the embedding queue is.
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_base_url(url: str) -> str:
+    """Scheme, host and port of a URL, the key connections are pooled by"""
+    url = httpx.URL(str(url))
+    base_url = f"{url.scheme}://{url.host}"
+    if url.port:
+        base_url += f":{url.port}"
+    return base_url
+
+
+def get_provider_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        float(getenv("PROVIDER_REQUEST_TIMEOUT")),
+        connect=float(getenv("PROVIDER_CONNECT_TIMEOUT")),
+    )
+
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """Pooled async HTTP client for the base URL of `url` on the running event loop"""
+    loop = asyncio.get_running_loop()
+    clients = _http_clients.get(loop)
+    if clients is None:
+        clients = {}
+        _http_clients[loop] = clients
+    base_url = get_base_url(url)
+    client = clients.get(base_url)
+    if client is None or client.is_closed:
+        max_connections = int(getenv("PROVIDER_MAX_CONNECTIONS"))
+        client = httpx.AsyncClient(
+            timeout=get_provider_timeout(),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            follow_redirects=True,
+        )
+        clients[base_url] = client
+    return client
+
+
+def get_openai_client(base_url: str, api_key: str):
+    """AsyncOpenAI client for an OpenAI compatible API using the shared pool for its base URL"""
+    import openai
+
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=get_http_client(base_url),
+        timeout=get_provider_timeout(),
+        # Providers handle retries and backoff themselves
+        max_retries=0,
+    )
+
+
+async def close_http_clients():
+    """Close the pooled clients of the running event loop"""
+    clients = _http_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        try:
+            await client.aclose()
+        except Exception as e:
+            logging.warning(f"Error closing HTTP client: {e}")
@@ -4,7 +4,7 @@ from agixtsdk import AGiXTSDK
 from MagicalAuth import MagicalAuth
 from Conversations import get_conversation_name_by_id
 from sqlalchemy.orm import joinedload
-from concurrent.futures import ThreadPoolExecutor
+from TaskQueue import notify_task_queue
 import datetime
 import logging
 import asyncio
@@ -98,6 +98,8 @@ class Task:
         session.commit()
         task_id = str(task.id)
         session.close()
+        if due_date:
+            notify_task_queue()
         return task_id
 
     async def get_pending_tasks(self) -> list:
@@ -128,61 +130,61 @@ class Task:
             session.commit()
         session.close()
 
+    async def execute_task(self, task_id: str):
+        """Run one due task and mark it completed, raises when it fails"""
+        session = get_session()
+        try:
+            task = (
+                session.query(TaskItem)
+                .options(joinedload(TaskItem.category))
+                .filter(TaskItem.id == task_id, TaskItem.user_id == self.user_id)
+                .first()
+            )
+            if not task or task.completed:
+                return
+            if task.category.name == "Follow-ups" and task.agent_id:
+                agent = session.query(Agent).get(task.agent_id)
+                if agent:
+                    conversation_name = get_conversation_name_by_id(
+                        conversation_id=task.memory_collection,
+                        user_id=self.user_id,
+                    )
+                    prompt = f"## Notes about scheduled follow-up task\n{task.description}\n\nThe assistant {agent.name} is doing a scheduled follow up with the user."
+
+                    def execute_prompt():
+                        return self.ApiClient.prompt_agent(
+                            agent_name=agent.name,
+                            prompt_name="Think About It",
+                            prompt_args={
+                                "user_input": prompt,
+                                "conversation_name": conversation_name,
+                                "websearch": False,
+                                "analyze_user_input": False,
+                                "log_user_input": False,
+                                "log_output": True,
+                                "tts": False,
+                            },
+                        )
+
+                    # Run the non-async prompt_agent in a thread, the task monitor
+                    # bounds the task with TASK_TIMEOUT_SECONDS
+                    response = await asyncio.to_thread(execute_prompt)
+                    logging.info(
+                        f"Follow-up task {task.id} executed: {response[:100]}..."
+                    )
+        finally:
+            session.close()
+        # Mark the current task as completed
+        await self.mark_task_completed(str(task_id))
+
     async def execute_pending_tasks(self):
         """Check and execute all pending tasks"""
         tasks = await self.get_pending_tasks()
         for task in tasks:
             try:
-                session = get_session()
-                if task.category.name == "Follow-ups" and task.agent_id:
-                    agent = session.query(Agent).get(task.agent_id)
-                    if agent:
-                        conversation_name = get_conversation_name_by_id(
-                            conversation_id=task.memory_collection,
-                            user_id=self.user_id,
-                        )
-                        prompt = f"## Notes about scheduled follow-up task\n{task.description}\n\nThe assistant {agent.name} is doing a scheduled follow up with the user."
-
-                        def execute_prompt():
-                            return self.ApiClient.prompt_agent(
-                                agent_name=agent.name,
-                                prompt_name="Think About It",
-                                prompt_args={
-                                    "user_input": prompt,
-                                    "conversation_name": conversation_name,
-                                    "websearch": False,
-                                    "analyze_user_input": False,
-                                    "log_user_input": False,
-                                    "log_output": True,
-                                    "tts": False,
-                                },
-                            )
-
-                        # Run the non-async prompt_agent in a thread pool
-                        loop = asyncio.get_running_loop()
-                        with ThreadPoolExecutor() as pool:
-                            try:
-                                response = await asyncio.wait_for(
-                                    loop.run_in_executor(pool, execute_prompt),
-                                    timeout=300,  # 5 minute timeout
-                                )
-                                logging.info(
-                                    f"Follow-up task {task.id} executed: {response[:100]}..."
-                                )
-                            except asyncio.TimeoutError:
-                                logging.error(
-                                    f"Task {task.id} timed out after 5 minutes"
-                                )
-                                raise
-
-                # Mark the current task as completed
-                await self.mark_task_completed(str(task.id))
-
+                await self.execute_task(str(task.id))
             except Exception as e:
                 logging.error(f"Error executing task {task.id}: {str(e)}")
-            finally:
-                if session:
-                    session.close()
 
     async def get_tasks_by_category(self, category_name: str) -> list:
         """Get all tasks in a category"""
@@ -226,6 +228,9 @@ class Task:
             if due_date is not None:
                 task.due_date = due_date
                 task.scheduled = bool(due_date)
+                # A rescheduled task gets a fresh set of attempts
+                task.attempts = 0
+                task.last_error = None
             if estimated_hours is not None:
                 task.estimated_hours = estimated_hours
             if priority is not None:
@@ -235,6 +240,8 @@ class Task:
                 if completed:
                     task.completed_at = datetime.datetime.now()
             session.commit()
+            if due_date is not None:
+                notify_task_queue()
         session.close()
         return "Task updated successfully"
 
@@ -3,13 +3,10 @@ import logging
 from DB import get_session, TaskItem, User
 from Globals import getenv
 from Task import Task
+from TaskQueue import get_task_queue, add_task_wakeup, remove_task_wakeup
 from datetime import datetime, timedelta
 from fastapi import HTTPException
-from hashlib import sha256
 import jwt
-import random
-import socket
-import os
 
 
 logging.basicConfig(level=logging.INFO)
@@ -40,121 +37,97 @@ def impersonate_user(user_id: str):
 
 
 class TaskMonitor:
+    """
+    Runs due tasks from the task queue on this worker.
+
+    Tasks are claimed with a lease, so any number of workers on any number of hosts
+    can run monitors without running a task twice. The monitor sleeps until the next
+    task is due, a running task finishes or a task is scheduled in this process, and
+    polls at least every TASK_POLL_SECONDS to pick up tasks scheduled elsewhere.
+    """
+
     def __init__(self):
         self.running = False
         self.tasks = []
-        self._process_lock = asyncio.Lock()
-        self.worker_id = None
-        self.total_workers = int(getenv("UVICORN_WORKERS"))
-        self._initialize_worker_id()
-
-    def _initialize_worker_id(self):
-        """Generate a unique worker ID based on process information"""
-        # Combine multiple sources of uniqueness
-        pid = os.getpid()
-        hostname = socket.gethostname()
-        # Create a hash of process-specific information
-        unique_str = f"{hostname}:{pid}:{os.getppid()}"
-        hash_obj = sha256(unique_str.encode())
-        # Use last 4 bits of hash for 0-15 worker ID range
-        self.worker_id = int(hash_obj.hexdigest()[-1], 16) % self.total_workers
-        logging.info(
-            f"Initialized worker {self.worker_id} of {self.total_workers} (PID: {pid})"
-        )
-
-    def _should_process_task(self, task_id: str) -> bool:
-        """Determine if this worker should process the given task"""
-        # Use consistent hashing to determine task ownership
-        hash_obj = sha256(task_id.encode())
-        task_num = int(hash_obj.hexdigest()[-1], 16)
-        return task_num % self.total_workers == self.worker_id
-
-    async def get_all_pending_tasks(self) -> list:
-        """Get pending tasks assigned to this worker"""
-        if self.worker_id is None:
-            logging.error("Worker ID not initialized!")
-            return []
-
-        session = get_session()
+        self.queue = get_task_queue()
+        self.worker_id = self.queue.worker_id
+        self.concurrency = max(1, int(getenv("TASK_WORKER_CONCURRENCY")))
+        self.poll_seconds = float(getenv("TASK_POLL_SECONDS"))
+        self.task_timeout = float(getenv("TASK_TIMEOUT_SECONDS"))
+        self.running_tasks = set()
+        self.wakeup = None
+
+    async def run_task(self, claimed_task: dict):
+        task_id = claimed_task["id"]
         try:
-            now = datetime.now()
-            all_tasks = (
-                session.query(TaskItem)
-                .filter(
-                    TaskItem.completed == False,
-                    TaskItem.scheduled == True,
-                    TaskItem.due_date <= now,
-                )
-                .all()
+            if not claimed_task["user_id"]:
+                logging.error(f"Task {task_id} has no associated user")
+                session = get_session()
+                try:
+                    session.query(TaskItem).filter(TaskItem.id == task_id).delete()
+                    session.commit()
+                finally:
+                    session.close()
+                return
+            logging.info(f"Worker {self.worker_id} processing task {task_id}")
+            task_manager = Task(token=impersonate_user(user_id=claimed_task["user_id"]))
+            await asyncio.wait_for(
+                task_manager.execute_task(task_id), timeout=self.task_timeout
+            )
+            await asyncio.to_thread(self.queue.complete, task_id)
+        except asyncio.CancelledError:
+            await asyncio.shield(asyncio.to_thread(self.queue.release, task_id))
+            raise
+        except asyncio.TimeoutError:
+            # The prompt thread and its request keep running after the timeout and
+            # may still deliver the follow-up, retrying could deliver it twice
+            await asyncio.to_thread(
+                self.queue.fail,
+                task_id,
+                f"Timed out after {self.task_timeout:.0f}s",
+                claimed_task["attempts"],
+                False,
+            )
+        except Exception as e:
+            await asyncio.to_thread(
+                self.queue.fail, task_id, str(e), claimed_task["attempts"]
             )
-
-            # Filter tasks for this worker
-            my_tasks = [
-                task for task in all_tasks if self._should_process_task(str(task.id))
-            ]
-
-            return my_tasks
-        finally:
-            session.close()
 
     async def process_tasks(self):
-        """Process tasks assigned to this worker"""
+        """Claim and run due tasks while the monitor is running"""
         while self.running:
             try:
-                # Add initial delay based on worker ID
-                if not hasattr(self, "_initial_delay_done"):
-                    delay = self.worker_id * 5  # 5 second stagger
-                    await asyncio.sleep(delay)
-                    self._initial_delay_done = True
-
-                async with self._process_lock:
-                    pending_tasks = await self.get_all_pending_tasks()
-
-                    for pending_task in pending_tasks:
-                        try:
-                            session = get_session()
-                            try:
-                                if not pending_task.user_id:
-                                    logging.error(
-                                        f"Task {pending_task.id} has no associated user"
-                                    )
-                                    session.delete(pending_task)
-                                    session.commit()
-                                    continue
-
-                                logging.info(
-                                    f"Worker {self.worker_id} processing task {pending_task.id}"
-                                )
-                                task_manager = Task(
-                                    token=impersonate_user(user_id=pending_task.user_id)
-                                )
-
-                                try:
-                                    await asyncio.wait_for(
-                                        task_manager.execute_pending_tasks(),
-                                        timeout=300,
-                                    )
-                                except asyncio.TimeoutError:
-                                    logging.error(f"Task {pending_task.id} timed out")
-                                    continue
-                            finally:
-                                session.close()
-
-                        except Exception as e:
-                            logging.error(
-                                f"Error processing task {pending_task.id}: {str(e)}"
-                            )
-                            continue
-
-                # Add randomized delay between checks (55-65 seconds)
-                check_interval = 60 + random.uniform(-5, 5)
-                await asyncio.sleep(check_interval)
-
+                self.wakeup.clear()
+                free = self.concurrency - len(self.running_tasks)
+                if free > 0:
+                    for claimed_task in await asyncio.to_thread(self.queue.claim, free):
+                        task = asyncio.create_task(self.run_task(claimed_task))
+                        self.running_tasks.add(task)
+                        task.add_done_callback(self.running_tasks.discard)
+                delay = self.poll_seconds
+                if len(self.running_tasks) < self.concurrency:
+                    next_due = await asyncio.to_thread(self.queue.next_due)
+                    if next_due is not None:
+                        delay = min(
+                            delay,
+                            max(0.0, (next_due - datetime.now()).total_seconds()),
+                        )
+                waiter = asyncio.create_task(self.wakeup.wait())
+                try:
+                    await asyncio.wait(
+                        {waiter, *self.running_tasks},
+                        timeout=delay,
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                finally:
+                    waiter.cancel()
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logging.error(
                     f"Error in main task loop (Worker {self.worker_id}): {str(e)}"
                 )
-                await asyncio.sleep(60)
+                await asyncio.sleep(self.poll_seconds)
 
     async def start(self):
         """Start the task monitoring service"""
@@ -162,13 +135,20 @@ class TaskMonitor:
             return
 
         self.running = True
+        self.wakeup = asyncio.Event()
+        add_task_wakeup(self.wakeup)
         task = asyncio.create_task(self.process_tasks())
         self.tasks.append(task)
+        logger.info(
+            f"Task monitor started on worker {self.worker_id} ({self.concurrency} concurrent tasks)."
+        )
 
     async def stop(self):
         """Stop the task monitoring service"""
         self.running = False
-        for task in self.tasks:
+        if self.wakeup is not None:
+            remove_task_wakeup(self.wakeup)
+        for task in [*self.tasks, *self.running_tasks]:
             if not task.done():
                 task.cancel()
                 try:
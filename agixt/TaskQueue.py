@@ -0,0 +1,290 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import or_, func
+from DB import get_session, TaskItem, DATABASE_TYPE
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class TaskQueue:
+    """
+    Durable queue over the scheduled task items in the database.
+
+    A worker claims due tasks by writing its id and an expiry into the task's lease
+    columns. On Postgres the candidates are locked with SELECT ... FOR UPDATE SKIP
+    LOCKED, other databases claim each candidate with a conditional update on the
+    lease. A task whose lease expires, because its worker died, is claimed again.
+    Failed tasks are retried with exponential backoff until `max_attempts`.
+    """
+
+    def __init__(
+        self,
+        worker_id: str = None,
+        lease_seconds: float = 600,
+        max_attempts: int = 5,
+        retry_seconds: float = 60,
+    ):
+        self.worker_id = (
+            worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.running = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def pending_filters(self, now: datetime) -> list:
+        """Tasks waiting to run, whether due yet or not"""
+        return [
+            TaskItem.completed == False,
+            TaskItem.scheduled == True,
+            TaskItem.due_date != None,
+            or_(TaskItem.lease_expires_at == None, TaskItem.lease_expires_at < now),
+            or_(TaskItem.attempts == None, TaskItem.attempts < self.max_attempts),
+        ]
+
+    def lease_values(self, now: datetime) -> dict:
+        return {
+            "lease_owner": self.worker_id,
+            "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+            "attempts": func.coalesce(TaskItem.attempts, 0) + 1,
+        }
+
+    def claim(self, limit: int = 1) -> list:
+        """Lease up to `limit` due tasks to this worker, returns their id, user_id and attempts"""
+        if limit <= 0:
+            return []
+        now = datetime.now()
+        session = get_session()
+        try:
+            due = (
+                session.query(TaskItem.id)
+                .filter(*self.pending_filters(now), TaskItem.due_date <= now)
+                .order_by(TaskItem.due_date)
+            )
+            if DATABASE_TYPE != "sqlite":
+                task_ids = [
+                    row.id
+                    for row in due.limit(limit).with_for_update(skip_locked=True).all()
+                ]
+                if task_ids:
+                    session.query(TaskItem).filter(TaskItem.id.in_(task_ids)).update(
+                        self.lease_values(now), synchronize_session=False
+                    )
+            else:
+                task_ids = []
+                # Over-fetch, other workers may win some of the candidates
+                for row in due.limit(limit * 2).all():
+                    claimed = (
+                        session.query(TaskItem)
+                        .filter(TaskItem.id == row.id, *self.pending_filters(now))
+                        .update(self.lease_values(now), synchronize_session=False)
+                    )
+                    if claimed:
+                        task_ids.append(row.id)
+                    if len(task_ids) >= limit:
+                        break
+            session.commit()
+            if not task_ids:
+                return []
+            tasks = [
+                {
+                    "id": str(task.id),
+                    "user_id": task.user_id,
+                    "attempts": task.attempts or 1,
+                }
+                for task in session.query(
+                    TaskItem.id, TaskItem.user_id, TaskItem.attempts
+                )
+                .filter(TaskItem.id.in_(task_ids))
+                .all()
+            ]
+            with self.lock:
+                self.claimed += len(tasks)
+                self.running += len(tasks)
+            return tasks
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error claiming tasks on worker {self.worker_id}: {e}")
+            return []
+        finally:
+            session.close()
+
+    def update_lease(self, task_id: str, values: dict):
+        """Update the lease of a task claimed by this worker and count it as no longer running"""
+        with self.lock:
+            self.running = max(0, self.running - 1)
+        session = get_session()
+        try:
+            session.query(TaskItem).filter(
+                TaskItem.id == task_id, TaskItem.lease_owner == self.worker_id
+            ).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.error(f"Error updating the lease of task {task_id}: {e}")
+        finally:
+            session.close()
+
+    def complete(self, task_id: str):
+        """Drop the lease of a task that ran, the task marks itself completed"""
+        self.update_lease(
+            task_id, {"lease_owner": None, "lease_expires_at": None, "last_error": None}
+        )
+        with self.lock:
+            self.completed += 1
+
+    def release(self, task_id: str):
+        """Give a task back without counting it as failed, used on shutdown"""
+        self.update_lease(
+            task_id,
+            {
+                "lease_owner": None,
+                "lease_expires_at": None,
+                # The claim counted an attempt that never finished
+                "attempts": func.coalesce(TaskItem.attempts, 1) - 1,
+            },
+        )
+
+    def fail(self, task_id: str, error: str, attempts: int, retry: bool = True):
+        """
+        Record a failure and reschedule the task with backoff, or give up after
+        max_attempts or when `retry` is False.
+        """
+        values = {
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "last_error": str(error)[:2000],
+        }
+        if retry and attempts < self.max_attempts:
+            delay = self.retry_seconds * 2 ** max(0, attempts - 1)
+            values["due_date"] = datetime.now() + timedelta(seconds=delay)
+            logging.warning(
+                f"Task {task_id} failed on attempt {attempts}, retrying in {delay:.0f}s: {error}"
+            )
+            with self.lock:
+                self.retried += 1
+        else:
+            if attempts < self.max_attempts:
+                # Counts as exhausted so it is not claimed again
+                values["attempts"] = self.max_attempts
+            logging.error(
+                f"Task {task_id} failed {attempts} times, not retrying: {error}"
+            )
+            with self.lock:
+                self.failed += 1
+        self.update_lease(task_id, values)
+
+    def next_due(self):
+        """When the next task that is not due yet becomes due, None when there is none"""
+        now = datetime.now()
+        session = get_session()
+        try:
+            return (
+                session.query(func.min(TaskItem.due_date))
+                .filter(*self.pending_filters(now), TaskItem.due_date > now)
+                .scalar()
+            )
+        finally:
+            session.close()
+
+    def metrics(self) -> dict:
+        now = datetime.now()
+        session = get_session()
+        try:
+            depth, oldest_due = (
+                session.query(func.count(TaskItem.id), func.min(TaskItem.due_date))
+                .filter(*self.pending_filters(now), TaskItem.due_date <= now)
+                .one()
+            )
+            leased = (
+                session.query(func.count(TaskItem.id))
+                .filter(
+                    TaskItem.completed == False,
+                    TaskItem.lease_expires_at >= now,
+                )
+                .scalar()
+            )
+            exhausted = (
+                session.query(func.count(TaskItem.id))
+                .filter(
+                    TaskItem.completed == False,
+                    TaskItem.attempts >= self.max_attempts,
+                    or_(
+                        TaskItem.lease_expires_at == None,
+                        TaskItem.lease_expires_at < now,
+                    ),
+                )
+                .scalar()
+            )
+        finally:
+            session.close()
+        with self.lock:
+            return {
+                "worker_id": self.worker_id,
+                "queue_depth": depth,
+                "lag_seconds": (
+                    (now - oldest_due).total_seconds() if oldest_due else 0.0
+                ),
+                "leased": leased,
+                "exhausted": exhausted,
+                "claimed": self.claimed,
+                "running": self.running,
+                "completed": self.completed,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
+
+
+_task_queue = None
+_task_queue_lock = threading.Lock()
+# Events of the task monitors in this process with the loops they wait on
+_wakeups = []
+
+
+def get_task_queue() -> TaskQueue:
+    global _task_queue
+    if _task_queue is None:
+        with _task_queue_lock:
+            if _task_queue is None:
+                _task_queue = TaskQueue(
+                    lease_seconds=float(getenv("TASK_LEASE_SECONDS")),
+                    max_attempts=int(getenv("TASK_MAX_ATTEMPTS")),
+                    retry_seconds=float(getenv("TASK_RETRY_SECONDS")),
+                )
+    return _task_queue
+
+
+def add_task_wakeup(event: asyncio.Event):
+    with _task_queue_lock:
+        _wakeups.append((asyncio.get_running_loop(), event))
+
+
+def remove_task_wakeup(event: asyncio.Event):
+    with _task_queue_lock:
+        _wakeups[:] = [wakeup for wakeup in _wakeups if wakeup[1] is not event]
+
+
+def notify_task_queue():
+    """Wake the task monitors in this process, call after scheduling or rescheduling a task"""
+    with _task_queue_lock:
+        wakeups = list(_wakeups)
+    for loop, event in wakeups:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # The loop is closed
+            pass
@@ -0,0 +1,190 @@
+import atexit
+import logging
+import threading
+from sqlalchemy.exc import IntegrityError
+from DB import get_session, TokenUsage, UserPreferences
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+def get_preference_token_counts(session, user_id: str) -> tuple:
+    """Totals kept in user preferences before the token_usage table existed"""
+    counts = {"input_tokens": 0, "output_tokens": 0}
+    preferences = (
+        session.query(UserPreferences.pref_key, UserPreferences.pref_value)
+        .filter(
+            UserPreferences.user_id == user_id,
+            UserPreferences.pref_key.in_(list(counts.keys())),
+        )
+        .all()
+    )
+    for pref_key, pref_value in preferences:
+        try:
+            counts[pref_key] = int(pref_value)
+        except (TypeError, ValueError):
+            pass
+    return counts["input_tokens"], counts["output_tokens"]
+
+
+def add_token_usage(session, user_id: str, input_tokens: int, output_tokens: int):
+    """Atomically add to a user's totals, creating their row from the preference totals"""
+    increment = {
+        TokenUsage.input_tokens: TokenUsage.input_tokens + input_tokens,
+        TokenUsage.output_tokens: TokenUsage.output_tokens + output_tokens,
+    }
+    updated = (
+        session.query(TokenUsage)
+        .filter(TokenUsage.user_id == user_id)
+        .update(increment, synchronize_session=False)
+    )
+    if updated:
+        return
+    previous_input_tokens, previous_output_tokens = get_preference_token_counts(
+        session, user_id
+    )
+    try:
+        with session.begin_nested():
+            session.add(
+                TokenUsage(
+                    user_id=user_id,
+                    input_tokens=previous_input_tokens + input_tokens,
+                    output_tokens=previous_output_tokens + output_tokens,
+                )
+            )
+    except IntegrityError:
+        # Another worker created the row first
+        session.query(TokenUsage).filter(TokenUsage.user_id == user_id).update(
+            increment, synchronize_session=False
+        )
+
+
+class TokenUsageAggregator:
+    """
+    Collects token usage per user in memory and adds it to the token_usage table in batches.
+
+    A background thread flushes the collected deltas every `flush_seconds`, or sooner
+    once `flush_calls` usages were recorded, so inference never waits on the write.
+    """
+
+    def __init__(self, flush_seconds: float = 5, flush_calls: int = 100):
+        self.flush_seconds = flush_seconds
+        self.flush_calls = flush_calls
+        self.pending = {}
+        # Deltas taken by a flush that has not committed yet
+        self.flushing = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.flusher = None
+
+    def add(self, user_id, input_tokens: int = 0, output_tokens: int = 0):
+        input_tokens = int(input_tokens or 0)
+        output_tokens = int(output_tokens or 0)
+        if not input_tokens and not output_tokens:
+            return
+        with self.lock:
+            counts = self.pending.setdefault(str(user_id), [0, 0])
+            counts[0] += input_tokens
+            counts[1] += output_tokens
+            self.calls += 1
+            flush_now = self.calls >= self.flush_calls
+        if self.flush_seconds <= 0:
+            self.flush()
+            return
+        self.start_flusher()
+        if flush_now:
+            self.flush_requested.set()
+
+    def get_pending(self, user_id) -> tuple:
+        with self.lock:
+            counts = self.pending.get(str(user_id), [0, 0])
+            flushing = self.flushing.get(str(user_id), [0, 0])
+            return counts[0] + flushing[0], counts[1] + flushing[1]
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending, self.calls = self.pending, {}, 0
+                self.flushing = pending
+            if not pending:
+                return
+            session = get_session()
+            try:
+                for user_id, (input_tokens, output_tokens) in pending.items():
+                    add_token_usage(session, user_id, input_tokens, output_tokens)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error flushing token usage: {e}")
+                # Keep the deltas for the next flush
+                with self.lock:
+                    for user_id, (input_tokens, output_tokens) in pending.items():
+                        counts = self.pending.setdefault(user_id, [0, 0])
+                        counts[0] += input_tokens
+                        counts[1] += output_tokens
+            finally:
+                session.close()
+                with self.lock:
+                    self.flushing = {}
+
+    def start_flusher(self):
+        if self.flusher is not None:
+            return
+        with self.lock:
+            if self.flusher is not None:
+                return
+
+            def run():
+                while True:
+                    self.flush_requested.wait(self.flush_seconds)
+                    self.flush_requested.clear()
+                    self.flush()
+
+            self.flusher = threading.Thread(
+                target=run, daemon=True, name="token-usage-flusher"
+            )
+            self.flusher.start()
+
+
+token_usage = TokenUsageAggregator(
+    flush_seconds=float(getenv("TOKEN_USAGE_FLUSH_SECONDS")),
+    flush_calls=int(getenv("TOKEN_USAGE_FLUSH_CALLS")),
+)
+atexit.register(token_usage.flush)
+
+
+def record_token_usage(user_id, input_tokens: int = 0, output_tokens: int = 0):
+    token_usage.add(user_id, input_tokens=input_tokens, output_tokens=output_tokens)
+
+
+def flush_token_usage():
+    token_usage.flush()
+
+
+def get_token_usage(user_id) -> dict:
+    """A user's token totals, including usage this worker has not flushed yet"""
+    session = get_session()
+    try:
+        usage = (
+            session.query(TokenUsage.input_tokens, TokenUsage.output_tokens)
+            .filter(TokenUsage.user_id == str(user_id))
+            .first()
+        )
+        if usage is None:
+            input_tokens, output_tokens = get_preference_token_counts(
+                session, str(user_id)
+            )
+        else:
+            input_tokens, output_tokens = usage
+    finally:
+        session.close()
+    pending_input_tokens, pending_output_tokens = token_usage.get_pending(user_id)
+    return {
+        "input_tokens": int(input_tokens) + pending_input_tokens,
+        "output_tokens": int(output_tokens) + pending_output_tokens,
+    }
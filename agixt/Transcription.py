@@ -1,3 +1,181 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from faster_whisper import WhisperModel
+from Globals import getenv
 
-WhisperModel("base", download_root="models", device="cpu", compute_type="int8")
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class WhisperModelRegistry:
+    """
+    Process wide cache of loaded Whisper models keyed by (model size, compute type).
+
+    Models are loaded on first use and kept resident, the least recently used one is
+    unloaded when more than `max_models` are loaded, and models nobody used for
+    `idle_seconds` are unloaded by a background sweep.
+    """
+
+    def __init__(
+        self,
+        max_models: int = 2,
+        idle_seconds: float = 600,
+        device: str = "cpu",
+        num_workers: int = 2,
+    ):
+        self.max_models = max(1, max_models)
+        self.idle_seconds = idle_seconds
+        self.device = device
+        self.num_workers = max(1, num_workers)
+        self.models = OrderedDict()
+        self.last_used = {}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.sweeper = None
+
+    def get(self, model_size: str = "base", compute_type: str = "int8") -> WhisperModel:
+        key = (model_size, compute_type)
+        with self.lock:
+            model = self.models.get(key)
+            if model is not None:
+                self.models.move_to_end(key)
+                self.last_used[key] = time.monotonic()
+                return model
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        # Load outside the registry lock so other models stay usable meanwhile
+        with load_lock:
+            with self.lock:
+                model = self.models.get(key)
+            if model is None:
+                started = time.monotonic()
+                model = WhisperModel(
+                    model_size,
+                    download_root="models",
+                    device=self.device,
+                    compute_type=compute_type,
+                    num_workers=self.num_workers,
+                )
+                logging.info(
+                    f"Loaded Whisper model {model_size} ({compute_type}) in {time.monotonic() - started:.1f}s"
+                )
+            with self.lock:
+                self.models[key] = model
+                self.models.move_to_end(key)
+                self.last_used[key] = time.monotonic()
+                while len(self.models) > self.max_models:
+                    evicted, _ = self.models.popitem(last=False)
+                    self.last_used.pop(evicted, None)
+                    logging.info(f"Unloaded Whisper model {evicted[0]} ({evicted[1]})")
+        self.start_sweeper()
+        return model
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            for key in [
+                key
+                for key, last_used in self.last_used.items()
+                if now - last_used > self.idle_seconds
+            ]:
+                self.models.pop(key, None)
+                self.last_used.pop(key, None)
+                logging.info(f"Unloaded idle Whisper model {key[0]} ({key[1]})")
+
+    def start_sweeper(self):
+        if self.idle_seconds <= 0 or self.sweeper is not None:
+            return
+        with self.lock:
+            if self.sweeper is not None:
+                return
+
+            def sweep():
+                while True:
+                    time.sleep(min(60, self.idle_seconds))
+                    self.evict_idle()
+
+            self.sweeper = threading.Thread(target=sweep, daemon=True)
+            self.sweeper.start()
+
+    def loaded_models(self) -> list:
+        with self.lock:
+            return [
+                {"model": key[0], "compute_type": key[1]} for key in self.models.keys()
+            ]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+_executor = None
+
+
+def get_whisper_registry() -> WhisperModelRegistry:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = WhisperModelRegistry(
+                    max_models=int(getenv("TRANSCRIPTION_MAX_MODELS")),
+                    idle_seconds=float(getenv("TRANSCRIPTION_IDLE_SECONDS")),
+                    device=getenv("TRANSCRIPTION_DEVICE"),
+                    num_workers=int(getenv("TRANSCRIPTION_WORKERS")),
+                )
+    return _registry
+
+
+def get_transcription_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _registry_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(getenv("TRANSCRIPTION_WORKERS")),
+                    thread_name_prefix="whisper",
+                )
+    return _executor
+
+
+def transcribe_file(
+    audio_path: str,
+    model_size: str = "base",
+    compute_type: str = "int8",
+    translate: bool = False,
+) -> str:
+    model = get_whisper_registry().get(model_size, compute_type)
+    segments, _ = model.transcribe(
+        audio_path,
+        task="transcribe" if not translate else "translate",
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=500),
+    )
+    # Segments are decoded lazily, consume them here on the worker thread
+    return "".join(segment.text for segment in segments)
+
+
+async def transcribe(
+    audio_path: str,
+    model_size: str = "base",
+    compute_type: str = "",
+    translate: bool = False,
+) -> str:
+    """Transcribe or translate an audio file on the transcription thread pool"""
+    if not compute_type:
+        compute_type = getenv("TRANSCRIPTION_COMPUTE_TYPE")
+    return await asyncio.get_running_loop().run_in_executor(
+        get_transcription_executor(),
+        transcribe_file,
+        audio_path,
+        model_size,
+        compute_type,
+        translate,
+    )
+
+
+if __name__ == "__main__":
+    # Download the default model ahead of time, used by the Dockerfile
+    WhisperModel("base", download_root="models", device="cpu", compute_type="int8")
@@ -11,6 +11,7 @@ from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup  # type: ignore
 from typing import List
 from ApiClient import Agent, Conversations
+from Agent import get_agent
 from Globals import getenv, get_tokens
 from Memories import Memories
 from datetime import datetime
@@ -36,7 +37,7 @@ async def search_the_web(
     c = Conversations(conversation_name=conversation_name, user=user)
     conversaton_id = c.get_conversation_id()
     websearch = Websearch(
-        agent=Agent(agent_name=agent_name, ApiClient=ApiClient, user=user),
+        agent=get_agent(agent_name=agent_name, ApiClient=ApiClient, user=user),
         user=user,
         collection_number=conversaton_id,
     )
@@ -1,7 +1,10 @@
 from Interactions import Interactions
 from ApiClient import get_api_client, Conversations, Prompts, Chain
+from Chain import run_chain_steps
 from Conversations import get_conversation_name_by_id, get_conversation_id_by_name
 from Memories import Memories
+from Ingestion import IngestionPipeline
+from Parsers import can_parse_file
 from Extensions import Extensions
 from pydub import AudioSegment
 from Globals import getenv, get_tokens, DEFAULT_SETTINGS
@@ -449,6 +452,7 @@ class AGiXT:
         user_input="",
         agent_override="",
         chain_args={},
+        step_responses: dict = None,
     ):
         if not chain_run_id:
             chain_run_id = await self.chain.get_chain_run_id(chain_name=chain_name)
@@ -472,6 +476,7 @@ class AGiXT:
                     prompt_content=step["prompt"],
                     user_input=user_input,
                     agent_name=agent_name,
+                    step_responses=step_responses,
                 )
                 if chain_args != {}:
                     for arg, value in chain_args.items():
@@ -507,7 +512,9 @@ class AGiXT:
                         args["voice_response"] = False
                         args["log_output"] = False
                         args["user_input"] = user_input
-                        result = self.ApiClient.prompt_agent(
+                        # The SDK call blocks, keep it off the loop so other steps run
+                        result = await asyncio.to_thread(
+                            self.ApiClient.prompt_agent,
                             agent_name=agent_name,
                             prompt_name=prompt_name,
                             prompt_args=args,
@@ -563,7 +570,15 @@ class AGiXT:
         chain_args={},
         log_user_input=False,
         voice_response=False,
+        max_concurrency: int = 0,
     ):
+        """
+        Run a chain from `from_step`, independent steps run concurrently.
+
+        Steps wait only for the earlier steps they reference as {STEPn} or, for
+        prompts using {context}, for all earlier steps. `max_concurrency` caps the
+        steps of this run executing at once, CHAIN_MAX_CONCURRENCY when not set.
+        """
         chain_data = self.chain.get_chain(chain_name=chain_name)
         if not chain_run_id:
             chain_run_id = await self.chain.get_chain_run_id(chain_name=chain_name)
@@ -585,6 +600,7 @@ class AGiXT:
             return f"Chain `{chain_name}` has no steps."
         if len(chain_data["steps"]) == 0:
             return f"Chain `{chain_name}` has no steps."
+        steps = []
         for step_data in chain_data["steps"]:
             if int(step_data["step"]) >= int(from_step):
                 if "prompt" in step_data and "step" in step_data:
@@ -599,15 +615,35 @@ class AGiXT:
                     step["prompt_type"] = step_data["prompt_type"]
                     step["prompt"] = step_data["prompt"]
                     step["step"] = step_data["step"]
-                    task = await self.run_chain_step(
-                        chain_run_id=chain_run_id,
-                        step=step,
-                        chain_name=chain_name,
-                        user_input=user_input,
-                        agent_override=agent_override,
-                        chain_args=chain_args,
-                    )
-                    step_responses.append(task)
+                    steps.append(step)
+        dependencies = self.chain.get_chain_step_dependencies(
+            chain_name=chain_name, chain_data=chain_data
+        )
+        results = {}
+
+        async def run_step(step):
+            response = await self.run_chain_step(
+                chain_run_id=chain_run_id,
+                step=step,
+                chain_name=chain_name,
+                user_input=user_input,
+                agent_override=agent_override,
+                chain_args=chain_args,
+                step_responses=results,
+            )
+            # Later steps read {STEPn} from here instead of the database
+            results[int(step["step"])] = response
+            return response
+
+        await run_chain_steps(
+            steps=steps,
+            dependencies=dependencies,
+            run_step=run_step,
+            chain_run_id=chain_run_id,
+            max_concurrency=max_concurrency,
+            user=self.user_email,
+        )
+        step_responses = [results.get(int(step["step"])) for step in steps]
         logging.info(f"Step responses: {step_responses}")
         if step_responses:
             response = step_responses[-1]
@@ -852,9 +888,19 @@ class AGiXT:
             if new_folder.startswith(self.agent_workspace):
                 with zipfile.ZipFile(file_path, "r") as zipObj:
                     zipObj.extractall(path=new_folder)
+                pdf_vision = str(
+                    self.agent_settings.get("pdf_vision", "")
+                ).lower() not in ["", "none", "false"]
+                bulk_files = []
                 # Iterate over every file that was extracted including subdirectories
                 for root, dirs, files in os.walk(new_folder):
                     for name in files:
+                        if can_parse_file(name) and not (
+                            pdf_vision and name.lower().endswith(".pdf")
+                        ):
+                            bulk_files.append((os.path.join(root, name), name))
+                            continue
+                        # Files that need conversion, transcription or vision are read one at a time
                         current_folder = root.replace(new_folder, "")
                         output_url = f"{self.outputs}/{collection_id}/{extracted_zip_folder_name}/{current_folder}/{name}"
                         logging.info(f"Output URL: {output_url}")
@@ -865,6 +911,22 @@ class AGiXT:
                             user_input=user_input,
                             collection_id=collection_id,
                         )
+                bulk_content = []
+
+                def on_document(document):
+                    self.input_tokens += get_tokens(document["content"])
+                    bulk_content.append(
+                        f"Content from file uploaded named `{document['file_name']}`:\n{document['content']}"
+                    )
+
+                await IngestionPipeline(
+                    memories=self.file_reader,
+                    user_input=user_input,
+                    conversation=self.conversation,
+                    agent_name=self.agent_name,
+                    on_document=on_document,
+                ).run(bulk_files)
+                file_content += "\n".join(bulk_content)
                 response = f"Extracted the content of the zip file [{file_name}]({file_url}) and read them into memory."
             else:
                 response = (
@@ -23,6 +23,9 @@ from contextlib import asynccontextmanager
 from Workspaces import WorkspaceManager
 from typing import Optional
 from TaskMonitor import TaskMonitor
+from ProviderClients import close_http_clients
+from Extensions import get_extension_registry
+from TokenCounter import flush_token_usage
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -41,6 +44,8 @@ task_monitor = TaskMonitor()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Import and inspect every extension once, before the first request needs them
+    get_extension_registry()
     workspace_manager.start_file_watcher()
     await task_monitor.start()
 
@@ -50,6 +55,8 @@ async def lifespan(app: FastAPI):
         # Shutdown
         workspace_manager.stop_file_watcher()
         await task_monitor.stop()
+        await close_http_clients()
+        flush_token_usage()
 
 
 # Register signal handlers for unexpected shutdowns
@@ -3,10 +3,11 @@ import uuid
 from fastapi import APIRouter, Depends, Header
 from Globals import get_tokens
 from MagicalAuth import get_user_id
-from ApiClient import Agent, verify_api_key, get_api_client
+from ApiClient import verify_api_key, get_api_client
+from Agent import get_agent
 from Conversations import get_conversation_name_by_id
 from providers.default import DefaultProvider
-from Memories import embed
+from Embeddings import embed_async
 from fastapi import UploadFile, File, Form
 from typing import Optional, List
 from Models import (
@@ -80,9 +81,9 @@ async def embedding(
 ):
     ApiClient = get_api_client(authorization=authorization)
     agent_name = embedding.model
-    agent = Agent(agent_name=agent_name, user=user, ApiClient=ApiClient)
+    agent = get_agent(agent_name=agent_name, user=user, ApiClient=ApiClient)
     tokens = get_tokens(embedding.input)
-    embedding = embed(input=embedding.input)
+    embedding = await embed_async(input=embedding.input)
     return {
         "data": [{"embedding": embedding, "index": 0, "object": "embedding"}],
         "model": agent_name,
@@ -113,7 +114,7 @@ async def speech_to_text(
     authorization: str = Header(None),
 ):
     ApiClient = get_api_client(authorization=authorization)
-    agent = Agent(agent_name=model, user=user, ApiClient=ApiClient)
+    agent = get_agent(agent_name=model, user=user, ApiClient=ApiClient)
     audio_format = file.content_type.split("/")[1]
     if audio_format == "x-wav":
         audio_format = "wav"
@@ -146,7 +147,7 @@ async def translate_audio(
     authorization: str = Header(None),
 ):
     ApiClient = get_api_client(authorization=authorization)
-    agent = Agent(agent_name=model, user=user, ApiClient=ApiClient)
+    agent = get_agent(agent_name=model, user=user, ApiClient=ApiClient)
     # Save as audio file based on its type
     audio_format = file.content_type.split("/")[1]
     audio_path = f"./WORKSPACE/{uuid.uuid4().hex}.{audio_format}"
@@ -174,7 +175,7 @@ async def text_to_speech(
     user: str = Depends(verify_api_key),
 ):
     ApiClient = get_api_client(authorization=authorization)
-    agent = Agent(agent_name=tts.model, user=user, ApiClient=ApiClient)
+    agent = get_agent(agent_name=tts.model, user=user, ApiClient=ApiClient)
     if agent.TTS_PROVIDER != None:
         audio_data = await agent.text_to_speech(text=tts.input)
     else:
@@ -198,7 +199,7 @@ async def generate_image(
     user: str = Depends(verify_api_key),
 ):
     ApiClient = get_api_client(authorization=authorization)
-    agent = Agent(agent_name=image.model, user=user, ApiClient=ApiClient)
+    agent = get_agent(agent_name=image.model, user=user, ApiClient=ApiClient)
     images = []
     if int(image.n) > 1:
         for i in range(image.n):
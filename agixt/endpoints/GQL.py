@@ -1,12 +1,18 @@
-from MagicalAuth import MagicalAuth, impersonate_user, verify_api_key, is_admin
+from MagicalAuth import (
+    MagicalAuth,
+    impersonate_user,
+    verify_api_key,
+    is_admin,
+    convert_time,
+    get_user_timezone,
+)
 from Conversations import Conversations, get_conversation_name_by_id
 from Providers import get_providers_with_details
-from contextlib import asynccontextmanager
 from typing import List, Optional, Dict
 from Models import ChatCompletions
 from fastapi import HTTPException
 from typing import AsyncGenerator
-from broadcaster import Broadcast
+from EventBus import event_bus
 from Extensions import Extensions
 from Websearch import Websearch
 from Memories import Memories
@@ -236,6 +242,8 @@ class ConversationForkInput:
 class PaginationInput:
     page: int = 1
     limit: int = 100
+    # end_cursor of the previous page, takes precedence over page where supported
+    cursor: Optional[str] = None
 
 
 # Pagination Info
@@ -247,6 +255,7 @@ class PageInfo:
     total_items: int
     current_page: int
     items_per_page: int
+    end_cursor: Optional[str] = None
 
 
 @strawberry.type
@@ -268,19 +277,28 @@ class NotificationConnection:
 
 
 @strawberry.type
-class MessageEvent:
-    conversation_id: str
-    message: ConversationMessage
+class ConversationEvent:
+    conversation: ConversationMetadata
 
 
 @strawberry.type
-class ConversationEvent:
-    conversation: ConversationMetadata
+class ConversationChange:
+    """A conversation that was created, renamed, updated or deleted"""
+
+    conversation_id: str
+    conversation_name: Optional[str] = None
+    updated_at: Optional[datetime] = None
+    deleted: bool = False
 
 
 @strawberry.type
-class NotificationEvent:
-    notification: ConversationNotification
+class MessageChange:
+    """An existing message of the current conversation that was edited or deleted"""
+
+    conversation_id: str
+    message_id: str
+    message: Optional[str] = None
+    deleted: bool = False
 
 
 @strawberry.type
@@ -1312,6 +1330,60 @@ def convert_preferences_to_dict(prefs: UserPreferences) -> dict:
     return result
 
 
+def convert_conversation_metadata(conversation_id: str, details: dict):
+    return ConversationMetadata(
+        id=conversation_id,
+        name=details["name"],
+        agent_id=details["agent_id"],
+        created_at=details["created_at"],
+        updated_at=details["updated_at"],
+        has_notifications=details["has_notifications"],
+        summary=details["summary"],
+        attachment_count=details["attachment_count"],
+    )
+
+
+def get_conversation_connection(
+    user: str, pagination: Optional[PaginationInput] = None
+) -> ConversationConnection:
+    """A page of the user's conversations, paginated in the database"""
+    page = pagination.page if pagination else 1
+    limit = pagination.limit if pagination else 100
+    cursor = pagination.cursor if pagination else None
+    result = Conversations(user=user).get_conversations_page(
+        limit=limit, page=page, cursor=cursor
+    )
+    total_items = result["total_items"]
+    page_info = PageInfo(
+        has_next_page=result["next_cursor"] is not None,
+        has_previous_page=bool(cursor) or page > 1,
+        total_pages=-(-total_items // limit),  # Ceiling division
+        total_items=total_items,
+        current_page=page,
+        items_per_page=limit,
+        end_cursor=result["next_cursor"],
+    )
+    return ConversationConnection(
+        page_info=page_info,
+        edges=[
+            convert_conversation_metadata(id, details)
+            for id, details in result["conversations"].items()
+        ],
+    )
+
+
+def get_conversation_metadata(user: str, conversation_id: str):
+    """Metadata of one of the user's conversations, None when it has no messages"""
+    conversations = Conversations(user=user).get_conversations_page(
+        limit=None, conversation_id=conversation_id
+    )["conversations"]
+    if conversation_id not in conversations:
+        return None
+    return convert_conversation_metadata(
+        conversation_id, conversations[conversation_id]
+    )
+
+
 def convert_extension(ext: dict) -> Extension:
     """Helper to convert raw extension data to Extension type"""
     return Extension(
@@ -1357,19 +1429,6 @@ def convert_extension_command(raw_command: dict) -> ExtensionCommand:
     )
 
 
-# Initialize broadcaster for pub/sub
-broadcast = Broadcast("memory://")
-
-
-@asynccontextmanager
-async def get_broadcaster():
-    await broadcast.connect()
-    try:
-        yield broadcast
-    finally:
-        await broadcast.disconnect()
-
-
 @strawberry.type
 class AppState:
     """Represents the complete application state"""
@@ -1382,9 +1441,114 @@ class AppState:
 
 @strawberry.type
 class AppStateEvent:
-    """Event type for app state updates"""
+    """
+    Event type for app state updates. The first event, and any after the server lost
+    track of changes, carries the full state, the others only what changed.
+    """
+
+    state: Optional[AppState] = None
+    new_messages: Optional[List[ConversationMessage]] = None
+    message_changes: Optional[List[MessageChange]] = None
+    conversation_changes: Optional[List[ConversationChange]] = None
+    notifications: Optional[List[ConversationNotification]] = None
+
 
-    state: AppState
+def build_app_state_event(
+    events: List[dict], user: str, conversation_id: Optional[str], timezone: str
+) -> Optional[AppStateEvent]:
+    """
+    Coalesce a batch of conversation events into one incremental AppStateEvent.
+    Messages added and then edited or deleted within the batch are sent as they end up.
+    """
+    new_messages = {}
+    message_changes = {}
+    conversation_changes = {}
+    notifications = []
+
+    def parse_time(value):
+        if not value:
+            return None
+        return convert_time(datetime.fromisoformat(value), timezone=timezone)
+
+    def get_content(event):
+        if not event.get("truncated"):
+            return event.get("message") or ""
+        # Too large for the event bus, read it from the database
+        content = Conversations(
+            user=user, conversation_name=event.get("conversation_name")
+        ).get_message_by_id(event["message_id"])
+        return content or ""
+
+    def get_change(event):
+        change = conversation_changes.setdefault(
+            event["conversation_id"],
+            ConversationChange(conversation_id=event["conversation_id"]),
+        )
+        if event.get("conversation_name"):
+            change.conversation_name = event["conversation_name"]
+        return change
+
+    for event in events:
+        event_type = event.get("type")
+        message_id = event.get("message_id")
+        if event_type == "conversation_deleted":
+            get_change(event).deleted = True
+        elif event_type in ("conversation_created", "conversation_renamed"):
+            change = get_change(event)
+            if event.get("updated_at"):
+                change.updated_at = parse_time(event["updated_at"])
+        elif event_type == "message_added":
+            get_change(event).updated_at = parse_time(event.get("timestamp"))
+            content = get_content(event)
+            if event.get("notify"):
+                notifications.append(
+                    ConversationNotification(
+                        conversation_id=event["conversation_id"],
+                        conversation_name=event.get("conversation_name") or "",
+                        message_id=message_id,
+                        message=content,
+                        role=event["role"],
+                        timestamp=parse_time(event.get("timestamp")),
+                    )
+                )
+            if event["conversation_id"] == conversation_id:
+                new_messages[message_id] = ConversationMessage(
+                    id=message_id,
+                    role=event["role"],
+                    message=content,
+                    timestamp=parse_time(event.get("timestamp")),
+                    updated_at=parse_time(event.get("updated_at")),
+                    updated_by=None,
+                    feedback_received=False,
+                )
+        elif event.get("conversation_id") != conversation_id:
+            # Edits to other conversations do not show in the list
+            continue
+        elif event_type == "message_updated":
+            content = get_content(event)
+            if message_id in new_messages:
+                new_messages[message_id].message = content
+            else:
+                message_changes[message_id] = MessageChange(
+                    conversation_id=conversation_id,
+                    message_id=message_id,
+                    message=content,
+                )
+        elif event_type == "message_deleted":
+            if new_messages.pop(message_id, None) is None:
+                message_changes[message_id] = MessageChange(
+                    conversation_id=conversation_id,
+                    message_id=message_id,
+                    deleted=True,
+                )
+    if not (new_messages or message_changes or conversation_changes or notifications):
+        return None
+    return AppStateEvent(
+        new_messages=list(new_messages.values()) or None,
+        message_changes=list(message_changes.values()) or None,
+        conversation_changes=list(conversation_changes.values()) or None,
+        notifications=notifications or None,
+    )
 
 
 @strawberry.type
@@ -1447,67 +1611,18 @@ class Subscription:
                 )
 
                 # Get conversations
-                c = Conversations(user=user)
-                result = c.get_conversations_with_detail()
-
-                conversations = [
-                    ConversationMetadata(
-                        id=id,
-                        name=details["name"],
-                        agent_id=details["agent_id"],
-                        created_at=details["created_at"],
-                        updated_at=details["updated_at"],
-                        has_notifications=details["has_notifications"],
-                        summary=details["summary"],
-                        attachment_count=details["attachment_count"],
-                    )
-                    for id, details in result.items()
-                ]
-                conversations.sort(key=lambda x: x.updated_at, reverse=True)
-
-                # Handle pagination
-                page = pagination.page if pagination else 1
-                limit = pagination.limit if pagination else 100
-                total_items = len(conversations)
-                total_pages = -(-total_items // limit)  # Ceiling division
-                start_idx = (page - 1) * limit
-                end_idx = start_idx + limit
-
-                page_info = PageInfo(
-                    has_next_page=end_idx < total_items,
-                    has_previous_page=page > 1,
-                    total_pages=total_pages,
-                    total_items=total_items,
-                    current_page=page,
-                    items_per_page=limit,
-                )
-
-                conversation_connection = ConversationConnection(
-                    page_info=page_info, edges=conversations[start_idx:end_idx]
+                conversation_connection = get_conversation_connection(
+                    user=user, pagination=pagination
                 )
 
                 # Get current conversation if ID provided
                 current_conversation = None
                 if conversation_id:
-                    conversation_name = get_conversation_name_by_id(
-                        conversation_id=conversation_id, user_id=auth_manager.user_id
+                    metadata = get_conversation_metadata(
+                        user=user, conversation_id=conversation_id
                     )
-                    c = Conversations(user=user, conversation_name=conversation_name)
-                    conv_result = {"conversations": c.get_conversations_with_detail()}
-
-                    if conversation_id in conv_result["conversations"]:
-                        details = conv_result["conversations"][conversation_id]
-                        metadata = ConversationMetadata(
-                            id=conversation_id,
-                            name=details["name"],
-                            agent_id=details["agent_id"],
-                            created_at=details["created_at"],
-                            updated_at=details["updated_at"],
-                            has_notifications=details["has_notifications"],
-                            summary=details["summary"],
-                            attachment_count=details["attachment_count"],
-                        )
 
+                    if metadata:
                         c = Conversations(user=user, conversation_name=metadata.name)
                         history_result = c.get_conversation()
 
@@ -1528,7 +1643,7 @@ class Subscription:
                             metadata=metadata, messages=messages
                         )
 
-                notification_data = c.get_notifications()
+                notification_data = Conversations(user=user).get_notifications()
                 notifications = [
                     ConversationNotification(
                         conversation_id=notif["conversation_id"],
@@ -1548,153 +1663,29 @@ class Subscription:
                     notifications=(notifications if notifications else None),
                 )
 
-            # Subscribe to relevant channels
-            broadcaster = Broadcast("memory://")
-            await broadcaster.connect()
-
-            try:
-                # Subscribe to conversations channel
-                async with broadcaster.subscribe(
-                    f"conversations_{user}"
-                ) as conversations_subscriber:
-                    if conversation_id:
-                        # For conversation-specific messages
-                        async with broadcaster.subscribe(
-                            f"messages_{conversation_id}"
-                        ) as messages_subscriber:
-                            # For notifications
-                            async with broadcaster.subscribe(
-                                f"notifications_{user}"
-                            ) as notifications_subscriber:
-                                # Send initial state
-                                initial_state = await get_app_state()
-                                yield AppStateEvent(state=initial_state)
-
-                                async def handle_subscriber(subscriber):
-                                    try:
-                                        async for event in subscriber:
-                                            updated_state = await get_app_state()
-                                            return updated_state
-                                    except Exception as e:
-                                        logging.error(
-                                            f"Subscriber handler error: {str(e)}"
-                                        )
-                                        return None
-
-                                # Create tasks for all active subscribers
-                                tasks = [
-                                    asyncio.create_task(
-                                        handle_subscriber(conversations_subscriber)
-                                    ),
-                                    asyncio.create_task(
-                                        handle_subscriber(messages_subscriber)
-                                    ),
-                                    asyncio.create_task(
-                                        handle_subscriber(notifications_subscriber)
-                                    ),
-                                ]
-
-                                # Main subscription loop
-                                while True:
-                                    done, pending = await asyncio.wait(
-                                        tasks, return_when=asyncio.FIRST_COMPLETED
-                                    )
-
-                                    for task in done:
-                                        try:
-                                            result = await task
-                                            if result:
-                                                yield AppStateEvent(state=result)
-                                        except Exception as e:
-                                            logging.error(f"Task error: {str(e)}")
-
-                                        # Recreate the completed task
-                                        if task in tasks:
-                                            index = tasks.index(task)
-                                            if index == 0:
-                                                tasks[0] = asyncio.create_task(
-                                                    handle_subscriber(
-                                                        conversations_subscriber
-                                                    )
-                                                )
-                                            elif index == 1:
-                                                tasks[1] = asyncio.create_task(
-                                                    handle_subscriber(
-                                                        messages_subscriber
-                                                    )
-                                                )
-                                            elif index == 2:
-                                                tasks[2] = asyncio.create_task(
-                                                    handle_subscriber(
-                                                        notifications_subscriber
-                                                    )
-                                                )
-
-                                    # Keep the pending tasks
-                                    tasks = list(pending)
-                    else:
-                        # Without conversation_id, only subscribe to conversations and notifications
-                        async with broadcaster.subscribe(
-                            f"notifications_{user}"
-                        ) as notifications_subscriber:
-                            # Send initial state
-                            initial_state = await get_app_state()
-                            yield AppStateEvent(state=initial_state)
-
-                            async def handle_subscriber(subscriber):
-                                try:
-                                    async for event in subscriber:
-                                        updated_state = await get_app_state()
-                                        return updated_state
-                                except Exception as e:
-                                    logging.error(f"Subscriber handler error: {str(e)}")
-                                    return None
-
-                            # Create tasks for active subscribers
-                            tasks = [
-                                asyncio.create_task(
-                                    handle_subscriber(conversations_subscriber)
-                                ),
-                                asyncio.create_task(
-                                    handle_subscriber(notifications_subscriber)
-                                ),
-                            ]
-
-                            # Main subscription loop
-                            while True:
-                                done, pending = await asyncio.wait(
-                                    tasks, return_when=asyncio.FIRST_COMPLETED
-                                )
-
-                                for task in done:
-                                    try:
-                                        result = await task
-                                        if result:
-                                            yield AppStateEvent(state=result)
-                                    except Exception as e:
-                                        logging.error(f"Task error: {str(e)}")
-
-                                    # Recreate the completed task
-                                    if task in tasks:
-                                        index = tasks.index(task)
-                                        if index == 0:
-                                            tasks[0] = asyncio.create_task(
-                                                handle_subscriber(
-                                                    conversations_subscriber
-                                                )
-                                            )
-                                        elif index == 1:
-                                            tasks[1] = asyncio.create_task(
-                                                handle_subscriber(
-                                                    notifications_subscriber
-                                                )
-                                            )
-
-                                # Keep the pending tasks
-                                tasks = list(pending)
-
-            finally:
-                await broadcaster.disconnect()
+            # Changes to the user's conversations, published from every worker
+            async with event_bus.subscribe(f"user:{auth_manager.user_id}") as events:
+                # Send initial state
+                yield AppStateEvent(state=await get_app_state())
+                timezone = get_user_timezone(auth_manager.user_id)
+                debounce = float(getenv("EVENT_DEBOUNCE_SECONDS"))
+                while True:
+                    batch = await events.get_batch(debounce=debounce)
+                    if events.overflowed or any(
+                        event.get("type") == "resync" for event in batch
+                    ):
+                        # Changes were missed, send the full state again
+                        events.overflowed = False
+                        yield AppStateEvent(state=await get_app_state())
+                        continue
+                    update = build_app_state_event(
+                        batch,
+                        user=user,
+                        conversation_id=conversation_id,
+                        timezone=timezone,
+                    )
+                    if update:
+                        yield update
 
         except Exception as e:
             logging.error(f"Subscription error: {str(e)}")
@@ -1710,45 +1701,7 @@ class Query:
     ) -> ConversationConnection:
         """Get paginated list of conversations with details"""
         user, auth, magical = await get_user_from_context(info)
-        c = Conversations(user=user)
-        result = c.get_conversations_with_detail()
-
-        # Convert dictionary to list and sort by updated_at
-        conversations = [
-            ConversationMetadata(
-                id=id,
-                name=details["name"],
-                agent_id=details["agent_id"],
-                created_at=details["created_at"],
-                updated_at=details["updated_at"],
-                has_notifications=details["has_notifications"],
-                summary=details["summary"],
-                attachment_count=details["attachment_count"],
-            )
-            for id, details in result.items()
-        ]
-        conversations.sort(key=lambda x: x.updated_at, reverse=True)
-
-        # Handle pagination
-        page = pagination.page if pagination else 1
-        limit = pagination.limit if pagination else 100
-        total_items = len(conversations)
-        total_pages = -(-total_items // limit)  # Ceiling division
-        start_idx = (page - 1) * limit
-        end_idx = start_idx + limit
-
-        page_info = PageInfo(
-            has_next_page=end_idx < total_items,
-            has_previous_page=page > 1,
-            total_pages=total_pages,
-            total_items=total_items,
-            current_page=page,
-            items_per_page=limit,
-        )
-
-        return ConversationConnection(
-            page_info=page_info, edges=conversations[start_idx:end_idx]
-        )
+        return get_conversation_connection(user=user, pagination=pagination)
 
     @strawberry.field
     async def conversation(
@@ -1756,27 +1709,11 @@ class Query:
     ) -> ConversationDetail:
         """Get conversation details and paginated messages"""
         user, auth, magical = await get_user_from_context(info)
-        conversation_name = get_conversation_name_by_id(
-            conversation_id=conversation_id, user_id=magical.user_id
-        )
         # Get conversation metadata
-        c = Conversations(user=user, conversation_name=conversation_name)
-        result = {"conversations": c.get_conversations_with_detail()}
-        if conversation_id not in result["conversations"]:
+        metadata = get_conversation_metadata(user=user, conversation_id=conversation_id)
+        if metadata is None:
             raise Exception(f"Conversation {conversation_id} not found")
 
-        details = result.conversations[conversation_id]
-        metadata = ConversationMetadata(
-            id=conversation_id,
-            name=details["name"],
-            agent_id=details["agent_id"],
-            created_at=details["created_at"],
-            updated_at=details["updated_at"],
-            has_notifications=details["has_notifications"],
-            summary=details["summary"],
-            attachment_count=details["attachment_count"],
-        )
-
         # Get messages with pagination
         c = Conversations(user=user, conversation_name=metadata.name)
         history_result = c.get_conversation()
@@ -2545,46 +2482,12 @@ class Mutation:
         user, auth, magical = await get_user_from_context(info)
         model = LogInteraction(**input.__dict__)
         c = Conversations(user=user, conversation_name=model.conversation_name)
-        result = c.log_interaction(
+        # Subscribers are notified by log_interaction
+        message_id = c.log_interaction(
             message=model.message,
             role=model.role,
         )
-        # Create message event
-        message = ConversationMessage(
-            id=result.message,
-            role=input.role,
-            message=input.message,
-            timestamp=datetime.now(),
-            updated_at=datetime.now(),
-            updated_by=None,
-            feedback_received=False,
-        )
-
-        # Broadcast the new message
-        async with get_broadcaster() as broadcaster:
-            await broadcaster.publish(
-                channel=f"messages_{input.conversation_name}",
-                message=MessageEvent(
-                    conversation_id=input.conversation_name, message=message
-                ),
-            )
-
-            # If this is a notification, broadcast it as well
-            if not input.message.startswith("[ACTIVITY]"):
-                notification = ConversationNotification(
-                    conversation_id=input.conversation_name,
-                    conversation_name=input.conversation_name,
-                    message_id=result.message,
-                    message=input.message,
-                    role=input.role,
-                    timestamp=datetime.now(),
-                )
-                await broadcaster.publish(
-                    channel=f"notifications_{user}",
-                    message=NotificationEvent(notification=notification),
-                )
-
-        return MutationResponse(success=True, message=result.message)
+        return MutationResponse(success=True, message=message_id)
 
     @strawberry.mutation
     async def create_prompt(self, info, input: CreatePromptInput) -> PromptResponse:
@@ -2767,7 +2670,7 @@ class Mutation:
                 conversation_id = str(uuid.UUID(conversation_name))
                 if conversation_id:
                     conversation_name = get_conversation_name_by_id(
-                        conversation_id=conversation_id, user_id=auth.user_id
+                        conversation_id=conversation_id, user_id=magic.user_id
                     )
             except:
                 pass
@@ -1,4 +1,6 @@
 from fastapi import APIRouter
+from Embeddings import get_embedding_metrics
+from TaskQueue import get_task_queue
 
 app = APIRouter()
 
@@ -6,3 +8,13 @@ app = APIRouter()
 @app.get("/health", tags=["Health"])
 async def health():
     return {"status": "UP"}
+
+
+@app.get("/health/embeddings", tags=["Health"])
+async def embedding_metrics():
+    return get_embedding_metrics()
+
+
+@app.get("/health/tasks", tags=["Health"])
+async def task_queue_metrics():
+    return get_task_queue().metrics()
@@ -6,10 +6,10 @@ except ImportError:
 
     subprocess.check_call([sys.executable, "-m", "pip", "install", "anthropic"])
     import anthropic
-import httpx
+from ProviderClients import get_http_client, get_provider_timeout
 import base64
 import logging
-import time
+import asyncio
 
 
 # List of models available at https://docs.anthropic.com/claude/docs/models-overview
@@ -62,7 +62,8 @@ class AnthropicProvider:
             for image in images:
                 # If the image is a url, download it
                 if image.startswith("http"):
-                    image_base64 = base64.b64encode(httpx.get(image).content).decode(
+                    image_response = await get_http_client(image).get(image)
+                    image_base64 = base64.b64encode(image_response.content).decode(
                         "utf-8"
                     )
                 else:
@@ -93,17 +94,27 @@ class AnthropicProvider:
             messages.append({"role": "user", "content": prompt})
 
         if self.GOOGLE_VERTEX_PROJECT_ID != "":
-            c = anthropic.AnthropicVertex(
+            c = anthropic.AsyncAnthropicVertex(
                 access_token=self.ANTHROPIC_API_KEY,
                 region=self.GOOGLE_VERTEX_REGION,
                 project_id=self.GOOGLE_VERTEX_PROJECT_ID,
+                http_client=get_http_client(
+                    f"https://{self.GOOGLE_VERTEX_REGION}-aiplatform.googleapis.com"
+                ),
+                timeout=get_provider_timeout(),
+                max_retries=0,
             )
         else:
-            c = anthropic.Client(api_key=self.ANTHROPIC_API_KEY)
+            c = anthropic.AsyncAnthropic(
+                api_key=self.ANTHROPIC_API_KEY,
+                http_client=get_http_client("https://api.anthropic.com"),
+                timeout=get_provider_timeout(),
+                max_retries=0,
+            )
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
         try:
-            response = c.messages.create(
+            response = await c.messages.create(
                 messages=messages,
                 model=self.AI_MODEL,
                 max_tokens=4096,
@@ -119,5 +130,5 @@ class AnthropicProvider:
                 # Rate limits that impact AGiXT most with Anthropic API are the input tokens per minute being limited to 80k.
                 # If we hit an error, it is almost always because we exceeded this by sending 2 or more prompts in a row exceeding 80k.
                 # To get around it, we sleep for 61 seconds.
-                time.sleep(61)
+                await asyncio.sleep(61)
                 return await self.inference(prompt=prompt, tokens=tokens, images=images)
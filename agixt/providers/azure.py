@@ -1,6 +1,7 @@
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
+from ProviderClients import get_http_client, get_provider_timeout
 import logging
-import time
+import asyncio
 
 
 class AzureProvider:
@@ -43,11 +44,14 @@ class AzureProvider:
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if not self.AZURE_OPENAI_ENDPOINT.endswith("/"):
             self.AZURE_OPENAI_ENDPOINT += "/"
-        openai = AzureOpenAI(
+        client = AsyncAzureOpenAI(
             api_key=self.AZURE_API_KEY,
             api_version="2024-02-01",
             azure_endpoint=self.AZURE_OPENAI_ENDPOINT,
             azure_deployment=self.AI_MODEL,
+            http_client=get_http_client(self.AZURE_OPENAI_ENDPOINT),
+            timeout=get_provider_timeout(),
+            max_retries=0,
         )
         if self.AZURE_API_KEY == "" or self.AZURE_API_KEY == "YOUR_API_KEY":
             if self.AZURE_OPENAI_ENDPOINT == "https://your-endpoint.openai.azure.com":
@@ -82,9 +86,9 @@ class AzureProvider:
         else:
             messages.append({"role": "user", "content": prompt})
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
         try:
-            response = openai.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -100,6 +104,6 @@ class AzureProvider:
             if self.failures > 3:
                 return "Azure OpenAI API Error: Too many failures."
             if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
                 return await self.inference(prompt=prompt, tokens=tokens)
             return str(response)
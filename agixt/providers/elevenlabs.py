@@ -1,4 +1,4 @@
-import requests
+from ProviderClients import get_http_client
 
 
 class ElevenlabsProvider:
@@ -26,8 +26,9 @@ class ElevenlabsProvider:
             "Content-Type": "application/json",
             "xi-api-key": self.ELEVENLABS_VOICE,
         }
+        client = get_http_client("https://api.elevenlabs.io")
         try:
-            response = requests.post(
+            response = await client.post(
                 f"https://api.elevenlabs.io/v1/text-to-speech/{self.ELEVENLABS_VOICE}",
                 headers=headers,
                 json={"text": text},
@@ -35,7 +36,7 @@ class ElevenlabsProvider:
             response.raise_for_status()
         except:
             self.ELEVENLABS_VOICE = "ErXwobaYiN019PkySvjV"
-            response = requests.post(
+            response = await client.post(
                 f"https://api.elevenlabs.io/v1/text-to-speech/{self.ELEVENLABS_VOICE}",
                 headers=headers,
                 json={"text": text},
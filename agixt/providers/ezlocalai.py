@@ -2,8 +2,8 @@ import logging
 import random
 import re
 import numpy as np
-import requests
 from Globals import getenv
+from ProviderClients import get_http_client, get_openai_client
 import uuid
 
 try:
@@ -78,15 +78,14 @@ class EzlocalaiProvider:
         for uri in uri_list:
             if uri not in self.FAILURES:
                 self.API_URI = uri
-                openai.base_url = self.API_URI
                 break
 
+    def get_client(self):
+        return get_openai_client(base_url=self.API_URI, api_key=self.EZLOCALAI_API_KEY)
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if not self.API_URI.endswith("/"):
             self.API_URI += "/"
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        openai.api_type = "openai"
         max_tokens = (
             int(self.MAX_TOKENS) - int(tokens) if tokens > 0 else self.MAX_TOKENS
         )
@@ -120,7 +119,7 @@ class EzlocalaiProvider:
         else:
             messages.append({"role": "user", "content": prompt})
         try:
-            response = openai.chat.completions.create(
+            response = await self.get_client().chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 max_tokens=int(max_tokens),
@@ -162,30 +161,21 @@ class EzlocalaiProvider:
             return await self.inference(prompt=prompt, tokens=tokens, images=images)
 
     async def transcribe_audio(self, audio_path: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            transcription = openai.audio.transcriptions.create(
+            transcription = await self.get_client().audio.transcriptions.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return transcription.text
 
     async def translate_audio(self, audio_path: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            translation = openai.audio.translations.create(
+            translation = await self.get_client().audio.translations.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return translation.text
 
     async def text_to_speech(self, text: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        openai.api_type = "openai"
-        tts_response = openai.audio.speech.create(
+        tts_response = await self.get_client().audio.speech.create(
             model="tts-1",
             voice=self.VOICE,
             input=text,
@@ -196,10 +186,7 @@ class EzlocalaiProvider:
     async def generate_image(self, prompt: str) -> str:
         filename = f"{uuid.uuid4()}.png"
         image_path = f"./WORKSPACE/{filename}"
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        openai.api_type = "openai"
-        response = openai.images.generate(
+        response = await self.get_client().images.generate(
             prompt=prompt,
             model="stabilityai/sdxl-turbo",
             n=1,
@@ -208,8 +195,9 @@ class EzlocalaiProvider:
         )
         logging.info(f"Image Generated for prompt:{prompt}")
         url = response.data[0].url
+        image = await get_http_client(url).get(url)
         with open(image_path, "wb") as f:
-            f.write(requests.get(url).content)
+            f.write(image.content)
         agixt_uri = getenv("AGIXT_URI")
         return f"{agixt_uri}/outputs/{filename}"
 
@@ -1,10 +1,10 @@
-import requests
-import time
+import asyncio
 import logging
 import uuid
 import base64
 import io
 from PIL import Image
+from ProviderClients import get_http_client
 
 
 class HuggingfaceProvider:
@@ -72,7 +72,7 @@ class HuggingfaceProvider:
             tries += 1
             if int(tries) > int(self.MAX_RETRIES):
                 raise ValueError(f"Reached max retries: {self.MAX_RETRIES}")
-            response = requests.post(
+            response = await get_http_client(self.HUGGINGFACE_API_URL).post(
                 self.HUGGINGFACE_API_URL,
                 json=payload,
                 headers=headers,
@@ -81,12 +81,12 @@ class HuggingfaceProvider:
                 logging.info(
                     f"Server Error {response.status_code}: Getting rate-limited / wait for {tries} seconds."
                 )
-                time.sleep(tries)
+                await asyncio.sleep(tries)
             elif response.status_code >= 500:
                 logging.info(
                     f"Server Error {response.status_code}: {response.json()['error']} / wait for {tries} seconds"
                 )
-                time.sleep(tries)
+                await asyncio.sleep(tries)
             elif response.status_code != 200:
                 raise ValueError(f"Error {response.status_code}: {response.text}")
             else:
@@ -181,7 +181,7 @@ class HuggingfaceProvider:
                 "width": width if width else 1920,
             }
         try:
-            response = requests.post(
+            response = await get_http_client(self.STABLE_DIFFUSION_API_URL).post(
                 self.STABLE_DIFFUSION_API_URL,
                 headers=headers,
                 json=generation_settings,  # Use the 'json' parameter instead
@@ -1,9 +1,9 @@
-import time
+import asyncio
 import logging
 import random
-import requests
 import uuid
 from Globals import getenv
+from ProviderClients import get_http_client, get_openai_client
 import numpy as np
 
 try:
@@ -76,7 +76,6 @@ class OpenaiProvider:
         for uri in uri_list:
             if uri not in self.FAILURES:
                 self.API_URI = uri
-                openai.base_url = self.API_URI
                 break
 
     async def inference(self, prompt, tokens: int = 0, images: list = []):
@@ -85,9 +84,6 @@ class OpenaiProvider:
                 self.AI_MODEL = "gpt-4o"
         if not self.API_URI.endswith("/"):
             self.API_URI += "/"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         if self.OPENAI_API_KEY == "" or self.OPENAI_API_KEY == "YOUR_OPENAI_API_KEY":
             if self.API_URI == "https://api.openai.com/v1/":
                 return (
@@ -124,9 +120,9 @@ class OpenaiProvider:
             messages.append({"role": "user", "content": prompt})
 
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
         try:
-            response = openai.chat.completions.create(
+            response = await self.get_client().chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -144,35 +140,32 @@ class OpenaiProvider:
             if "," in self.API_URI:
                 self.rotate_uri()
             if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
                 return await self.inference(prompt=prompt, tokens=tokens)
             return str(response)
 
+    def get_client(self):
+        return get_openai_client(
+            base_url=self.API_URI if self.API_URI else "https://api.openai.com/v1/",
+            api_key=self.OPENAI_API_KEY,
+        )
+
     async def transcribe_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            transcription = openai.audio.transcriptions.create(
+            transcription = await self.get_client().audio.transcriptions.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return transcription.text
 
     async def translate_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
         with open(audio_path, "rb") as audio_file:
-            translation = openai.audio.translations.create(
+            translation = await self.get_client().audio.translations.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return translation.text
 
     async def text_to_speech(self, text: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
-        tts_response = openai.audio.speech.create(
+        tts_response = await self.get_client().audio.speech.create(
             model="tts-1",
             voice=self.VOICE,
             input=text,
@@ -182,10 +175,7 @@ class OpenaiProvider:
     async def generate_image(self, prompt: str) -> str:
         filename = f"{uuid.uuid4()}.png"
         image_path = f"./WORKSPACE/{filename}"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        openai.api_type = "openai"
-        response = openai.images.generate(
+        response = await self.get_client().images.generate(
             prompt=prompt,
             model="dall-e-3",
             n=1,
@@ -194,8 +184,9 @@ class OpenaiProvider:
         )
         logging.info(f"Image Generated for prompt:{prompt}")
         url = response.data[0].url
+        image = await get_http_client(url).get(url)
         with open(image_path, "wb") as f:
-            f.write(requests.get(url).content)
+            f.write(image.content)
         agixt_uri = getenv("AGIXT_URI")
         return f"{agixt_uri}/outputs/{filename}"
 
@@ -1,14 +1,6 @@
-import time
+import asyncio
 import logging
-
-try:
-    import openai
-except ImportError:
-    import sys
-    import subprocess
-
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "openai"])
-    import openai
+from ProviderClients import get_openai_client
 
 
 class XaiProvider:
@@ -56,9 +48,10 @@ class XaiProvider:
         ]
 
     async def inference(self, prompt, tokens: int = 0, images: list = []):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.x.ai/v1/"
-        openai.api_key = f"Bearer {self.XAI_API_KEY}"
-        openai.api_type = "openai"
+        client = get_openai_client(
+            base_url=self.API_URI if self.API_URI else "https://api.x.ai/v1/",
+            api_key=f"Bearer {self.XAI_API_KEY}",
+        )
         messages = []
         if len(images) > 0:
             messages.append(
@@ -90,9 +83,9 @@ class XaiProvider:
             messages.append({"role": "user", "content": prompt})
 
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
         try:
-            response = openai.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=self.AI_MODEL,
                 messages=messages,
                 temperature=float(self.AI_TEMPERATURE),
@@ -108,6 +101,6 @@ class XaiProvider:
             if self.failures > 3:
                 return "xAI API Error: Too many failures."
             if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
                 return await self.inference(prompt=prompt, tokens=tokens)
             return str(response)
@@ -0,0 +1,64 @@
+"""
+Time to construct Extensions(...) with and without the shared extension registry.
+
+Extensions objects are built for every agent, so their construction time is paid on
+most requests. --cold drops the registry before every construction, which repeats the
+glob, import and instantiate pass every Extensions object used to make on its own.
+Run it from the agixt directory against a configured database, the same as the app.
+
+    cd agixt && python ../tests/benchmark_extensions.py --iterations 50
+    cd agixt && python ../tests/benchmark_extensions.py --cold
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import statistics
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "agixt")
+)
+
+
+def run(iterations: int, cold: bool, user: str):
+    import Extensions as extensions_module
+    from Extensions import Extensions, get_extension_registry
+
+    started = time.perf_counter()
+    registry = get_extension_registry()
+    build_time = time.perf_counter() - started
+
+    timings = []
+    for _ in range(iterations):
+        if cold:
+            extensions_module._registry = None
+        started = time.perf_counter()
+        extensions = Extensions(user=user)
+        # Listing and settings are what the endpoints call right after constructing
+        extensions.get_extensions()
+        extensions.get_extension_settings()
+        timings.append(time.perf_counter() - started)
+
+    timings_ms = sorted(timing * 1000 for timing in timings)
+    commands = sum(len(extension["commands"]) for extension in registry.extensions)
+    print(f"mode:                {'cold' if cold else 'registry'}")
+    print(f"extensions:          {len(registry.extensions)} ({commands} commands)")
+    print(f"registry build:      {build_time * 1000:.1f} ms")
+    print(f"iterations:          {iterations}")
+    print(f"construct p50:       {statistics.median(timings_ms):.1f} ms")
+    print(f"construct p99:       {timings_ms[int(len(timings_ms) * 0.99) - 1]:.1f} ms")
+    print(f"construct max:       {timings_ms[-1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--cold", action="store_true")
+    parser.add_argument("--user", default="")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    from Globals import DEFAULT_USER
+
+    run(args.iterations, args.cold, args.user or DEFAULT_USER)
@@ -0,0 +1,154 @@
+"""
+Event loop latency while N completions are in flight against a local stub server.
+
+A stub OpenAI compatible server answers every chat completion after --delay seconds.
+While --concurrency completions run through OpenaiProvider, a ticker coroutine
+measures how late the event loop wakes it up, which is how long any other request
+on the same worker would be stalled.
+
+    python tests/benchmark_provider_concurrency.py --concurrency 50 --delay 0.5
+    python tests/benchmark_provider_concurrency.py --blocking
+
+--blocking runs the same completions through the synchronous OpenAI client inside the
+coroutine, the way providers worked before they moved to async clients.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "agixt")
+)
+
+
+async def handle_request(reader, writer, delay: float):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    content_length = int(value.strip())
+            if content_length:
+                await reader.readexactly(content_length)
+            await asyncio.sleep(delay)
+            body = json.dumps(
+                {
+                    "id": "chatcmpl-benchmark",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "stub",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "pong"},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 1,
+                        "completion_tokens": 1,
+                        "total_tokens": 2,
+                    },
+                }
+            ).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_stub_server(delay: float) -> int:
+    """Run the stub server on its own event loop thread so a blocked client loop cannot stall it"""
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        asyncio.start_server(
+            lambda reader, writer: handle_request(reader, writer, delay),
+            "127.0.0.1",
+            0,
+        )
+    )
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+async def measure_loop_lag(interval: float, lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(port: int, concurrency: int, delay: float, blocking: bool):
+    api_uri = f"http://127.0.0.1:{port}/v1/"
+
+    from providers.openai import OpenaiProvider
+    from ProviderClients import close_http_clients
+
+    provider = OpenaiProvider(
+        OPENAI_API_KEY="benchmark",
+        OPENAI_API_URI=api_uri,
+        OPENAI_MODEL="stub",
+    )
+    provider.WAIT_BETWEEN_REQUESTS = 0
+
+    async def complete():
+        if not blocking:
+            return await provider.inference(prompt="ping")
+        import openai
+
+        # Synchronous client called from the coroutine, blocks the event loop
+        client = openai.OpenAI(api_key="benchmark", base_url=api_uri, max_retries=0)
+        response = client.chat.completions.create(
+            model="stub", messages=[{"role": "user", "content": "ping"}]
+        )
+        return response.choices[0].message.content
+
+    lags = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_loop_lag(0.01, lags, stop))
+    started = time.perf_counter()
+    results = await asyncio.gather(*[complete() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    await close_http_clients()
+
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    print(f"mode:                {'blocking' if blocking else 'async'}")
+    print(f"completions:         {concurrency} ({results.count('pong')} ok)")
+    print(f"server delay:        {delay * 1000:.0f} ms")
+    print(f"wall time:           {elapsed:.2f} s")
+    print(f"loop lag p50:        {statistics.median(lags_ms):.1f} ms")
+    print(f"loop lag p99:        {lags_ms[int(len(lags_ms) * 0.99) - 1]:.1f} ms")
+    print(f"loop lag max:        {lags_ms[-1]:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--blocking", action="store_true")
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    port = start_stub_server(args.delay)
+    asyncio.run(run(port, args.concurrency, args.delay, args.blocking))